@@ -1,9 +1,159 @@
-from fastapi import FastAPI, HTTPException
-from models import TableColumn, AddInput, AddOutput, SQLSearchInput, SQLSearchOutput, SearchInput, SearchOutput, SearchWithRetryOutput
-from typing import List
-from utils import get_schema, add_row_to_db, run_sql_query, call_nlp_module, call_nlp_module_retry
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from models import TableColumn, AddInput, AddOutput, AddBatchOutput, SchemaCacheOutput, SQLCacheOutput, ResultCacheOutput, OllamaEndpointOutput, LLMQueueOutput, SQLSearchInput, SQLSearchOutput, SearchInput, SearchOutput, SearchRaceOutput, SearchWithRetryOutput
+from typing import Awaitable, List, Literal, Optional, TypeVar
+from utils import (get_schema, refresh_schema_cache, add_row_to_db, parse_add_batch, add_rows_to_db,
+                   ADD_BATCH_MAX_LINES, run_sql_query_page_async,
+                   run_sql_query_columnar_async, encode_columnar, open_sql_stream, stream_results_json,
+                   call_nlp_module_async,
+                   discard_cached_sql_async, sql_cache_stats, result_cache_stats, ollama_pool_stats, llm_scheduler_stats,
+                   metrics_text,
+                   search_with_retries, search_race, warm_up_models, SEARCH_RACE_BUDGET,
+                   search_batch, SEARCH_BATCH_CONCURRENCY, SEARCH_BATCH_MAX_ITEMS,
+                   SEARCH_RETRY_MAX_ATTEMPTS, SEARCH_RETRY_BUDGET)
+from text_to_sql.text_to_sql import close_async_client
+from text_to_sql.scheduler import Overloaded
+from db_utils.executor import QueryStream, budget_for, run_in_db_executor
+from db_utils.metrics import REGISTRY, SERVER_TIMING, server_timing_header, start_request_timing
+from db_utils.migrate import apply_migrations
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo di vita dell'app: applica le migrazioni del DB e avvia il warm-up
+    dei modelli Ollama all'avvio; chiude il client HTTP verso Ollama allo shutdown.
+    """
+    try:
+        if await run_in_db_executor(apply_migrations):
+            await run_in_db_executor(refresh_schema_cache)
+    except Exception as e:
+        print(f"[ERRORE] Migrazioni non applicate: {e}")
+    # in background: il backend risponde subito, i modelli si caricano nel frattempo
+    warm_up = asyncio.create_task(warm_up_models())
+    yield
+    warm_up.cancel()
+    await close_async_client()
+
+
+app = FastAPI(lifespan=lifespan)
+
+T = TypeVar("T")
+
+# Ogni quanti secondi le richieste in corso verificano che il client sia ancora connesso
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds", "Durata delle richieste HTTP (fino all'invio degli header)",
+                                          ["method", "route", "status"])
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded) -> JSONResponse:
+    """
+    Richiesta scartata dallo scheduler LLM: 429 (coda piena) o 503 (scadenza),
+    con Retry-After.
+    """
+    return JSONResponse(status_code=exc.status, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
+class ClientDisconnected(Exception):
+    """
+    Il client ha chiuso la connessione prima della risposta.
+    """
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected) -> Response:
+    """
+    Nessuno legge la risposta: 499 (client closed request), utile solo per log e metriche.
+    """
+    return Response(status_code=499)
+
+
+async def until_disconnected(request: Request, work: Awaitable[T]) -> T:
+    """
+    Attende `work` verificando ogni DISCONNECT_POLL_INTERVAL secondi che il
+    client sia ancora connesso. Se si è disconnesso annulla il lavoro (le
+    query in corso sul DB sono interrotte, il posto nello scheduler LLM
+    liberato) e solleva ClientDisconnected.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                print(f"[DEBUG] Client disconnesso: {request.url.path} annullata")
+                raise ClientDisconnected()
+    finally:
+        task.cancel()
+
+
+class TimingMiddleware:
+    """
+    Misura la durata di ogni richiesta e raccoglie i tempi per fase
+    (schema, ollama, validate, db_query, ...). Con SERVER_TIMING attivo
+    (o header X-Server-Timing: 1) li restituisce nell'header Server-Timing.
+    Middleware ASGI puro: con @app.middleware("http") le richieste non
+    vedrebbero la disconnessione del client (vedi until_disconnected).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = start_request_timing()
+        started = time.perf_counter()
+        wants_header = SERVER_TIMING or (b"x-server-timing", b"1") in scope.get("headers", [])
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - started
+                route = scope.get("route")
+                HTTP_REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=getattr(route, "path", "unmatched"),
+                                             status=message["status"])
+                if wants_header:
+                    timings["total"] = elapsed
+                    header = (b"server-timing", server_timing_header(timings).encode("latin-1"))
+                    message = {**message, "headers": [*message.get("headers", []), header]}
+            await send(message)
+
+        await self.app(scope, receive, _send)
+
+
+app.add_middleware(TimingMiddleware)
+
+# Formato colonnare: {"columns": [...], "rows": [[...], ...]} al posto della lista di ResultItem
+COLUMNAR_MEDIA_TYPE = "application/vnd.text2sql.columnar+json"
+
+
+def _wants_columnar(request: Request, format: Optional[str]) -> bool:
+    """
+    Negozia il formato dei risultati: parametro `format` oppure header Accept.
+    """
+    if format:
+        return format == "columnar"
+    return COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _stream_response(qs: QueryStream, head: dict, columnar: bool) -> StreamingResponse:
+    """
+    Risposta in streaming sui risultati di `qs`. La chiusura dello stream è
+    anche un task di background della risposta: la connessione torna al pool
+    pure se il client si disconnette prima che il generatore parta.
+    """
+    return StreamingResponse(stream_results_json(qs, head),
+                             media_type=COLUMNAR_MEDIA_TYPE if columnar else "application/json",
+                             background=BackgroundTask(run_in_db_executor, qs.close))
 
 
 # endpoint -- root
@@ -15,6 +165,16 @@ def root() -> AddOutput:
     return AddOutput(status="ok")
 
 
+# endpoint -- metrics
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """
+    Metriche in formato Prometheus: tempi per fase, token e durate di Ollama,
+    saturazione dei pool (MariaDB, endpoint Ollama) e hit rate delle cache.
+    """
+    return PlainTextResponse(metrics_text(), media_type="text/plain; version=0.0.4")
+
+
 # endpoint -- schema_summary
 @app.get("/schema_summary", response_model=List[TableColumn])
 def schema_summary() -> List[TableColumn]:
@@ -24,6 +184,51 @@ def schema_summary() -> List[TableColumn]:
     return get_schema()
 
 
+# endpoint -- admin/schema_cache/refresh
+@app.post("/admin/schema_cache/refresh", response_model=SchemaCacheOutput)
+def schema_cache_refresh() -> SchemaCacheOutput:
+    """
+    Invalida e ricarica la cache dello schema (da usare dopo migrazioni/DDL).
+    """
+    return SchemaCacheOutput(**refresh_schema_cache())
+
+
+# endpoint -- admin/sql_cache
+@app.get("/admin/sql_cache", response_model=SQLCacheOutput)
+def sql_cache_info() -> SQLCacheOutput:
+    """
+    Restituisce i contatori della cache domanda -> SQL.
+    """
+    return SQLCacheOutput(**sql_cache_stats())
+
+
+# endpoint -- admin/result_cache
+@app.get("/admin/result_cache", response_model=ResultCacheOutput)
+def result_cache_info() -> ResultCacheOutput:
+    """
+    Restituisce i contatori (hit rate compreso) della cache dei risultati delle query.
+    """
+    return ResultCacheOutput(**result_cache_stats())
+
+
+# endpoint -- admin/ollama_pool
+@app.get("/admin/ollama_pool", response_model=List[OllamaEndpointOutput])
+def ollama_pool_info() -> List[OllamaEndpointOutput]:
+    """
+    Restituisce lo stato degli endpoint Ollama (carico, modelli, circuit breaker).
+    """
+    return [OllamaEndpointOutput(**ep) for ep in ollama_pool_stats()]
+
+
+# endpoint -- admin/llm_scheduler
+@app.get("/admin/llm_scheduler", response_model=List[LLMQueueOutput])
+def llm_scheduler_info() -> List[LLMQueueOutput]:
+    """
+    Restituisce lo stato delle code dello scheduler LLM (posti occupati, attese per priorità, scarti).
+    """
+    return [LLMQueueOutput(**q) for q in llm_scheduler_stats()]
+
+
 # endpoint -- add
 @app.post("/add", response_model=AddOutput)
 def add(data: AddInput) -> AddOutput:
@@ -36,59 +241,178 @@ def add(data: AddInput) -> AddOutput:
     raise HTTPException(status_code=422, detail=error_msg)
 
 
+# endpoint -- add_batch
+@app.post("/add_batch", response_model=AddBatchOutput)
+async def add_batch(request: Request, atomic: bool = False) -> AddBatchOutput:
+    """
+    Aggiunge o aggiorna molte righe in una richiesta.
+    Corpo: array JSON di righe nel formato di /add, oppure TSV (formato di data.tsv)
+    con Content-Type text/tab-separated-values.
+    Le righe sono validate tutte prima di scrivere e applicate in transazioni a
+    gruppi; la risposta riporta l'esito di ogni riga. Con `atomic` una sola riga
+    non valida annulla l'intero batch.
+    """
+    lines, error_msg = parse_add_batch(request.headers.get("content-type", ""), await request.body())
+    if lines is None:
+        raise HTTPException(status_code=422, detail=error_msg)
+    if len(lines) > ADD_BATCH_MAX_LINES:
+        raise HTTPException(status_code=422, detail=f"Massimo {ADD_BATCH_MAX_LINES} righe per batch")
+    return AddBatchOutput(**await run_in_db_executor(add_rows_to_db, lines, atomic))
+
+
 # endpoint -- search
 @app.post("/search", response_model=SearchOutput)
-def search(body: SearchInput) -> SearchOutput:
+async def search(body: SearchInput, request: Request, limit: Optional[int] = None, offset: int = 0,
+                 stream: bool = False, format: Optional[Literal["items", "columnar"]] = None
+                 ) -> SearchOutput | Response:
     """
     Converte una domanda in SQL e restituisce i risultati.
+    Paginazione con `limit`/`offset` (al più SQL_MAX_ROWS righe per pagina);
+    con `stream` le righe sono inviate man mano che vengono lette dal DB.
+    Con `format=columnar` (o Accept: application/vnd.text2sql.columnar+json)
+    i risultati sono colonne + righe invece di ResultItem.
+    Le query eseguite rispettano il budget di "search" (vedi SQL_BUDGETS): se
+    lo superano sql_validation è "too_expensive" e sql_error ne indica il motivo.
     """
-    sql_traduction = call_nlp_module(body.question, body.model)
-    valid, result, _ = run_sql_query(sql_traduction)
+    sql_traduction = await until_disconnected(request, call_nlp_module_async(body.question, body.model))
+    columnar = _wants_columnar(request, format)
+    head = {"sql": sql_traduction}
+    budget = budget_for("search")
+
+    if stream:
+        valid, qs, error = await until_disconnected(
+            request, open_sql_stream(sql_traduction, limit, offset, columnar=columnar, budget=budget))
+        if valid == "valid":
+            return _stream_response(qs, {**head, "sql_validation": valid}, columnar)
+        await discard_cached_sql_async(body.question, body.model, sql_traduction)
+        return SearchOutput(sql=sql_traduction, sql_validation=valid, results=None, sql_error=error)
+
+    if columnar:
+        valid, table, error, next_offset = await until_disconnected(
+            request, run_sql_query_columnar_async(sql_traduction, limit, offset, budget))
+        if valid != "valid":
+            await discard_cached_sql_async(body.question, body.model, sql_traduction)
+            head["sql_error"] = error
+        return Response(encode_columnar({**head, "sql_validation": valid}, table, next_offset),
+                        media_type=COLUMNAR_MEDIA_TYPE)
+
+    valid, result, error, next_offset = await until_disconnected(
+        request, run_sql_query_page_async(sql_traduction, limit, offset, budget))
 
     if valid != "valid":
-        return SearchOutput(sql=sql_traduction, sql_validation=valid, results=None)
-    return SearchOutput(sql=sql_traduction, sql_validation=valid, results=result)
+        await discard_cached_sql_async(body.question, body.model, sql_traduction)
+        return SearchOutput(sql=sql_traduction, sql_validation=valid, results=None, sql_error=error)
+    return SearchOutput(sql=sql_traduction, sql_validation=valid, results=result,
+                        truncated=next_offset is not None, next_offset=next_offset)
+
+
+# endpoint -- search_batch
+@app.post("/search_batch")
+async def search_batch_endpoint(body: List[SearchInput], ordered: bool = True,
+                                concurrency: int = SEARCH_BATCH_CONCURRENCY) -> StreamingResponse:
+    """
+    Converte molte domande in SQL ed esegue le query.
+    Risponde in NDJSON: una riga SearchBatchItem per domanda, inviata appena pronta
+    (nell'ordine di input se `ordered`).
+    `concurrency` può solo ridurre il limite SEARCH_BATCH_CONCURRENCY.
+    """
+    if len(body) > SEARCH_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=422, detail=f"Massimo {SEARCH_BATCH_MAX_ITEMS} domande per batch")
+    concurrency = min(concurrency, SEARCH_BATCH_CONCURRENCY)
+
+    async def _lines():
+        async for item in search_batch(body, concurrency=concurrency, ordered=ordered):
+            yield item.json() + "\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
 
 
 # endpoint -- sql_search
 @app.post("/sql_search", response_model=SQLSearchOutput)
-def sql_search(req: SQLSearchInput) -> SQLSearchOutput:
+async def sql_search(req: SQLSearchInput, request: Request, limit: Optional[int] = None, offset: int = 0,
+                     stream: bool = False, format: Optional[Literal["items", "columnar"]] = None
+                     ) -> SQLSearchOutput | Response:
     """
     Esegue una query SQL diretta e restituisce i risultati.
+    Paginazione, streaming e formato colonnare come per /search; budget di "sql_search".
     """
-    validation, results, _ = run_sql_query(req.sql_query)
+    columnar = _wants_columnar(request, format)
+    budget = budget_for("sql_search")
+
+    if stream:
+        validation, qs, error = await until_disconnected(
+            request, open_sql_stream(req.sql_query, limit, offset, columnar=columnar, budget=budget))
+        if validation == "valid":
+            return _stream_response(qs, {"sql_validation": validation}, columnar)
+        return SQLSearchOutput(sql_validation=validation, results=None, sql_error=error)
+
+    if columnar:
+        validation, table, error, next_offset = await until_disconnected(
+            request, run_sql_query_columnar_async(req.sql_query, limit, offset, budget))
+        head = {"sql_validation": validation}
+        if error:
+            head["sql_error"] = error
+        return Response(encode_columnar(head, table, next_offset),
+                        media_type=COLUMNAR_MEDIA_TYPE)
+
+    validation, results, error, next_offset = await until_disconnected(
+        request, run_sql_query_page_async(req.sql_query, limit, offset, budget))
     if validation != "valid":
-        return SQLSearchOutput(sql_validation=validation, results=None)
-    return SQLSearchOutput(sql_validation=validation, results=results)
+        return SQLSearchOutput(sql_validation=validation, results=None, sql_error=error)
+    return SQLSearchOutput(sql_validation=validation, results=results,
+                           truncated=next_offset is not None, next_offset=next_offset)
 
 
 # endpoint -- search_with_retry
 @app.post("/search_with_retry", response_model=SearchWithRetryOutput)
-def search_with_retry(body: SearchInput) -> SearchWithRetryOutput:
+async def search_with_retry(body: SearchInput, request: Request, max_attempts: int = SEARCH_RETRY_MAX_ATTEMPTS,
+                            budget: float = SEARCH_RETRY_BUDGET) -> SearchWithRetryOutput:
     """
     Esegue una query NLP con retry automatico in caso di errore.
+    Ogni SQL è validata (schema + EXPLAIN) prima dell'esecuzione; si fanno al più
+    `max_attempts` tentativi entro `budget` secondi complessivi.
+    `attempt_1`/`attempt_2` riportano i primi due tentativi, `attempts` tutti.
+    `max_attempts` e `budget` possono solo ridurre SEARCH_RETRY_MAX_ATTEMPTS e SEARCH_RETRY_BUDGET.
     """
-    sql_query = call_nlp_module(body.question, body.model)
-    valid, result, error = run_sql_query(sql_query)
-    if valid != "valid":
-        attempt_1 = SearchOutput(sql=sql_query, sql_validation=valid, results=None)
-        sql_retry = call_nlp_module_retry(body.question, sql_query, error, body.model)
-        valid, result, error = run_sql_query(sql_retry)
-        if valid != "valid":
-            return SearchWithRetryOutput(
-                attempt_1=attempt_1, 
-                attempt_2=SearchOutput(sql=sql_retry, sql_validation=valid, results=None)
-            )
-        return SearchWithRetryOutput(
-            attempt_1=attempt_1, 
-            attempt_2=SearchOutput(sql=sql_retry, sql_validation=valid, results=result)
-        )
+    max_attempts = min(max_attempts, SEARCH_RETRY_MAX_ATTEMPTS)
+    budget = min(budget, SEARCH_RETRY_BUDGET)
+    attempts, exhausted = await until_disconnected(
+        request, search_with_retries(body.question, body.model, max_attempts=max_attempts, budget=budget))
+    if not attempts:
+        raise HTTPException(status_code=504, detail="Budget di latenza esaurito prima della generazione della SQL")
+
+    outputs = [SearchOutput(**attempt) for attempt in attempts]
     return SearchWithRetryOutput(
-        attempt_1=SearchOutput(sql=sql_query, sql_validation=valid, results=result), 
-        attempt_2=None
+        attempt_1=outputs[0],
+        attempt_2=outputs[1] if len(outputs) > 1 else None,
+        attempts=outputs,
+        budget_exhausted=exhausted
     )
 
 
+# endpoint -- search_race
+@app.post("/search_race", response_model=SearchRaceOutput)
+async def search_race_endpoint(body: SearchInput, request: Request, limit: Optional[int] = None, offset: int = 0,
+                               budget: float = SEARCH_RACE_BUDGET) -> SearchRaceOutput:
+    """
+    Converte una domanda in SQL mettendo in gara più modelli/temperature
+    (OLLAMA_RACE_CANDIDATES, il modello richiesto per primo): restituisce la
+    prima SQL valida ed eseguita, annullando le altre generazioni.
+    Se nessuna è valida risponde con il primo candidato concluso.
+    `candidates` riporta i candidati conclusi in ordine di arrivo.
+    `budget` può solo ridurre SEARCH_RACE_BUDGET.
+    """
+    budget = min(budget, SEARCH_RACE_BUDGET)
+    winner, candidates, cancelled, exhausted = await until_disconnected(
+        request, search_race(body.question, body.model, limit, offset, budget=budget))
+    if not candidates:
+        raise HTTPException(status_code=504, detail="Budget di latenza esaurito prima della generazione della SQL")
+
+    best = winner or candidates[0]
+    return SearchRaceOutput(**{k: v for k, v in best.items() if k != "seconds"},
+                            candidates=candidates, cancelled=cancelled, budget_exhausted=exhausted)
+
+
 
 
 
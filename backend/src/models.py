@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List, Any, Literal
+from typing import Optional, List, Any, Dict, Literal
 
 class TableColumn(BaseModel):
     table_name: str
@@ -14,6 +14,74 @@ class AddOutput(BaseModel):
     status: str
 
 
+class AddBatchLine(BaseModel):
+    line: int
+    status: Literal["inserted", "updated", "invalid", "failed", "skipped"]
+    error: Optional[str] = None
+
+
+class AddBatchOutput(BaseModel):
+    lines: int
+    inserted: int
+    updated: int
+    invalid: int
+    failed: int
+    skipped: int
+    seconds: float
+    results: List[AddBatchLine]
+
+
+class SchemaCacheOutput(BaseModel):
+    version: int
+    fingerprint: Optional[str] = None
+    loaded: bool
+    age_seconds: Optional[float] = None
+
+
+class SQLCacheOutput(BaseModel):
+    exact_hits: int
+    exact_misses: int
+    similar_hits: int
+    similar_misses: int
+    evictions: int
+    exact_size: int
+    similar_size: int
+
+
+class ResultCacheOutput(BaseModel):
+    hits: int
+    misses: int
+    hit_rate: Optional[float] = None
+    evictions: int
+    invalidations: int
+    size: int
+
+
+class OllamaEndpointOutput(BaseModel):
+    url: str
+    state: Literal["closed", "open", "half_open"]
+    inflight: int
+    max_inflight: int
+    models: Optional[List[str]] = None
+    requests: int
+    errors: int
+    hedges: int
+    ejections: int
+
+
+class LLMQueueOutput(BaseModel):
+    model: str
+    inflight: int
+    limit: int
+    queued: Dict[str, int] = {}
+    service_time: Optional[float] = None
+    admitted: int
+    queued_total: int
+    shed_queue_full: int
+    shed_deadline: int
+    preempted: int
+
+
 class SQLSearchInput(BaseModel):
     sql_query: str
 
@@ -33,17 +101,53 @@ class ResultItem(BaseModel):
     properties: List[Property]
 
 
+class SQLError(BaseModel):
+    code: str
+    message: str
+    token: Optional[str] = None
+
+
 class SearchOutput(BaseModel):
     sql: str
-    sql_validation: Literal["valid", "unsafe", "invalid"]
+    sql_validation: Literal["valid", "unsafe", "invalid", "too_expensive"]
     results: Optional[List[ResultItem]] = None
+    sql_error: Optional[SQLError] = None
+    truncated: bool = False
+    next_offset: Optional[int] = None
+
+
+class SearchBatchItem(SearchOutput):
+    index: int
+    question: str
+
+
+class SearchRaceCandidate(BaseModel):
+    model: str
+    temperature: Optional[float] = None
+    sql: str
+    sql_validation: Literal["valid", "unsafe", "invalid", "too_expensive"]
+    sql_error: Optional[SQLError] = None
+    seconds: float
+
+
+class SearchRaceOutput(SearchOutput):
+    model: str
+    temperature: Optional[float] = None
+    candidates: List[SearchRaceCandidate] = []
+    cancelled: int = 0
+    budget_exhausted: bool = False
 
 
 class SQLSearchOutput(BaseModel):
-    sql_validation: Literal["valid", "unsafe", "invalid"]
+    sql_validation: Literal["valid", "unsafe", "invalid", "too_expensive"]
     results: Optional[List[ResultItem]] = None
+    sql_error: Optional[SQLError] = None
+    truncated: bool = False
+    next_offset: Optional[int] = None
     
 
 class SearchWithRetryOutput(BaseModel):
     attempt_1: SearchOutput
-    attempt_2: Optional[SearchOutput] = None
\ No newline at end of file
+    attempt_2: Optional[SearchOutput] = None
+    attempts: List[SearchOutput] = []
+    budget_exhausted: bool = False
\ No newline at end of file
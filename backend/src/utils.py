@@ -1,28 +1,101 @@
-from models import TableColumn, Property, ResultItem
-from typing import List, Dict, Tuple
+import os
+import json
+import time
+import asyncio
+import decimal
+import datetime
+from models import TableColumn, SearchInput, SearchBatchItem
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, List, Dict, Tuple
+from db_utils.connection import get_pool
+from db_utils.bulk import parse_tsv_lines, upsert_film_lines
 from db_utils.crud import insert_or_update_film
-from db_utils.executor import execute_query
-from db_utils.schema_utils import schema_text_from_information_schema
-from text_to_sql.text_to_sql import build_prompt, ask_ollama
+from db_utils.executor import (DEFAULT_BUDGET, SQL_BUDGET_EVENTS, SQL_MAX_ROWS, QueryBudget, QueryRejected, QueryStream,
+                               budget_for, check_cost, fetch_page, fetch_columns_page, is_statement_timeout,
+                               run_in_db_executor)
+from db_utils.metrics import REGISTRY, stage
+from db_utils.result_cache import normalize_sql, result_cache
+from db_utils.schema_utils import get_schema_columns, get_schema_links, get_schema_tables, get_schema_text, get_schema_fingerprint, invalidate_schema_cache, schema_cache_info
+from text_to_sql.text_to_sql import build_messages, ask_ollama, ask_ollama_async, race_candidates, resolve_model, warm_up_async
+from text_to_sql.sql_cache import sql_cache, normalize_question
+from text_to_sql.sql_validator import UNSAFE_CODES, bound_limit, validate_sql
+from text_to_sql.schema_linking import SCHEMA_PRUNING, prune_schema
+from text_to_sql.ollama_pool import ollama_pool
+from text_to_sql.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RETRY_PENALTY, Claim, Overloaded, llm_scheduler
 
+SEARCH_BATCH_CONCURRENCY = int(os.getenv("SEARCH_BATCH_CONCURRENCY", "4"))
+SEARCH_BATCH_MAX_ITEMS = int(os.getenv("SEARCH_BATCH_MAX_ITEMS", "10000"))
+SEARCH_RETRY_MAX_ATTEMPTS = int(os.getenv("SEARCH_RETRY_MAX_ATTEMPTS", "3"))
+SEARCH_RETRY_BUDGET = float(os.getenv("SEARCH_RETRY_BUDGET", "60"))
+SEARCH_RACE_BUDGET = float(os.getenv("SEARCH_RACE_BUDGET", "60"))
+ADD_BATCH_MAX_LINES = int(os.getenv("ADD_BATCH_MAX_LINES", "50000"))
+# Righe per transazione in /add_batch (transazioni brevi: meno attesa sui lock per gli altri scrittori)
+ADD_BATCH_GROUP_SIZE = int(os.getenv("ADD_BATCH_GROUP_SIZE", "1000"))
 
-def get_schema() -> list[TableColumn]:
+
+class SingleFlight:
+    """
+    Unisce chiamate asincrone identiche in corso (stessa chiave): la prima
+    avvia il lavoro, le successive ne attendono il risultato (o l'errore).
+    Il lavoro gira in un task separato: se il chiamante che l'ha avviato si
+    disconnette gli altri lo ricevono comunque; viene annullato solo quando
+    non resta nessuno ad attenderlo.
+    `context` è associato al lavoro avviato; chi si unisce a un lavoro in corso
+    riceve con `join(context)` quello del primo (es. per alzarne la priorità).
     """
-    Recupera lo schema del database come lista di TableColumn.
+
+    def __init__(self):
+        self._calls: Dict[Hashable, list] = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]], context: Any = None,
+                 join: Callable[[Any], None] | None = None) -> Any:
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = [asyncio.ensure_future(factory()), 0, context]
+            self._calls[key] = entry
+            entry[0].add_done_callback(lambda _, k=key, e=entry: self._calls.pop(k, None)
+                                       if self._calls.get(k) is e else None)
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+            if join is not None:
+                join(entry[2])
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+
+# domanda -> SQL e SQL -> risultati: richieste identiche contemporanee condividono una sola esecuzione
+_nlp_flight = SingleFlight()
+_query_flight = SingleFlight()
+
+
+def get_schema() -> list[TableColumn]:
     """
-    sql = """
-        SELECT TABLE_NAME AS table_name, COLUMN_NAME AS table_column
-        FROM information_schema.COLUMNS
-        WHERE TABLE_SCHEMA = DATABASE()
-        ORDER BY TABLE_NAME, ORDINAL_POSITION
+    Recupera lo schema del database come lista di TableColumn (dalla cache dello schema).
     """
-    ok, rows, err = execute_query(sql)
-    if not ok:
-        print(f"[ERRORE] Query fallita su information_schema: {err}")
+    rows = get_schema_columns()
+    if not rows:
+        print("[ERRORE] Schema non disponibile da information_schema")
         return []
 
     # Converte le righe in oggetti TableColumn
-    return [TableColumn(table_name=r["table_name"], table_column=r["table_column"]) for r in rows]
+    return [TableColumn(table_name=r["table_name"], table_column=r["column_name"]) for r in rows]
+
+
+def refresh_schema_cache() -> dict:
+    """
+    Invalida la cache dello schema e la ricarica subito.
+    Restituisce lo stato aggiornato della cache.
+    """
+    invalidate_schema_cache()
+    get_schema_text()
+    return schema_cache_info()
 
 
 def add_row_to_db(data_line: str) -> tuple[bool, str | None]:
@@ -33,82 +106,771 @@ def add_row_to_db(data_line: str) -> tuple[bool, str | None]:
     return insert_or_update_film(data_line)
 
 
-def run_sql_query(sql_query: str) -> Tuple[str, List[Dict] | None, str | None]:
+def parse_add_batch(content_type: str, body: bytes) -> Tuple[List[Tuple[int, List[str]]] | None, str | None]:
+    """
+    Righe del corpo di /add_batch come coppie (numero di riga, campi):
+    - JSON: array di righe nel formato di /add (stringhe "Titolo,Regista,...",
+      oppure oggetti {"data_line": ...}); il numero di riga è la posizione (da 1);
+    - TSV (text/tab-separated-values o text/plain): formato di data.tsv,
+      intestazione facoltativa.
+    Restituisce (righe, None) oppure (None, messaggio_errore).
+    """
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return None, "Il corpo deve essere in UTF-8"
+    if "json" not in content_type:
+        return parse_tsv_lines(text), None
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        return None, f"JSON non valido: {e}"
+    if not isinstance(data, list):
+        return None, "Atteso un array JSON di righe"
+    lines = []
+    for i, item in enumerate(data, start=1):
+        if isinstance(item, dict):
+            item = item.get("data_line")
+        if not isinstance(item, str):
+            return None, f"Riga {i}: attesa una stringa nel formato di /add"
+        lines.append((i, item.split(",")))
+    return lines, None
+
+
+def add_rows_to_db(lines: List[Tuple[int, List[str]]], atomic: bool = False) -> Dict:
+    """
+    Aggiunge o aggiorna molte righe nel DB (vedi db_utils.bulk.upsert_film_lines).
+    Restituisce i conteggi e l'esito di ogni riga.
+    """
+    return upsert_film_lines(lines, group_size=ADD_BATCH_GROUP_SIZE, atomic=atomic)
+
+
+def validate_query(sql_query: str) -> Tuple[str, Dict | None]:
+    """
+    Valida una query prima di eseguirla (sql_validator + schema in cache).
+    Restituisce ("valid", None), ("unsafe", errore) o ("invalid", errore),
+    con errore = {"code": ..., "message": ..., "token": ...}.
+    """
+    with stage("validate"):
+        check = validate_sql(sql_query, get_schema_tables())
+    if check.ok:
+        return "valid", None
+    error = {"code": check.code, "message": check.message, "token": check.token}
+    return ("unsafe" if check.code in UNSAFE_CODES else "invalid"), error
+
+
+def db_error_status(db_error: str) -> Tuple[str, Dict]:
+    """
+    Stato ed errore strutturato per un errore del DB in esecuzione:
+    ("too_expensive", statement_timeout) se la query ha superato il tempo
+    massimo del suo budget, altrimenti ("invalid", db_error).
+    """
+    if is_statement_timeout(db_error):
+        SQL_BUDGET_EVENTS.inc(reason="statement_timeout")
+        return "too_expensive", {"code": "statement_timeout", "message": db_error, "token": None}
+    return "invalid", {"code": "db_error", "message": db_error, "token": None}
+
+
+def bounded_sql(sql_query: str, limit: int | None = None, offset: int = 0) -> str:
+    """
+    SQL effettivamente eseguita per una pagina: LIMIT esterno aggiunto o ridotto
+    alle righe che QueryStream può leggere (offset + pagina + 1 per has_more).
+    """
+    return bound_limit(sql_query, offset + clamp_limit(limit) + 1)
+
+
+def error_text(error: Dict | None) -> str:
+    """
+    Descrizione testuale di un errore strutturato (per log e prompt di retry).
+    """
+    if not error:
+        return ""
+    text = f"[{error['code']}] {error['message']}"
+    if error.get("token"):
+        text += f" (vicino a: {error['token']})"
+    return text
+
+
+def _to_result_item(row: Dict, table_name: str = "film") -> Dict:
+    # Stessa forma di ResultItem(...).dict(), senza oggetti intermedi
+    return {
+        "item_type": table_name,
+        "properties": [{"property_name": "name" if k == "titolo" else k, "property_value": v}
+                       for k, v in row.items()],
+    }
+
+
+def _column_names(columns: List[str]) -> List[str]:
+    # Stessa rinomina applicata alle property dei ResultItem
+    return ["name" if c == "titolo" else c for c in columns]
+
+
+def _json_default(value):
+    # Tipi restituiti da MariaDB non serializzabili direttamente in JSON
+    if isinstance(value, (datetime.date, datetime.time, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+def clamp_limit(limit: int | None) -> int:
+    """
+    Numero di righe per pagina: quello richiesto, ma mai oltre SQL_MAX_ROWS.
+    """
+    return SQL_MAX_ROWS if limit is None else max(0, min(limit, SQL_MAX_ROWS))
+
+
+def run_sql_query_page(sql_query: str, limit: int | None = None, offset: int = 0,
+                       budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[str, List[Dict] | None, Dict | None, int | None]:
+    """
+    Esegue una query SQL sicura restituendo una pagina di risultati
+    (al più `limit` righe, mai oltre SQL_MAX_ROWS, a partire da `offset`),
+    entro il `budget` di esecuzione (piano EXPLAIN e durata massima).
+
+    Returns:
+        Tuple[str, List[Dict] | None, Dict | None, int | None]:
+            - stato: "valid", "invalid", "unsafe" o "too_expensive" (budget superato)
+            - results: lista di ResultItem oppure None
+            - error: {"code", "message"} se presente
+            - next_offset: offset della pagina successiva, None se non ci sono altre righe
+    """
+    valid, error = validate_query(sql_query)
+    if valid != "valid":
+        return valid, None, error, None
+
+    # Esecuzione query (cursore non bufferizzato, righe limitate lato server)
+    try:
+        success, rows, db_error, has_more = fetch_page(bounded_sql(sql_query, limit, offset), clamp_limit(limit),
+                                                       offset, budget)
+    except QueryRejected as e:
+        return "too_expensive", None, e.error, None
+    if not success:
+        valid, error = db_error_status(db_error)
+        return valid, None, error, None
+
+    with stage("convert"):
+        results = [_to_result_item(row) for row in rows]
+    return "valid", results, None, (offset + len(rows) if has_more else None)
+
+
+def run_sql_query(sql_query: str, limit: int | None = None, offset: int = 0,
+                  budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[str, List[Dict] | None, Dict | None]:
     """
     Esegue una query SQL sicura e converte i risultati in formato strutturato.
 
-    Blocca query pericolose (DROP, DELETE, UPDATE, INSERT).
+    Blocca query non di sola lettura e rifiuta prima dell'esecuzione quelle
+    che referenziano tabelle/colonne inesistenti (vedi validate_query).
+    Restituisce al più SQL_MAX_ROWS righe (vedi run_sql_query_page per la paginazione).
 
     Returns:
-        Tuple[str, List[Dict] | None, str | None]:
-            - stato: "valid", "invalid" o "unsafe"
+        Tuple[str, List[Dict] | None, Dict | None]:
+            - stato: "valid", "invalid", "unsafe" o "too_expensive"
             - results: lista di ResultItem oppure None
-            - error: messaggio di errore se presente
+            - error: {"code", "message"} se presente
+    """
+    valid, results, error, _ = run_sql_query_page(sql_query, limit, offset, budget)
+    return valid, results, error
+
+
+def run_sql_query_columnar(sql_query: str, limit: int | None = None, offset: int = 0,
+                           budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[str, Dict | None, Dict | None, int | None]:
+    """
+    Come run_sql_query_page, ma con risultati in forma colonnare:
+    {"columns": [...], "rows": [[...], ...]} costruiti direttamente dalle tuple del cursore.
     """
-    # Sicurezza: blocco query pericolose
-    for keyword in ("DROP", "DELETE", "UPDATE", "INSERT"):
-        if keyword in sql_query.upper():
-            return "unsafe", None, f"Operazione {keyword} non permessa"
+    valid, error = validate_query(sql_query)
+    if valid != "valid":
+        return valid, None, error, None
 
-    # Esecuzione query
-    success, rows, error = execute_query(sql_query)
+    try:
+        success, columns, rows, db_error, has_more = fetch_columns_page(
+            bounded_sql(sql_query, limit, offset), clamp_limit(limit), offset, budget)
+    except QueryRejected as e:
+        return "too_expensive", None, e.error, None
     if not success:
-        return "invalid", None, error
+        valid, error = db_error_status(db_error)
+        return valid, None, error, None
+    return "valid", {"columns": _column_names(columns), "rows": rows}, None, (offset + len(rows) if has_more else None)
+
+
+def encode_columnar(head: Dict, table: Dict | None, next_offset: int | None) -> bytes:
+    """
+    Serializza in JSON compatto una risposta colonnare
+    {**head, columns, rows, truncated, next_offset}.
+    """
+    body = {**head, "columns": table["columns"] if table else None, "rows": table["rows"] if table else None,
+            "truncated": next_offset is not None, "next_offset": next_offset}
+    return json.dumps(body, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+async def run_sql_query_columnar_async(sql_query: str, limit: int | None = None, offset: int = 0,
+                                       budget: QueryBudget = DEFAULT_BUDGET
+                                       ) -> Tuple[str, Dict | None, Dict | None, int | None]:
+    """
+    Versione asincrona di run_sql_query_columnar (eseguita nel thread pool DB).
+    Query identiche in corso (con lo stesso budget) sono eseguite una volta sola.
+    """
+    key = ("columns", normalize_sql(sql_query), clamp_limit(limit), offset, budget)
+    return await _query_flight.do(
+        key, lambda: run_in_db_executor(run_sql_query_columnar, sql_query, limit, offset, budget))
+
+
+async def run_sql_query_async(sql_query: str, limit: int | None = None, offset: int = 0,
+                              budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[str, List[Dict] | None, Dict | None]:
+    """
+    Versione asincrona di run_sql_query (eseguita nel thread pool DB).
+    """
+    valid, results, error, _ = await run_sql_query_page_async(sql_query, limit, offset, budget)
+    return valid, results, error
 
-    results: List[Dict] = []
-    table_name = "film"
 
-    # Conversione risultati in ResultItem
-    for row in rows:
-        props = []
-        for k, v in row.items():
-            props.append(Property(property_name="name" if k == "titolo" else k, property_value=v))
-        results.append(ResultItem(item_type=table_name, properties=props).dict())
+async def run_sql_query_page_async(sql_query: str, limit: int | None = None, offset: int = 0,
+                                   budget: QueryBudget = DEFAULT_BUDGET
+                                   ) -> Tuple[str, List[Dict] | None, Dict | None, int | None]:
+    """
+    Versione asincrona di run_sql_query_page (eseguita nel thread pool DB).
+    Query identiche in corso (con lo stesso budget) sono eseguite una volta sola.
+    """
+    key = ("rows", normalize_sql(sql_query), clamp_limit(limit), offset, budget)
+    return await _query_flight.do(
+        key, lambda: run_in_db_executor(run_sql_query_page, sql_query, limit, offset, budget))
+
 
-    return "valid", results, None
+def _open_stream(qs: QueryStream, budget: QueryBudget) -> Tuple[str, Dict | None]:
+    try:
+        db_error = check_cost(qs.sql_query, budget)
+        if not db_error:
+            qs.open()
+    except QueryRejected as e:
+        return "too_expensive", e.error
+    except Exception as e:
+        db_error = str(e)
+    return db_error_status(db_error) if db_error else ("valid", None)
+
+
+async def open_sql_stream(sql_query: str, limit: int | None = None, offset: int = 0, columnar: bool = False,
+                          budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[str, QueryStream | None, Dict | None]:
+    """
+    Valida ed esegue una query per lo streaming dei risultati, entro il `budget`.
+    Restituisce (stato, stream, errore): lo stream è aperto solo se lo stato è "valid"
+    e chi lo riceve deve chiuderlo (vedi stream_results_json).
+    """
+    valid, error = await run_in_db_executor(validate_query, sql_query)
+    if valid != "valid":
+        return valid, None, error
+
+    qs = QueryStream(bounded_sql(sql_query, limit, offset), max_rows=clamp_limit(limit), offset=offset,
+                     dictionary=not columnar, max_time=budget.max_time)
+    try:
+        valid, error = await run_in_db_executor(_open_stream, qs, budget)
+    except asyncio.CancelledError:
+        # annullata (client disconnesso) con l'apertura ancora in corso: la
+        # chiusura attende la fine di open e restituisce la connessione al pool
+        await run_in_db_executor(qs.close)
+        raise
+    return valid, (qs if valid == "valid" else None), error
+
+
+async def stream_results_json(qs: QueryStream, head: Dict) -> AsyncIterator[str]:
+    """
+    Serializza in JSON una risposta {**head, results: [...], truncated, next_offset}
+    codificando le righe man mano che vengono lette dal cursore.
+    Se lo stream è colonnare (dictionary=False) produce invece
+    {**head, columns: [...], rows: [[...], ...], truncated, next_offset}.
+    """
+    try:
+        if qs.dictionary:
+            yield "{" + json.dumps(head)[1:-1] + ', "results": ['
+            encode = lambda r: json.dumps(_to_result_item(r), default=_json_default)
+        else:
+            yield ("{" + json.dumps(head)[1:-1] + f', "columns": {json.dumps(_column_names(qs.columns))}'
+                   + ', "rows": [')
+            encode = lambda r: json.dumps(r, separators=(",", ":"), default=_json_default)
+        first = True
+        while rows := await run_in_db_executor(qs.fetch):
+            chunk = ",".join(encode(r) for r in rows)
+            yield chunk if first else "," + chunk
+            first = False
+        yield f'], "truncated": {json.dumps(qs.has_more)}, "next_offset": {json.dumps(qs.next_offset)}}}'
+    except Exception as e:
+        print(f"[ERRORE] Streaming risultati interrotto: {e}")
+        yield f'], "truncated": true, "next_offset": null, "error": {json.dumps(str(e))}}}'
+    finally:
+        await run_in_db_executor(qs.close)
+
+
+_SCHEMA_ERROR = "[ERROR] Impossibile recuperare lo schema dal database."
+
+
+def _prepare_nlp(question: str, model: str | None) -> tuple[str | None, list[dict] | None, str, str | None]:
+    """
+    Parte bloccante (schema + cache) della traduzione domanda -> SQL.
+    Restituisce (sql_pronta, prompt, modello, fingerprint): se sql_pronta
+    non è None (cache o errore schema) non serve interrogare Ollama.
+    Con SCHEMA_PRUNING le tabelle collegate alla domanda (con i valori di
+    esempio) vanno nel messaggio utente: il messaggio di sistema resta lo
+    stesso del warm-up e la KV cache del prefisso viene riusata.
+    """
+    with stage("schema"):
+        schema_text = get_schema_text()
+    use_model = resolve_model(model)
+    if not schema_text:
+        print(_SCHEMA_ERROR)
+        return f"SELECT NULL AS warning -- {_SCHEMA_ERROR}", None, use_model, None
+
+    fingerprint = get_schema_fingerprint()
+    with stage("sql_cache"):
+        cached_sql, _ = sql_cache.get(question, use_model, fingerprint)
+    if cached_sql is not None:
+        return cached_sql, None, use_model, fingerprint
+    with stage("prompt"):
+        links = get_schema_links() if SCHEMA_PRUNING else None
+        context = prune_schema(question, **links) if links and links["tables"] else None
+        return None, build_messages(schema_text, question, context), use_model, fingerprint
+
+
+def _store_nlp(question: str, model: str, fingerprint: str | None, sql: str) -> str:
+    if not sql.startswith("SELECT NULL AS warning"):
+        sql_cache.put(question, model, fingerprint, sql)
+    return sql
 
 
 def call_nlp_module(question: str, model: str | None = None) -> str:
     """
     Converte una domanda in query SQL usando Ollama.
+    Le SQL generate sono servite dalla cache domanda -> SQL quando possibile.
+    """
+    sql, prompt, use_model, fingerprint = _prepare_nlp(question, model)
+    if sql is not None:
+        return sql
+    return _store_nlp(question, use_model, fingerprint, ask_ollama(prompt, use_model))
+
+
+async def _call_nlp_module_async(question: str, model: str | None, claim: Claim) -> str:
+    sql, prompt, use_model, fingerprint = await run_in_db_executor(_prepare_nlp, question, model)
+    if sql is not None:
+        return sql
+    sql = await llm_scheduler.run(use_model, lambda: ask_ollama_async(prompt, use_model), claim=claim)
+    return _store_nlp(question, use_model, fingerprint, sql)
+
+
+async def call_nlp_module_async(question: str, model: str | None = None, priority: int = PRIORITY_INTERACTIVE,
+                                deadline: float | None = None) -> str:
+    """
+    Versione asincrona di call_nlp_module.
+    Richieste contemporanee con la stessa domanda (normalizzata) e lo stesso
+    modello condividono una sola generazione.
+    La chiamata a Ollama passa dallo scheduler LLM con la `priority` e la
+    `deadline` (time.monotonic()) indicate: solleva Overloaded se scartata.
+    Chi si unisce a una generazione in corso ne alza la priorità e ne prolunga
+    la scadenza se le sue sono più favorevoli.
+    """
+    key = (normalize_question(question), resolve_model(model))
+    claim = Claim(priority, deadline)
+    return await _nlp_flight.do(key, lambda: _call_nlp_module_async(question, model, claim), claim,
+                                lambda leader: leader.join(priority, deadline))
+
+
+def discard_cached_sql(question: str, model: str | None = None, sql: str | None = None) -> None:
+    """
+    Rimuove dalla cache la SQL di una domanda (es. perché non eseguibile).
+    Con `sql` (la query fallita) la rimuove anche se era servita per similarità
+    da un'altra domanda.
+    """
+    sql_cache.discard(question, resolve_model(model), get_schema_fingerprint(), sql)
+
+
+async def discard_cached_sql_async(question: str, model: str | None = None, sql: str | None = None) -> None:
+    """
+    Versione asincrona di discard_cached_sql.
+    """
+    await run_in_db_executor(discard_cached_sql, question, model, sql)
+
+
+def sql_cache_stats() -> dict:
+    """
+    Contatori della cache domanda -> SQL.
     """
-    schema_text = schema_text_from_information_schema()
+    return sql_cache.info()
+
+
+def result_cache_stats() -> dict:
+    """
+    Contatori della cache dei risultati delle query.
+    """
+    return result_cache.info()
+
+
+def ollama_pool_stats() -> list[dict]:
+    """
+    Stato degli endpoint Ollama del pool.
+    """
+    return ollama_pool.info()
+
+
+def llm_scheduler_stats() -> list[dict]:
+    """
+    Stato delle code dello scheduler LLM per modello.
+    """
+    return llm_scheduler.info()
+
+
+_DB_POOL = REGISTRY.gauge("db_pool_connections", "Connessioni del pool MariaDB", ["state"])
+_DB_POOL_EVENTS = REGISTRY.counter("db_pool_events_total", "Connessioni create e riconnessioni del pool MariaDB",
+                                   ["event"])
+_OLLAMA_INFLIGHT = REGISTRY.gauge("ollama_endpoint_inflight", "Richieste in corso per endpoint Ollama", ["url"])
+_OLLAMA_MAX_INFLIGHT = REGISTRY.gauge("ollama_endpoint_max_inflight", "Limite di richieste per endpoint Ollama",
+                                      ["url"])
+_OLLAMA_UP = REGISTRY.gauge("ollama_endpoint_up", "Circuit breaker chiuso (1), semiaperto (0.5) o aperto (0)",
+                            ["url"])
+_OLLAMA_EVENTS = REGISTRY.counter("ollama_endpoint_events_total", "Richieste, errori, hedge ed espulsioni per endpoint",
+                                  ["url", "event"])
+_CACHE_LOOKUPS = REGISTRY.counter("cache_lookups_total", "Accessi alle cache per esito", ["cache", "result"])
+_CACHE_HIT_RATIO = REGISTRY.gauge("cache_hit_ratio", "Hit rate delle cache", ["cache"])
+_CACHE_SIZE = REGISTRY.gauge("cache_entries", "Voci presenti nelle cache", ["cache"])
+_FLIGHT_CALLS = REGISTRY.counter("singleflight_calls_total", "Chiamate unite (follower) o eseguite (leader)",
+                                 ["flight", "role"])
+_BREAKER_UP = {"closed": 1, "half_open": 0.5, "open": 0}
+
+
+def _collect_metrics() -> None:
+    # gauge e contatori mantenuti dai singoli componenti, letti a ogni scrape
+    pool = get_pool().stats()
+    _DB_POOL.set(pool["in_use"], state="in_use")
+    _DB_POOL.set(pool["idle"], state="idle")
+    _DB_POOL.set(pool["size"], state="max")
+    _DB_POOL_EVENTS.set(pool["created"], event="created")
+    _DB_POOL_EVENTS.set(pool["reconnects"], event="reconnect")
+
+    for ep in ollama_pool.info():
+        _OLLAMA_INFLIGHT.set(ep["inflight"], url=ep["url"])
+        _OLLAMA_MAX_INFLIGHT.set(ep["max_inflight"], url=ep["url"])
+        _OLLAMA_UP.set(_BREAKER_UP.get(ep["state"], 0), url=ep["url"])
+        for event in ("requests", "errors", "hedges", "ejections"):
+            _OLLAMA_EVENTS.set(ep[event], url=ep["url"], event=event)
+
+    sql = sql_cache.info()
+    results = result_cache.info()
+    lookups = {
+        "sql_exact": (sql["exact_hits"], sql["exact_misses"], sql["exact_size"]),
+        "sql_similar": (sql["similar_hits"], sql["similar_misses"], sql["similar_size"]),
+        "result": (results["hits"], results["misses"], results["size"]),
+    }
+    for cache, (hits, misses, size) in lookups.items():
+        _CACHE_LOOKUPS.set(hits, cache=cache, result="hit")
+        _CACHE_LOOKUPS.set(misses, cache=cache, result="miss")
+        _CACHE_SIZE.set(size, cache=cache)
+        if hits + misses:
+            _CACHE_HIT_RATIO.set(round(hits / (hits + misses), 4), cache=cache)
+
+    for name, flight in (("nlp", _nlp_flight), ("query", _query_flight)):
+        _FLIGHT_CALLS.set(flight.stats["leaders"], flight=name, role="leader")
+        _FLIGHT_CALLS.set(flight.stats["followers"], flight=name, role="follower")
+
+
+REGISTRY.register_collector(_collect_metrics)
+
+
+def metrics_text() -> str:
+    """
+    Metriche del backend in formato testo Prometheus.
+    """
+    return REGISTRY.render()
+
+
+def _build_retry_prompt(original_question: str, previous_sql: str, db_error: str) -> list[dict] | None:
+    schema_text = get_schema_text()
     if not schema_text:
-        error_msg = "[ERROR] Impossibile recuperare lo schema dal database."
-        print(error_msg)
-        return f"SELECT NULL AS warning -- {error_msg}"
-    
-    prompt = build_prompt(schema_text, question)
-    return ask_ollama(prompt, model)
+        print(_SCHEMA_ERROR)
+        return None
+
+    # istruzioni e schema nel messaggio di sistema (prefisso stabile, riusato dalla KV cache di Ollama)
+    return [
+        {"role": "system", "content": (
+            "Sei un assistente SQL. Il tuo compito è correggere query SQL fallite.\n\n"
+            "Istruzioni:\n"
+            "- Analizza l'errore e correggi la query SQL.\n"
+            "- Assicurati che la query sia valida e coerente con lo schema.\n"
+            "- Non aggiungere spiegazioni o testo extra, restituisci solo la query SQL pronta per l'esecuzione.\n"
+            "- Mantieni lo scopo originale della domanda dell'utente.\n\n"
+            f"Schema del database:\n{schema_text}"
+        )},
+        {"role": "user", "content": (
+            f"1. Domanda originale dell'utente:\n{original_question}\n\n"
+            f"2. Query SQL precedente che ha fallito:\n{previous_sql}\n\n"
+            f"3. Errore restituito dal database o dal validatore:\n{db_error}\n\n"
+            "Restituisci solo la query SQL corretta."
+        )},
+    ]
 
 
 def call_nlp_module_retry(original_question: str, previous_sql: str, db_error: str, model: str | None = None) -> str:
     """
     Corregge una query SQL fallita generando un prompt di retry per Ollama.
     """
-    schema_text = schema_text_from_information_schema()
-    if not schema_text:
-        error_msg = "[ERROR] Impossibile recuperare lo schema dal database."
-        print(error_msg)
-        return f"SELECT NULL AS warning -- {error_msg}"
-
-    prompt_retry = (
-        f"Sei un assistente SQL. Il tuo compito è correggere query SQL fallite.\n\n"
-        f"1. Domanda originale dell'utente:\n{original_question}\n\n"
-        f"2. Query SQL precedente che ha fallito:\n{previous_sql}\n\n"
-        f"3. Errore restituito dal database:\n{db_error}\n\n"
-        f"4. Schema del database:\n{schema_text}\n\n"
-        "Istruzioni:\n"
-        "- Analizza l'errore e correggi la query SQL.\n"
-        "- Assicurati che la query sia valida e coerente con lo schema.\n"
-        "- Non aggiungere spiegazioni o testo extra, restituisci solo la query SQL pronta per l'esecuzione.\n"
-        "- Mantieni lo scopo originale della domanda dell'utente.\n\n"
-        "Restituisci solo la query SQL corretta."
-    )
-
+    prompt_retry = _build_retry_prompt(original_question, previous_sql, db_error)
+    if prompt_retry is None:
+        return f"SELECT NULL AS warning -- {_SCHEMA_ERROR}"
     return ask_ollama(prompt_retry, model)
 
 
+async def call_nlp_module_retry_async(original_question: str, previous_sql: str, db_error: str,
+                                      model: str | None = None, priority: int = PRIORITY_INTERACTIVE,
+                                      deadline: float | None = None) -> str:
+    """
+    Versione asincrona di call_nlp_module_retry (retry identici in corso condividono la generazione).
+    Nello scheduler LLM i retry passano dopo i primi tentativi della stessa priorità.
+    """
+    async def _retry() -> str:
+        prompt_retry = await run_in_db_executor(_build_retry_prompt, original_question, previous_sql, db_error)
+        if prompt_retry is None:
+            return f"SELECT NULL AS warning -- {_SCHEMA_ERROR}"
+        use_model = resolve_model(model)
+        return await llm_scheduler.run(use_model, lambda: ask_ollama_async(prompt_retry, use_model), claim=claim)
+
+    key = ("retry", normalize_question(original_question), previous_sql, db_error, resolve_model(model))
+    claim = Claim(priority + RETRY_PENALTY, deadline)
+    return await _nlp_flight.do(key, _retry, claim, lambda leader: leader.join(priority + RETRY_PENALTY, deadline))
+
+
+# Suggerimenti aggiunti al prompt di retry in base al tipo di errore
+_RETRY_HINTS = {
+    "unknown_table": "Usa solo le tabelle elencate nello schema.",
+    "unknown_column": "Usa solo le colonne elencate nello schema, con la tabella o l'alias corretto.",
+    "syntax_error": "Correggi la sintassi: una sola istruzione SELECT valida per MariaDB.",
+    "full_scan": "Aggiungi filtri selettivi o un LIMIT per evitare di leggere l'intera tabella.",
+    "rows_estimate": "Evita prodotti cartesiani: collega le tabelle con condizioni di JOIN sulle chiavi.",
+    "statement_timeout": "La query è troppo lenta: usa filtri selettivi, JOIN sulle chiavi e meno righe.",
+}
+
+
+def retry_error_text(error: Dict | None) -> str:
+    """
+    Errore strutturato + suggerimento per il prompt di retry.
+    """
+    text = error_text(error)
+    hint = _RETRY_HINTS.get((error or {}).get("code"))
+    return f"{text}\nSuggerimento: {hint}" if hint else text
+
+
+async def search_with_retries(question: str, model: str | None = None,
+                              max_attempts: int = SEARCH_RETRY_MAX_ATTEMPTS,
+                              budget: float = SEARCH_RETRY_BUDGET) -> Tuple[List[Dict], bool]:
+    """
+    Traduce ed esegue una domanda con al più `max_attempts` tentativi,
+    entro un budget di latenza totale di `budget` secondi.
+    Ogni SQL generata è validata (schema + EXPLAIN con il budget di
+    "search_with_retry") prima di essere eseguita: gli errori rilevati così
+    non costano un'esecuzione sul DB e sono passati in forma strutturata al
+    prompt del tentativo successivo.
+    Restituisce (tentativi, budget_esaurito), con tentativi = lista di dict
+    {sql, sql_validation, results, sql_error}. Se lo scheduler LLM scarta il
+    primo tentativo solleva Overloaded; un retry scartato chiude i tentativi.
+    """
+    deadline = time.monotonic() + budget
+    attempts: List[Dict] = []
+    sql, error = None, None
+
+    for n in range(max(1, max_attempts)):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return attempts, True
+        try:
+            if n == 0:
+                generation = call_nlp_module_async(question, model, deadline=deadline)
+            else:
+                generation = call_nlp_module_retry_async(question, sql, retry_error_text(error), model,
+                                                         deadline=deadline)
+            sql = await asyncio.wait_for(generation, timeout=remaining)
+        except asyncio.TimeoutError:
+            print(f"[DEBUG] search_with_retries: budget di {budget}s esaurito dopo {len(attempts)} tentativi")
+            return attempts, True
+        except Overloaded:
+            if not attempts:
+                raise
+            return attempts, True
+
+        valid, results, error = await run_sql_query_async(sql, budget=budget_for("search_with_retry"))
+        attempts.append({"sql": sql, "sql_validation": valid, "results": results, "sql_error": error})
+        if valid == "valid":
+            break
+        print(f"[DEBUG] Tentativo {n + 1} fallito: {error_text(error)}")
+        if n == 0:
+            await discard_cached_sql_async(question, model, sql)
+
+    return attempts, False
+
+
+_RACE_WINS = REGISTRY.counter("search_race_total", "Gare di generazione per candidato vincente ('none' se nessuno)",
+                              ["winner"])
+
+
+def _candidate_name(model: str, temperature: float | None) -> str:
+    return model if temperature is None else f"{model}@{temperature:g}"
+
+
+async def search_race(question: str, model: str | None = None, limit: int | None = None, offset: int = 0,
+                      budget: float = SEARCH_RACE_BUDGET) -> Tuple[Dict | None, List[Dict], int, bool]:
+    """
+    Generazione in gara: la domanda è inviata insieme a tutti i candidati
+    (modelli/temperature di race_candidates); ogni SQL è validata ed eseguita
+    appena arriva, vince la prima valida e le generazioni e query ancora in
+    corso sono annullate. Il tutto entro `budget` secondi.
+    Nello scheduler LLM il primo candidato ha priorità interattiva, gli altri
+    quella dei retry: sfruttano la capacità libera senza scavalcare le
+    richieste degli altri utenti (con la coda piena sono i primi scartati).
+    La SQL vincente è salvata in cache per il modello richiesto, quindi le
+    richieste successive con la stessa domanda non rifanno la gara.
+    Restituisce (vincitore, candidati, annullati, budget_esaurito): candidati
+    conclusi in ordine di arrivo, dict {model, temperature, sql, sql_validation,
+    results, sql_error, truncated, next_offset, seconds}; vincitore è None se
+    nessuna SQL è valida. Solleva Overloaded se tutti i candidati sono scartati.
+    """
+    started = time.monotonic()
+    deadline = started + budget
+    exec_budget = budget_for("search")
+
+    async def _execute(cand_model: str, temperature: float | None, sql: str) -> Dict:
+        valid, results, error, next_offset = await run_sql_query_page_async(sql, limit, offset, exec_budget)
+        return {"model": cand_model, "temperature": temperature, "sql": sql, "sql_validation": valid,
+                "results": results, "sql_error": error, "truncated": next_offset is not None,
+                "next_offset": next_offset, "seconds": round(time.monotonic() - started, 3)}
+
+    sql, prompt, use_model, fingerprint = await run_in_db_executor(_prepare_nlp, question, model)
+    if sql is not None:
+        # SQL in cache (o errore di schema): la gara serve solo se non è eseguibile
+        cached = await _execute(use_model, None, sql)
+        if cached["sql_validation"] == "valid" or fingerprint is None:
+            return (cached if cached["sql_validation"] == "valid" else None), [cached], 0, False
+        await discard_cached_sql_async(question, model, sql)
+        _, prompt, use_model, fingerprint = await run_in_db_executor(_prepare_nlp, question, model)
+        if prompt is None:
+            return None, [cached], 0, False
+
+    async def _candidate(index: int, cand_model: str, temperature: float | None) -> Dict:
+        options = {"temperature": temperature} if temperature is not None else None
+        priority = PRIORITY_INTERACTIVE if index == 0 else PRIORITY_INTERACTIVE + RETRY_PENALTY
+        sql = await llm_scheduler.run(cand_model, lambda: ask_ollama_async(prompt, cand_model, options),
+                                      priority, deadline)
+        return await _execute(cand_model, temperature, sql)
+
+    candidates = race_candidates(model)
+    tasks = {asyncio.create_task(_candidate(i, m, t)): (m, t) for i, (m, t) in enumerate(candidates)}
+    finished: List[Dict] = []
+    winner, overloaded, exhausted = None, None, False
+    pending = set(tasks)
+    try:
+        while pending and winner is None:
+            remaining = deadline - time.monotonic()
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, remaining),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                exhausted = True
+                break
+            # più candidati conclusi insieme: vince il primo nell'ordine configurato
+            for task in sorted(done, key=lambda t: candidates.index(tasks[t])):
+                cand_model, temperature = tasks[task]
+                if isinstance(task.exception(), Overloaded):
+                    overloaded = overloaded or task.exception()
+                    continue
+                if task.exception() is not None:
+                    print(f"[ERRORE] Candidato {_candidate_name(cand_model, temperature)}: {task.exception()}")
+                    error = {"code": "internal_error", "message": str(task.exception()), "token": None}
+                    finished.append({"model": cand_model, "temperature": temperature,
+                                     "sql": f"SELECT NULL AS warning -- [ERROR] {task.exception()}",
+                                     "sql_validation": "invalid", "results": None, "sql_error": error,
+                                     "truncated": False, "next_offset": None,
+                                     "seconds": round(time.monotonic() - started, 3)})
+                    continue
+                finished.append(task.result())
+                if winner is None and task.result()["sql_validation"] == "valid":
+                    winner = task.result()
+    finally:
+        # vincitore trovato, budget esaurito o client disconnesso: annulla generazioni e query in corso
+        for task in pending:
+            task.cancel()
+
+    if winner is not None:
+        _store_nlp(question, use_model, fingerprint, winner["sql"])
+    elif overloaded is not None and not finished and not exhausted:
+        raise overloaded
+    _RACE_WINS.inc(winner=_candidate_name(winner["model"], winner["temperature"]) if winner else "none")
+    print(f"[DEBUG] search_race: {len(finished)}/{len(candidates)} candidati conclusi, vincitore "
+          f"{_candidate_name(winner['model'], winner['temperature']) if winner else 'nessuno'}")
+    return winner, finished, len(pending), exhausted
+
+
+async def warm_up_models() -> dict:
+    """
+    Preriscalda i modelli Ollama all'avvio: li carica in memoria e valuta il
+    prefisso di sistema con lo schema completo (lo stesso delle richieste).
+    """
+    schema_text = await run_in_db_executor(get_schema_text)
+    return await warm_up_async(build_messages(schema_text or "", ""))
+
+
+async def search_batch(items: List[SearchInput], concurrency: int = SEARCH_BATCH_CONCURRENCY,
+                       ordered: bool = True) -> AsyncIterator[SearchBatchItem]:
+    """
+    Esegue molte domande: deduplica quelle identiche (domanda normalizzata + modello),
+    genera la SQL con al più `concurrency` chiamate Ollama in parallelo ed esegue
+    le query sul pool di connessioni.
+    Produce un SearchBatchItem per ogni domanda in input: nell'ordine di input
+    se `ordered`, altrimenti appena ciascun risultato è pronto.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def _solve(question: str, model: str | None) -> Tuple[str, str, List[Dict] | None, Dict | None]:
+        async with semaphore:
+            sql = await call_nlp_module_async(question, model, priority=PRIORITY_BATCH)
+        valid, results, error = await run_sql_query_async(sql, budget=budget_for("search_batch"))
+        if valid != "valid":
+            await discard_cached_sql_async(question, model, sql)
+            results = None
+        return sql, valid, results, error
 
+    # deduplica: domande identiche condividono lo stesso task
+    keys = []
+    for item in items:
+        key = (normalize_question(item.question), resolve_model(item.model))
+        if key not in tasks:
+            tasks[key] = asyncio.create_task(_solve(item.question, item.model))
+        keys.append(key)
+    print(f"[DEBUG] search_batch: {len(items)} domande, {len(tasks)} distinte")
 
+    def _item(index: int) -> SearchBatchItem:
+        task = tasks[keys[index]]
+        if task.exception() is not None:
+            sql, valid, results = f"SELECT NULL AS warning -- [ERROR] {task.exception()}", "invalid", None
+            code = "overloaded" if isinstance(task.exception(), Overloaded) else "internal_error"
+            error = {"code": code, "message": str(task.exception()), "token": None}
+        else:
+            sql, valid, results, error = task.result()
+        return SearchBatchItem(index=index, question=items[index].question,
+                               sql=sql, sql_validation=valid, results=results, sql_error=error)
 
+    try:
+        if ordered:
+            for index, key in enumerate(keys):
+                await asyncio.wait({tasks[key]})
+                yield _item(index)
+        else:
+            by_task: Dict[asyncio.Task, List[int]] = {}
+            for index, key in enumerate(keys):
+                by_task.setdefault(tasks[key], []).append(index)
+            pending = set(by_task)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for index in by_task[task]:
+                        yield _item(index)
+    finally:
+        # client disconnesso o errore: annulla le generazioni ancora in corso
+        for task in tasks.values():
+            task.cancel()
@@ -0,0 +1,227 @@
+"""
+Benchmark end-to-end del backend, senza docker-compose né modelli reali.
+
+L'app FastAPI di backend/src/main.py gira in-process (httpx + ASGITransport),
+Ollama è sostituito da text_to_sql/fake_ollama (latenza e velocità di
+generazione configurabili, risposte deterministiche) e MariaDB da
+benchmarks/standin_db (SQLite popolato con un dataset generato da data.tsv).
+
+Per /search, /search_with_retry, /search_race, /sql_search, /add e /add_batch (righe
+per richiesta: --add-batch-size) e per ogni livello di
+concorrenza misura p50/p95/p99 della latenza e le richieste al secondo, e
+stampa (o salva con --output) i risultati in JSON. Con --baseline confronta
+con un'esecuzione precedente ed esce con codice 1 se p95 o throughput
+peggiorano oltre --tolerance.
+
+Le domande e le query cambiano a ogni richiesta e le cache (SQL e risultati)
+sono disattivate, salvo --caches: si misura il percorso completo.
+
+Uso:
+    python benchmarks/bench_e2e.py --rows 20000 --concurrency 1,8,32 --requests 200
+    python benchmarks/bench_e2e.py --latency 0.5 --token-rate 30 --output bench.json
+    python benchmarks/bench_e2e.py --baseline bench.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import standin_db
+
+ENDPOINTS = ("search", "search_with_retry", "search_race", "sql_search", "add", "add_batch")
+
+QUESTIONS = [
+    "Quali film sono usciti dopo il 2015?",
+    "Elenca i registi con più di 60 anni",
+    "Quali piattaforme sono disponibili?",
+    "Film di fantascienza su Netflix",
+    "Quanti film ha diretto Christopher Nolan?",
+    "Numero di film per genere",
+]
+
+SQL_QUERIES = [
+    "SELECT titolo, anno FROM movies WHERE anno = {year} ORDER BY titolo",
+    "SELECT m.titolo, r.nome FROM movies m JOIN registi r ON r.id = m.regista_id WHERE m.anno > {year} LIMIT 50",
+    "SELECT genere, COUNT(*) AS n FROM movies WHERE anno >= {year} GROUP BY genere",
+    "SELECT m.titolo, p.nome FROM movies m JOIN piattaforme p ON p.id = m.piattaforma_1_id WHERE m.genere = 'Dramma' AND m.anno < {year}",
+]
+
+
+def _film_line(run: str, i: int) -> str:
+    return f"Bench {run} {i},Regista bench {i % 50},{30 + i % 50},{1980 + i % 45},Dramma,Netflix"
+
+
+def _request(endpoint: str, i: int, run: str, batch_size: int = 1) -> tuple[str, dict | list]:
+    # richieste sempre diverse: niente coalescing né cache tra richieste
+    if endpoint in ("search", "search_with_retry", "search_race"):
+        return f"/{endpoint}", {"question": f"{QUESTIONS[i % len(QUESTIONS)]} ({run}-{i})"}
+    if endpoint == "sql_search":
+        return "/sql_search", {"sql_query": SQL_QUERIES[i % len(SQL_QUERIES)].format(year=1950 + i % 75)}
+    if endpoint == "add_batch":
+        return "/add_batch", [_film_line(run, i * batch_size + j) for j in range(batch_size)]
+    return "/add", {"data_line": _film_line(run, i)}
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[k]
+
+
+async def _run_level(client, endpoint: str, concurrency: int, n_requests: int, run: str,
+                     batch_size: int = 1) -> dict:
+    latencies, errors, invalid = [], 0, 0
+    counter = iter(range(n_requests))
+
+    async def _worker():
+        nonlocal errors, invalid
+        for i in counter:
+            path, payload = _request(endpoint, i, run, batch_size)
+            started = time.perf_counter()
+            try:
+                resp = await client.post(path, json=payload)
+                elapsed = time.perf_counter() - started
+                if resp.status_code >= 400:
+                    errors += 1
+                    continue
+                data = resp.json()
+                if endpoint == "search_with_retry":
+                    data = (data.get("attempts") or [{}])[-1]
+                if endpoint == "add_batch":
+                    invalid += data["lines"] - data["inserted"] - data["updated"]
+                elif data.get("sql_validation", data.get("status", "ok")) not in ("valid", "ok"):
+                    invalid += 1
+                latencies.append(elapsed)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    result = {"endpoint": endpoint, "concurrency": concurrency, "requests": n_requests,
+              "errors": errors, "invalid": invalid, "rps": round(len(latencies) / wall, 2) if wall else None}
+    if endpoint == "add_batch":
+        result["batch_size"] = batch_size
+        result["rows_per_sec"] = round(len(latencies) * batch_size / wall, 1) if wall else None
+    if latencies:
+        result.update({f"p{p}_ms": round(_percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)})
+        result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 2)
+        result["max_ms"] = round(max(latencies) * 1000, 2)
+    return result
+
+
+def _compare(results: list[dict], baseline: dict, tolerance: float) -> list[dict]:
+    previous = {(r["endpoint"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        base = previous.get((r["endpoint"], r["concurrency"]))
+        if not base:
+            continue
+        if base.get("p95_ms") and r.get("p95_ms") and r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append({"endpoint": r["endpoint"], "concurrency": r["concurrency"],
+                                "metric": "p95_ms", "baseline": base["p95_ms"], "current": r["p95_ms"]})
+        if base.get("rps") and r.get("rps") is not None and r["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append({"endpoint": r["endpoint"], "concurrency": r["concurrency"],
+                                "metric": "rps", "baseline": base["rps"], "current": r["rps"]})
+    return regressions
+
+
+async def _bench(args, run: str) -> list[dict]:
+    import httpx
+    import main
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://backend", timeout=600) as client:
+        for endpoint in args.endpoints:
+            # riscaldamento: schema in cache, connessioni del pool aperte
+            batch_size = args.add_batch_size if endpoint == "add_batch" else 1
+            await _run_level(client, endpoint, 1, args.warmup, f"{run}w", batch_size)
+            for concurrency in args.concurrency:
+                results.append(await _run_level(client, endpoint, concurrency, args.requests, f"{run}c{concurrency}",
+                                                batch_size))
+                print(f"[DEBUG] {json.dumps(results[-1])}", file=sys.stderr)
+        await main.close_async_client()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="film nel database sostitutivo")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,8,32", help="livelli di concorrenza (separati da virgola)")
+    parser.add_argument("--requests", type=int, default=200, help="richieste per livello")
+    parser.add_argument("--warmup", type=int, default=5, help="richieste di riscaldamento per endpoint")
+    parser.add_argument("--add-batch-size", type=int, default=100, help="righe per richiesta a /add_batch")
+    parser.add_argument("--latency", type=float, default=0.2, help="secondi prima del primo token (finto Ollama)")
+    parser.add_argument("--token-rate", type=float, default=50, help="token/s generati dal finto Ollama")
+    parser.add_argument("--ollama-nodes", type=int, default=1, help="istanze del finto Ollama nel pool")
+    parser.add_argument("--db-pool-size", type=int, default=10)
+    parser.add_argument("--caches", action="store_true", help="lascia attive le cache SQL e dei risultati")
+    parser.add_argument("--output", help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--baseline", help="risultati precedenti (JSON) con cui confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento relativo tollerato")
+    parser.add_argument("--verbose", action="store_true", help="mostra i log del backend")
+    args = parser.parse_args()
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "movies.sqlite")
+        started = time.perf_counter()
+        standin_db.create_database(db_path, rows=args.rows, seed=args.seed)
+        standin_db.install(db_path)
+        print(f"[DEBUG] Database sostitutivo: {args.rows} film in {time.perf_counter() - started:.1f}s",
+              file=sys.stderr)
+
+        # la configurazione del backend è letta all'import: env prima di importare text_to_sql/db_utils
+        from text_to_sql.fake_ollama import start_fake_ollama
+        chunk_delay = 1 / args.token_rate if args.token_rate > 0 else 0.0
+        servers = [start_fake_ollama(latency=args.latency, chunk_delay=chunk_delay)
+                   for _ in range(args.ollama_nodes)]
+
+        os.environ.update({
+            "OLLAMA_HOSTS": ",".join(url for _, url in servers),
+            "DB_POOL_SIZE": str(args.db_pool_size),
+        })
+        if not args.caches:
+            os.environ.update({"SQL_CACHE_EXACT_SIZE": "0", "SQL_CACHE_SIMILAR_SIZE": "0", "RESULT_CACHE_SIZE": "0"})
+        sys.path.insert(0, str(ROOT / "backend" / "src"))
+
+        run = str(int(time.time()))
+        logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with logs:
+            results = asyncio.run(_bench(args, run))
+        for server, _ in servers:
+            server.shutdown()
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "verbose")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "results": results,
+    }
+    if args.baseline:
+        report["regressions"] = _compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark degli indici introdotti dalla migrazione 0001_movies_indexes.
+
+Crea tabelle bench_registi / bench_piattaforme / bench_movies con lo schema di
+mariadb_init/init.sql, le popola con un dataset sintetico (default 1M film),
+misura la latenza del lookup di upsert e di alcune query tipiche generate
+dall'LLM prima e dopo aver applicato gli indici della migrazione, e stampa
+i risultati in JSON. Le tabelle vengono eliminate alla fine (salvo --keep).
+
+Uso (con MariaDB raggiungibile, variabili DB_* come per il backend):
+    python benchmarks/bench_indexes.py --movies 1000000 --samples 200
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from db_utils.connection import pooled_connection
+from db_utils.migrate import MIGRATIONS_DIR, split_statements
+
+TABLES = ("movies", "registi", "piattaforme")
+GENERI = ("Azione", "Dramma", "Commedia", "Fantascienza", "Horror", "Thriller", "Animazione", "Documentario")
+
+
+def _bench_sql(sql: str) -> str:
+    # rinomina le tabelle reali nelle corrispondenti bench_*
+    return re.sub(r"\b(%s)\b" % "|".join(TABLES), r"bench_\1", sql)
+
+
+def _create_tables(cur) -> None:
+    for table in ("movies", "registi", "piattaforme"):
+        cur.execute(f"DROP TABLE IF EXISTS bench_{table}")
+    init_sql = (ROOT / "mariadb_init" / "init.sql").read_text(encoding="utf-8")
+    for statement in split_statements(init_sql):
+        cur.execute(_bench_sql(statement))
+
+
+def _populate(conn, cur, n_movies: int, n_registi: int, batch: int = 10000) -> None:
+    rnd = random.Random(42)
+    cur.executemany("INSERT INTO bench_piattaforme (nome) VALUES (?)", [(f"Piattaforma {i}",) for i in range(50)])
+    for start in range(0, n_registi, batch):
+        cur.executemany("INSERT INTO bench_registi (nome, eta) VALUES (?, ?)",
+                        [(f"Regista {i}", 30 + i % 50) for i in range(start, min(start + batch, n_registi))])
+        conn.commit()
+    for start in range(0, n_movies, batch):
+        rows = [(f"Film {i}", rnd.randint(1920, 2025), rnd.choice(GENERI), rnd.randint(1, 50),
+                 rnd.choice((None, rnd.randint(1, 50))), rnd.randint(1, n_registi))
+                for i in range(start, min(start + batch, n_movies))]
+        cur.executemany(
+            """INSERT INTO bench_movies (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            rows
+        )
+        conn.commit()
+        print(f"[DEBUG] Popolati {min(start + batch, n_movies)}/{n_movies} film", file=sys.stderr)
+
+
+def _timed(cur, sql: str, params: tuple) -> float:
+    t0 = time.perf_counter()
+    cur.execute(sql, params)
+    cur.fetchall()
+    return (time.perf_counter() - t0) * 1000
+
+
+def _summary(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(samples[int(len(samples) * 0.95) - 1], 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+    }
+
+
+def _measure(cur, n_movies: int, n_registi: int, samples: int) -> dict:
+    rnd = random.Random(7)
+    results = {}
+
+    # percorso di upsert: lookup regista + lookup film (come crud.insert_or_update_film)
+    upsert = []
+    for _ in range(samples):
+        i = rnd.randrange(n_registi)
+        t = _timed(cur, "SELECT id FROM bench_registi WHERE nome=? AND eta=?", (f"Regista {i}", 30 + i % 50))
+        t += _timed(cur, "SELECT id, piattaforma_1_id, piattaforma_2_id FROM bench_movies WHERE titolo=? AND regista_id=?",
+                    (f"Film {rnd.randrange(n_movies)}", i + 1))
+        upsert.append(t)
+    results["upsert_lookup"] = _summary(upsert)
+
+    queries = {
+        "filter_anno": ("SELECT titolo FROM bench_movies WHERE anno = ?", lambda: (rnd.randint(1920, 2025),)),
+        "filter_genere_anno": ("SELECT titolo, anno FROM bench_movies WHERE genere = ? AND anno > ? LIMIT 100",
+                               lambda: (rnd.choice(GENERI), 2015)),
+        "join_regista": ("""SELECT m.titolo FROM bench_movies m JOIN bench_registi r ON m.regista_id = r.id
+                            WHERE r.nome = ?""", lambda: (f"Regista {rnd.randrange(n_registi)}",)),
+    }
+    for name, (sql, params) in queries.items():
+        results[name] = _summary([_timed(cur, sql, params()) for _ in range(max(10, samples // 10))])
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--movies", type=int, default=1_000_000)
+    parser.add_argument("--registi", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="non eliminare le tabelle bench_*")
+    args = parser.parse_args()
+
+    report = {"movies": args.movies, "registi": args.registi, "samples": args.samples}
+    with pooled_connection() as (conn, cur):
+        try:
+            _create_tables(cur)
+            conn.begin()
+            _populate(conn, cur, args.movies, args.registi)
+            report["before"] = _measure(cur, args.movies, args.registi, args.samples)
+
+            t0 = time.perf_counter()
+            for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+                for statement in split_statements(path.read_text(encoding="utf-8")):
+                    cur.execute(_bench_sql(statement))
+            report["migration_seconds"] = round(time.perf_counter() - t0, 3)
+            report["after"] = _measure(cur, args.movies, args.registi, args.samples)
+        finally:
+            if not args.keep:
+                for table in ("movies", "registi", "piattaforme"):
+                    cur.execute(f"DROP TABLE IF EXISTS bench_{table}")
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
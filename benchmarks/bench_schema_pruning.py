@@ -0,0 +1,139 @@
+"""
+Benchmark dello schema linking (text_to_sql/schema_linking.py).
+
+Per ogni domanda di prova costruisce il prompt senza e con lo schema ridotto
+(che va nel messaggio utente, dopo il prefisso di sistema fisso con lo schema
+completo) e confronta i token del prompt e del solo messaggio utente, cioè
+quelli da valutare quando il prefisso è già nella KV cache. Con --ollama
+invia anche i prompt a Ollama (/api/chat) e misura la latenza end-to-end e i
+token valutati (prompt_eval_count) riportati dal server.
+
+Lo schema è letto da mariadb_init/init.sql (valori campione da data.tsv)
+oppure, con --source db, dalla cache dello schema del database.
+--extra-tables aggiunge tabelle sintetiche per simulare uno schema più grande.
+
+Uso:
+    python benchmarks/bench_schema_pruning.py --extra-tables 20
+    python benchmarks/bench_schema_pruning.py --ollama --repeat 3 --model gemma3:1b-it-qat
+"""
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from text_to_sql.text_to_sql import build_messages, build_prompt, resolve_model, _chat_payload, _ollama_chat_url
+from text_to_sql.schema_linking import estimate_tokens, prune_schema, render_schema
+
+QUESTIONS = [
+    "Quali film sono usciti dopo il 2015?",
+    "Elenca i registi con più di 60 anni",
+    "Quali piattaforme sono disponibili?",
+    "Film di fantascienza su Netflix",
+    "Quanti film ha diretto Christopher Nolan?",
+    "Titoli dei drammi usciti prima del 2000",
+    "Numero di film per genere",
+    "Età media dei registi",
+]
+
+
+def _schema_from_init() -> dict:
+    init_sql = (ROOT / "mariadb_init" / "init.sql").read_text(encoding="utf-8")
+    tables, foreign_keys = {}, []
+    for name, body in re.findall(r"CREATE TABLE (\w+)\s*\((.*?)\n\);", init_sql, flags=re.S):
+        tables[name] = []
+        for line in body.splitlines():
+            line = line.split("--")[0].strip()
+            fk = re.match(r"FOREIGN KEY \((\w+)\) REFERENCES (\w+)\((\w+)\)", line)
+            if fk:
+                foreign_keys.append((name, fk.group(1), fk.group(2), fk.group(3)))
+            elif re.match(r"\w+\s", line):
+                tables[name].append(line.split()[0])
+
+    samples = {}
+    with open(ROOT / "mariadb_init" / "data.tsv", newline="", encoding="utf-8") as file:
+        rows = list(csv.DictReader(file, delimiter="\t"))
+    samples[("movies", "genere")] = sorted({r["Genere"] for r in rows if r.get("Genere")})
+    samples[("piattaforme", "nome")] = sorted({r[c] for r in rows for c in ("Piattaforma_1", "Piattaforma_2")
+                                               if r.get(c)})
+    return {"tables": tables, "foreign_keys": foreign_keys, "samples": samples}
+
+
+def _schema_from_db() -> dict:
+    from db_utils.schema_utils import get_schema_links
+    return get_schema_links()
+
+
+def _add_extra_tables(schema: dict, n: int) -> None:
+    # tabelle sintetiche collegate a movies, come farebbe un catalogo più ricco
+    for i in range(n):
+        name = f"extra_{i}"
+        schema["tables"][name] = ["id", "movie_id"] + [f"attributo_{i}_{k}" for k in range(8)]
+        schema["foreign_keys"].append((name, "movie_id", "movies", "id"))
+
+
+def _ask(messages: list, model: str) -> dict:
+    import requests
+    t0 = time.perf_counter()
+    resp = requests.post(_ollama_chat_url(), json=_chat_payload(messages, model), timeout=600)
+    resp.raise_for_status()
+    data = resp.json()
+    return {
+        "latency_ms": (time.perf_counter() - t0) * 1000,
+        "prompt_eval_count": data.get("prompt_eval_count"),
+        "prompt_eval_ms": (data.get("prompt_eval_duration") or 0) / 1e6,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=("init", "db"), default="init")
+    parser.add_argument("--extra-tables", type=int, default=0)
+    parser.add_argument("--max-tokens", type=int, default=0, help="budget di token per lo schema ridotto")
+    parser.add_argument("--ollama", action="store_true", help="misura anche la latenza su Ollama (OLLAMA_HOST)")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    schema = _schema_from_db() if args.source == "db" else _schema_from_init()
+    _add_extra_tables(schema, args.extra_tables)
+    full_schema = render_schema(schema["tables"])
+    model = resolve_model(args.model)
+
+    report = {"tables": len(schema["tables"]), "questions": []}
+    totals = {"full": [], "pruned": []}
+    for question in QUESTIONS:
+        contexts = {
+            "full": None,
+            "pruned": prune_schema(question, max_tokens=args.max_tokens, **schema),
+        }
+        entry = {"question": question}
+        for mode, context in contexts.items():
+            messages = build_messages(full_schema, question, context)
+            result = {"prompt_tokens_est": estimate_tokens(build_prompt(full_schema, question, context)),
+                      "user_tokens_est": estimate_tokens(messages[-1]["content"])}
+            if args.ollama:
+                runs = [_ask(messages, model) for _ in range(args.repeat)]
+                result["latency_ms_p50"] = round(statistics.median(r["latency_ms"] for r in runs), 1)
+                result["prompt_eval_count"] = runs[-1]["prompt_eval_count"]
+                result["prompt_eval_ms_p50"] = round(statistics.median(r["prompt_eval_ms"] for r in runs), 1)
+            totals[mode].append(result)
+            entry[mode] = result
+        report["questions"].append(entry)
+
+    report["summary"] = {
+        mode: {key: round(statistics.fmean(r[key] for r in results), 1)
+               for key in results[0] if results[0][key] is not None}
+        for mode, results in totals.items()
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Sostituto di MariaDB per i benchmark offline, basato su SQLite.
+
+Espone il sottoinsieme dell'API del connettore `mariadb` usato da db_utils
+(connect, cursori dictionary/tuple, begin/commit/rollback, ping, eccezioni)
+e traduce le poche istruzioni specifiche di MariaDB che il backend esegue:
+
+- SET STATEMENT ... FOR <sql>  -> <sql> (le righe le limita già QueryStream;
+                                  max_statement_time con un progress handler)
+- KILL QUERY <id>              -> interrupt() della connessione <id>
+- SELECT ... FOR UPDATE        -> SELECT ... (SQLite serializza le scritture)
+- INSERT IGNORE                -> INSERT OR IGNORE
+- information_schema (colonne, tabelle, chiavi esterne) -> PRAGMA di SQLite
+- EXPLAIN <sql>                -> EXPLAIN QUERY PLAN, nel formato di MariaDB
+                                  (type ALL / index / ref, rows stimate)
+
+create_database crea le tabelle da mariadb_init/init.sql e dalle migrazioni
+di db_utils/migrations (tradotte in DDL SQLite) e le popola con i film di
+generate_rows, un dataset di dimensione arbitraria derivato da mariadb_init/data.tsv.
+
+Uso (dagli script in benchmarks/):
+    import standin_db
+    standin_db.create_database(path, rows=100000)
+    standin_db.install(path)        # prima di importare db_utils
+"""
+import re
+import csv
+import sys
+import zlib
+import time
+import random
+import sqlite3
+import itertools
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# eccezioni con i nomi del connettore mariadb
+Error = sqlite3.Error
+InterfaceError = sqlite3.InterfaceError
+OperationalError = sqlite3.OperationalError
+DatabaseError = sqlite3.DatabaseError
+IntegrityError = sqlite3.IntegrityError
+ProgrammingError = sqlite3.ProgrammingError
+
+_path: Optional[str] = None
+_connections: Dict[int, "Connection"] = {}
+_connection_ids = itertools.count(1)
+
+_SET_STATEMENT = re.compile(r"^\s*SET\s+STATEMENT\s+(.*?)\s+FOR\s+", re.I | re.S)
+_MAX_STATEMENT_TIME = re.compile(r"max_statement_time\s*=\s*([\d.]+)", re.I)
+_KILL = re.compile(r"^\s*KILL\s+QUERY\s+(\d+)\s*$", re.I)
+_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE\s*$", re.I)
+_INSERT_IGNORE = re.compile(r"^\s*INSERT\s+IGNORE\b", re.I)
+_EXPLAIN = re.compile(r"^\s*EXPLAIN\s+(?!QUERY\s+PLAN)", re.I)
+_INFO_SCHEMA = re.compile(r"information_schema\.(COLUMNS|TABLES|KEY_COLUMN_USAGE)", re.I)
+_LOCKS = re.compile(r"^\s*SELECT\s+(GET_LOCK|RELEASE_LOCK)\s*\(", re.I)
+
+
+# ---------------- DDL ----------------
+
+def _translate_ddl(sql: str) -> List[str]:
+    # init.sql / migrazioni MariaDB -> istruzioni SQLite
+    sql = re.sub(r"--[^\n]*", "", sql)
+    statements = []
+    for statement in (s.strip() for s in sql.split(";")):
+        if not statement:
+            continue
+        statement = re.sub(r"\bINT AUTO_INCREMENT PRIMARY KEY\b", "INTEGER PRIMARY KEY AUTOINCREMENT", statement, flags=re.I)
+        m = re.match(r"ALTER TABLE (\w+) ADD (UNIQUE )?INDEX (IF NOT EXISTS )?(\w+) \((.*)\)$", statement, flags=re.I | re.S)
+        if m:
+            table, unique, _, name, columns = m.groups()
+            statement = f"CREATE {unique or ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+        statements.append(statement)
+    return statements
+
+
+def _base_rows() -> List[Dict[str, str]]:
+    with open(ROOT / "mariadb_init" / "data.tsv", newline="", encoding="utf-8") as file:
+        return list(csv.DictReader(file, delimiter="\t"))
+
+
+def generate_rows(n: int, seed: int = 42) -> Iterator[Tuple]:
+    """
+    Dataset sintetico di `n` film derivato da data.tsv (deterministico dato `seed`):
+    registi, generi e piattaforme reali più varianti numerate, così che
+    la cardinalità delle colonne cresca con `n` come in un catalogo vero.
+    Produce tuple (titolo, regista, eta, anno, genere, piattaforma_1, piattaforma_2).
+    """
+    rng = random.Random(seed)
+    base = _base_rows()
+    registi = sorted({(r["Regista"], int(r["Età_Autore"])) for r in base})
+    generi = sorted({r["Genere"] for r in base})
+    piattaforme = sorted({r[c] for r in base for c in ("Piattaforma_1", "Piattaforma_2") if r[c]})
+    n_registi = max(len(registi), n // 20)
+    n_piattaforme = max(len(piattaforme), min(50, n // 1000))
+    for i in range(n):
+        r = base[i % len(base)]
+        k = rng.randrange(n_registi)
+        regista, eta = registi[k] if k < len(registi) else (f"Regista {k}", rng.randint(30, 90))
+        p = [rng.randrange(n_piattaforme) for _ in range(2)]
+        p1, p2 = (piattaforme[j] if j < len(piattaforme) else f"Piattaforma {j}" for j in p)
+        titolo = r["Titolo"] if i < len(base) else f"{r['Titolo']} {i // len(base)}"
+        yield (titolo, regista, eta, rng.randint(1950, 2025), rng.choice(generi), p1,
+               p2 if p2 != p1 and rng.random() < 0.5 else None)
+
+
+def create_database(path: str, rows: int = 10000, seed: int = 42, indexes: bool = True) -> None:
+    """
+    Crea (sovrascrivendo) il database SQLite in `path` con lo schema di init.sql,
+    gli indici delle migrazioni (se `indexes`) e `rows` film generati da generate_rows.
+    """
+    Path(path).unlink(missing_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in _translate_ddl((ROOT / "mariadb_init" / "init.sql").read_text(encoding="utf-8")):
+        conn.execute(statement)
+    if indexes:
+        for migration in sorted((ROOT / "db_utils" / "migrations").glob("*.sql")):
+            for statement in _translate_ddl(migration.read_text(encoding="utf-8")):
+                conn.execute(statement)
+
+    registi: Dict[Tuple[str, int], int] = {}
+    piattaforme: Dict[str, int] = {}
+
+    def _id(cache: Dict, key, sql: str, params: Sequence) -> int:
+        if key not in cache:
+            cache[key] = conn.execute(sql, params).lastrowid
+        return cache[key]
+
+    seen = set()
+    for titolo, regista, eta, anno, genere, p1, p2 in generate_rows(rows, seed):
+        regista_id = _id(registi, (regista, eta), "INSERT INTO registi (nome, eta) VALUES (?, ?)", (regista, eta))
+        p1_id = _id(piattaforme, p1, "INSERT INTO piattaforme (nome) VALUES (?)", (p1,))
+        p2_id = _id(piattaforme, p2, "INSERT INTO piattaforme (nome) VALUES (?)", (p2,)) if p2 else None
+        if (titolo, regista_id) in seen:
+            continue
+        seen.add((titolo, regista_id))
+        conn.execute("INSERT INTO movies (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (titolo, anno, genere, p1_id, p2_id, regista_id))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def install(path: str) -> None:
+    """
+    Registra questo modulo come `mariadb`: le connect() successive aprono `path`.
+    Va chiamata prima di importare db_utils.
+    """
+    global _path
+    _path = path
+    sys.modules["mariadb"] = sys.modules[__name__]
+
+
+# ---------------- CONNETTORE ----------------
+
+def connect(**kwargs) -> "Connection":
+    if _path is None:
+        raise InterfaceError("standin_db.install() non chiamata")
+    return Connection(_path)
+
+
+class Connection:
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        self.autocommit = True
+        self.connection_id = next(_connection_ids)
+        self.deadline: Optional[float] = None
+        _connections[self.connection_id] = self
+
+    def _set_deadline(self, seconds: Optional[float]) -> None:
+        # max_statement_time: SQLite interrompe l'istruzione quando il progress handler restituisce True
+        self.deadline = time.monotonic() + seconds if seconds else None
+        handler = (lambda: time.monotonic() > self.deadline) if seconds else None
+        self._conn.set_progress_handler(handler, 1000)
+
+    def _error(self, e: sqlite3.OperationalError) -> Exception:
+        if "interrupted" in str(e) and self.deadline is not None and time.monotonic() > self.deadline:
+            return OperationalError("Query execution was interrupted (max_statement_time exceeded)")
+        if "interrupted" in str(e):
+            return OperationalError("Query execution was interrupted")
+        return e
+
+    def cursor(self, dictionary: bool = False, buffered: bool = True) -> "Cursor":
+        return Cursor(self, dictionary)
+
+    def begin(self) -> None:
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self) -> None:
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+
+    def rollback(self) -> None:
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+
+    def ping(self) -> None:
+        self._conn.execute("SELECT 1")
+
+    def reconnect(self) -> None:
+        pass
+
+    def close(self) -> None:
+        _connections.pop(self.connection_id, None)
+        self._conn.close()
+
+
+class Cursor:
+    def __init__(self, conn: Connection, dictionary: bool):
+        self._conn = conn
+        self._dictionary = dictionary
+        self._cur: Optional[sqlite3.Cursor] = None
+        self._rows: Optional[List[tuple]] = None
+        self.description = None
+        self.rowcount = -1
+        self.lastrowid = None
+
+    # --- esecuzione ---
+
+    def execute(self, sql: str, params: Sequence = ()) -> None:
+        self._rows = None
+        settings = _SET_STATEMENT.match(sql)
+        limit = _MAX_STATEMENT_TIME.search(settings.group(1)) if settings else None
+        self._conn._set_deadline(float(limit.group(1)) if limit else None)
+        sql = _SET_STATEMENT.sub("", sql)
+        sql = _FOR_UPDATE.sub("", sql.rstrip().rstrip(";"))
+        sql = _INSERT_IGNORE.sub("INSERT OR IGNORE", sql)
+        m = _KILL.match(sql)
+        if m:
+            target = _connections.get(int(m.group(1)))
+            if target is not None:
+                target._conn.interrupt()
+            return self._result([], [])
+        if _LOCKS.match(sql):
+            return self._result(["locked"], [(1,)])
+        m = _INFO_SCHEMA.search(sql)
+        if m:
+            return self._information_schema(m.group(1).upper())
+        if _EXPLAIN.match(sql):
+            return self._explain(_EXPLAIN.sub("", sql), params)
+
+        try:
+            self._cur = self._conn._conn.execute(sql, tuple(params))
+        except sqlite3.OperationalError as e:
+            raise self._conn._error(e) from e
+        self.description = self._cur.description
+        self.rowcount = self._cur.rowcount
+        self.lastrowid = self._cur.lastrowid
+
+    def executemany(self, sql: str, seq: Sequence[Sequence]) -> None:
+        self._rows = None
+        sql = _INSERT_IGNORE.sub("INSERT OR IGNORE", sql)
+        self._cur = self._conn._conn.executemany(sql, [tuple(p) for p in seq])
+        self.description = None
+        self.rowcount = self._cur.rowcount
+
+    def _result(self, columns: List[str], rows: List[tuple]) -> None:
+        self._cur = None
+        self._rows = rows
+        self.description = [(c, None, None, None, None, None, None) for c in columns]
+        self.rowcount = len(rows)
+
+    def _tables(self) -> List[str]:
+        rows = self._conn._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' "
+            "AND name <> 'schema_migrations' ORDER BY name").fetchall()
+        return [r[0] for r in rows]
+
+    def _information_schema(self, view: str) -> None:
+        db = self._conn._conn
+        if view == "COLUMNS":
+            rows = []
+            for table in self._tables():
+                for _, name, col_type, *_ in db.execute(f"PRAGMA table_info({table})"):
+                    data_type = re.sub(r"\(.*", "", col_type).lower() or "text"
+                    rows.append((table, name, "int" if data_type == "integer" else data_type))
+            return self._result(["table_name", "column_name", "data_type"], rows)
+        if view == "TABLES":
+            tables = self._tables()
+            return self._result(["n_tables", "checksum"],
+                                [(len(tables), sum(zlib.crc32(t.encode()) for t in tables))])
+        rows = []
+        for table in self._tables():
+            for fk in db.execute(f"PRAGMA foreign_key_list({table})"):
+                rows.append((table, fk[3], fk[2], fk[4]))
+        return self._result(["table_name", "column_name", "ref_table", "ref_column"], sorted(rows))
+
+    def _explain(self, sql: str, params: Sequence) -> None:
+        # righe nel formato di EXPLAIN di MariaDB: una per tabella letta
+        db = self._conn._conn
+        counts = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in self._tables()}
+        # SQLite riporta gli alias (FROM movies m -> "SCAN m"): risale alla tabella
+        aliases = {alias: table for table, alias in re.findall(r"\b(\w+)\s+(?:AS\s+)?(\w+)", sql, re.I)
+                   if table in counts}
+        rows = []
+        for _, _, _, detail in db.execute(f"EXPLAIN QUERY PLAN {sql}", tuple(params)):
+            m = re.match(r"(SCAN|SEARCH) (\w+)", detail)
+            table = aliases.get(m.group(2), m.group(2)) if m else None
+            if table not in counts:
+                continue
+            if m.group(1) == "SEARCH":
+                rows.append((1, "SIMPLE", table, "ref", 1, detail))
+            else:
+                # SCAN: tabella intera (ALL) o indice intero (index), in entrambi i casi tutte le righe
+                rows.append((1, "SIMPLE", table, "index" if "INDEX" in detail else "ALL", counts[table], detail))
+        return self._result(["id", "select_type", "table", "type", "rows", "Extra"], rows)
+
+    # --- lettura ---
+
+    def _convert(self, rows: List[tuple]) -> List:
+        if not self._dictionary:
+            return [tuple(r) for r in rows]
+        columns = [d[0] for d in self.description or ()]
+        return [dict(zip(columns, r)) for r in rows]
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size: int = 1) -> List:
+        if self._rows is not None:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+            return self._convert(rows)
+        try:
+            return self._convert(self._cur.fetchmany(size)) if self._cur is not None else []
+        except sqlite3.OperationalError as e:
+            raise self._conn._error(e) from e
+
+    def fetchall(self) -> List:
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return self._convert(rows)
+        try:
+            return self._convert(self._cur.fetchall()) if self._cur is not None else []
+        except sqlite3.OperationalError as e:
+            raise self._conn._error(e) from e
+
+    def close(self) -> None:
+        if self._cur is not None:
+            self._cur.close()
+        self._cur, self._rows = None, None
@@ -0,0 +1,345 @@
+import io
+import os
+import csv
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from .connection import pooled_connection
+from .crud import parse_film_fields, _cleanup_orphan_piattaforme
+from .result_cache import invalidate_tables
+
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "5000"))
+
+# Colonne del file TSV nell'ordine atteso da parse_film_fields
+TSV_COLUMNS = ("Titolo", "Regista", "Età_Autore", "Anno", "Genere", "Piattaforma_1", "Piattaforma_2")
+
+
+def iter_tsv_films(path: str) -> Iterator[List[str]]:
+    """
+    Legge il file TSV una sola volta e produce i campi di ogni film.
+    """
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.DictReader(file, delimiter="\t")
+        for riga in reader:
+            yield [riga.get(col) or "" for col in TSV_COLUMNS]
+
+
+def parse_tsv_lines(text: str) -> List[Tuple[int, List[str]]]:
+    """
+    Righe di un testo TSV (es. corpo di /add_batch) con il loro numero di riga.
+    L'intestazione (come in data.tsv) è facoltativa: se presente decide l'ordine
+    delle colonne, altrimenti vale quello di TSV_COLUMNS. Le righe vuote sono ignorate.
+    """
+    lines = []
+    columns = None
+    for line_no, campi in enumerate(csv.reader(io.StringIO(text), delimiter="\t"), start=1):
+        if not any(c.strip() for c in campi):
+            continue
+        if columns is None and not lines and campi[0].strip() == TSV_COLUMNS[0]:
+            columns = [c.strip() for c in campi]
+            continue
+        if columns is not None:
+            riga = dict(zip(columns, campi))
+            campi = [riga.get(col) or "" for col in TSV_COLUMNS]
+        lines.append((line_no, campi))
+    return lines
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _placeholders(n: int) -> str:
+    return ", ".join("?" * n)
+
+
+class FilmUpserter:
+    """
+    Applica upsert di film a gruppi su un cursore già aperto.
+
+    Registi, piattaforme e film noti sono tenuti in memoria:
+    - con `prefetch=True` le tre tabelle sono lette una sola volta all'inizio
+      (caricamenti massivi);
+    - altrimenti ogni batch legge solo le chiavi che non conosce ancora.
+    Le nuove righe sono inserite con executemany e i loro id recuperati con
+    una sola lettura per intervallo di chiave primaria (id > max precedente).
+    """
+
+    def __init__(self, cur, prefetch: bool = False):
+        self.cur = cur
+        self.prefetched = prefetch
+        self.registi: Dict[Tuple[str, Optional[int]], int] = {}
+        self.piattaforme: Dict[str, int] = {}
+        self.movies: Dict[Tuple[str, int], Tuple[int, Optional[int], Optional[int]]] = {}
+        self.orphan_candidates: set = set()
+        if prefetch:
+            self._prefetch()
+
+    def _prefetch(self) -> None:
+        cur = self.cur
+        cur.execute("SELECT id, nome, eta FROM registi")
+        self.registi = {(r["nome"], r["eta"]): r["id"] for r in cur.fetchall()}
+        cur.execute("SELECT id, nome FROM piattaforme")
+        self.piattaforme = {r["nome"]: r["id"] for r in cur.fetchall()}
+        cur.execute("SELECT id, titolo, regista_id, piattaforma_1_id, piattaforma_2_id FROM movies")
+        self.movies = {(r["titolo"], r["regista_id"]): (r["id"], r["piattaforma_1_id"], r["piattaforma_2_id"])
+                       for r in cur.fetchall()}
+        print(f"[DEBUG] Prefetch: {len(self.registi)} registi, {len(self.piattaforme)} piattaforme, "
+              f"{len(self.movies)} film")
+
+    def _max_id(self, table: str) -> int:
+        self.cur.execute(f"SELECT COALESCE(MAX(id), 0) AS max_id FROM {table}")
+        return self.cur.fetchone()["max_id"]
+
+    def _resolve_registi(self, keys: set) -> None:
+        missing = [k for k in keys if k not in self.registi]
+        if missing and not self.prefetched:
+            nomi = list({nome for nome, _ in missing})
+            self.cur.execute(f"SELECT id, nome, eta FROM registi WHERE nome IN ({_placeholders(len(nomi))})", nomi)
+            for r in self.cur.fetchall():
+                self.registi.setdefault((r["nome"], r["eta"]), r["id"])
+            missing = [k for k in missing if k not in self.registi]
+        if not missing:
+            return
+        max_id = self._max_id("registi")
+        self.cur.executemany("INSERT INTO registi (nome, eta) VALUES (?, ?)", missing)
+        self.cur.execute("SELECT id, nome, eta FROM registi WHERE id > ?", (max_id,))
+        for r in self.cur.fetchall():
+            self.registi.setdefault((r["nome"], r["eta"]), r["id"])
+
+    def _resolve_piattaforme(self, nomi: set) -> None:
+        missing = [n for n in nomi if n not in self.piattaforme]
+        if missing and not self.prefetched:
+            self.cur.execute(f"SELECT id, nome FROM piattaforme WHERE nome IN ({_placeholders(len(missing))})",
+                             missing)
+            for r in self.cur.fetchall():
+                self.piattaforme[r["nome"]] = r["id"]
+            missing = [n for n in missing if n not in self.piattaforme]
+        if not missing:
+            return
+        max_id = self._max_id("piattaforme")
+        self.cur.executemany("INSERT IGNORE INTO piattaforme (nome) VALUES (?)", [(n,) for n in missing])
+        self.cur.execute("SELECT id, nome FROM piattaforme WHERE id > ?", (max_id,))
+        for r in self.cur.fetchall():
+            self.piattaforme[r["nome"]] = r["id"]
+        # INSERT IGNORE salta i nomi inseriti nel frattempo da altri (o con id <= max_id): si rileggono per nome
+        missing = [n for n in missing if n not in self.piattaforme]
+        if not missing:
+            return
+        self.cur.execute(f"SELECT id, nome FROM piattaforme WHERE nome IN ({_placeholders(len(missing))})", missing)
+        for r in self.cur.fetchall():
+            self.piattaforme[r["nome"]] = r["id"]
+        missing = [n for n in missing if n not in self.piattaforme]
+        if missing:
+            raise RuntimeError(f"Id non recuperati per le piattaforme: {', '.join(sorted(missing))}")
+
+    def _resolve_movies(self, keys: set) -> None:
+        if self.prefetched:
+            return
+        missing = [k for k in keys if k not in self.movies]
+        if not missing:
+            return
+        titoli = list({titolo for titolo, _ in missing})
+        self.cur.execute(
+            f"""SELECT id, titolo, regista_id, piattaforma_1_id, piattaforma_2_id
+                FROM movies WHERE titolo IN ({_placeholders(len(titoli))})""",
+            titoli
+        )
+        for r in self.cur.fetchall():
+            self.movies.setdefault((r["titolo"], r["regista_id"]),
+                                   (r["id"], r["piattaforma_1_id"], r["piattaforma_2_id"]))
+
+    def upsert(self, films: Sequence[tuple]) -> List[str]:
+        """
+        Inserisce o aggiorna i film (tuple prodotte da parse_film_fields).
+        Non esegue commit. Restituisce per ogni film "inserted" o "updated";
+        se lo stesso film compare più volte vince l'ultima occorrenza.
+        """
+        self._resolve_registi({(f[1], f[2]) for f in films})
+        self._resolve_piattaforme({p for f in films for p in (f[5], f[6]) if p})
+
+        rows: Dict[Tuple[str, int], tuple] = {}
+        keys = []
+        for titolo, regista, eta, anno, genere, p1, p2 in films:
+            regista_id = self.registi[(regista, eta)]
+            key = (titolo, regista_id)
+            rows[key] = (titolo, anno, genere,
+                         self.piattaforme.get(p1) if p1 else None,
+                         self.piattaforme.get(p2) if p2 else None,
+                         regista_id)
+            keys.append(key)
+        self._resolve_movies(set(rows))
+
+        inserts, updates = [], []
+        status_by_key = {}
+        for key, (titolo, anno, genere, p1_id, p2_id, regista_id) in rows.items():
+            existing = self.movies.get(key)
+            if existing is None:
+                inserts.append((titolo, anno, genere, p1_id, p2_id, regista_id))
+                status_by_key[key] = "inserted"
+            else:
+                film_id, old_p1, old_p2 = existing
+                updates.append((anno, genere, p1_id, p2_id, regista_id, film_id))
+                if (old_p1, old_p2) != (p1_id, p2_id):
+                    self.orphan_candidates |= {old_p1, old_p2} - {p1_id, p2_id}
+                self.movies[key] = (film_id, p1_id, p2_id)
+                status_by_key[key] = "updated"
+
+        if inserts:
+            max_id = self._max_id("movies")
+            self.cur.executemany(
+                """INSERT INTO movies (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                inserts
+            )
+            self.cur.execute(
+                "SELECT id, titolo, regista_id, piattaforma_1_id, piattaforma_2_id FROM movies WHERE id > ?",
+                (max_id,)
+            )
+            for r in self.cur.fetchall():
+                self.movies[(r["titolo"], r["regista_id"])] = (r["id"], r["piattaforma_1_id"], r["piattaforma_2_id"])
+        if updates:
+            self.cur.executemany(
+                """UPDATE movies SET anno=?, genere=?, piattaforma_1_id=?, piattaforma_2_id=?, regista_id=?
+                   WHERE id=?""",
+                updates
+            )
+
+        return [status_by_key[key] for key in keys]
+
+    def cleanup(self) -> None:
+        """
+        Rimuove le piattaforme rimaste orfane tra quelle sostituite dagli upsert
+        finora applicati (cleanup differito: un solo controllo per più film).
+        """
+        if self.orphan_candidates:
+            deleted = set(_cleanup_orphan_piattaforme(self.cur, self.orphan_candidates))
+            self.piattaforme = {nome: pid for nome, pid in self.piattaforme.items() if pid not in deleted}
+            self.orphan_candidates = set()
+
+
+def bulk_upsert_films(rows: Iterable[Sequence[str]], batch_size: int = BULK_BATCH_SIZE,
+                      cleanup: str = "deferred") -> Dict:
+    """
+    Carica molti film: valida ogni riga, risolve registi/piattaforme in memoria
+    (prefetch unico) e applica gli upsert in transazioni da `batch_size` righe.
+    `cleanup` decide quando rimuovere le piattaforme orfane: "deferred" una
+    volta a fine caricamento, "batch" dentro la transazione di ogni batch.
+    Restituisce le statistiche del caricamento (righe, inseriti, aggiornati,
+    scartati, errori, righe/s).
+    """
+    stats = {"rows": 0, "inserted": 0, "updated": 0, "skipped": 0, "errors": []}
+    started = time.perf_counter()
+
+    with pooled_connection() as (conn, cur):
+        upserter = FilmUpserter(cur, prefetch=True)
+        line_no = 0
+        for batch in _batched(rows, batch_size):
+            films = []
+            for campi in batch:
+                line_no += 1
+                film, msg = parse_film_fields(list(campi))
+                if film is None:
+                    stats["skipped"] += 1
+                    stats["errors"].append((line_no, msg))
+                    continue
+                films.append(film)
+
+            conn.begin()
+            statuses = upserter.upsert(films)
+            if cleanup == "batch":
+                upserter.cleanup()
+            conn.commit()
+            invalidate_tables()
+
+            stats["rows"] += len(batch)
+            stats["inserted"] += statuses.count("inserted")
+            stats["updated"] += statuses.count("updated")
+            elapsed = time.perf_counter() - started
+            print(f"[DEBUG] Batch caricato: {stats['rows']} righe, {stats['rows'] / elapsed:.0f} righe/s")
+
+        conn.begin()
+        upserter.cleanup()
+        conn.commit()
+        invalidate_tables()
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    stats["rows_per_sec"] = round(stats["rows"] / stats["seconds"], 1) if stats["seconds"] else None
+    return stats
+
+
+def bulk_load_tsv(path: str, batch_size: int = BULK_BATCH_SIZE, cleanup: str = "deferred") -> Dict:
+    """
+    Carica un file TSV (formato di mariadb_init/data.tsv) con bulk_upsert_films.
+    """
+    return bulk_upsert_films(iter_tsv_films(path), batch_size=batch_size, cleanup=cleanup)
+
+
+def upsert_film_lines(lines: Sequence[Tuple[int, Sequence[str]]], group_size: int = BULK_BATCH_SIZE,
+                      atomic: bool = False) -> Dict:
+    """
+    Upsert di molte righe ricevute via API (/add_batch), con l'esito di ogni riga.
+    `lines` sono coppie (numero di riga, campi nell'ordine di TSV_COLUMNS).
+
+    Tutte le righe sono validate prima di scrivere; le valide sono applicate
+    in transazioni da `group_size` righe con un solo FilmUpserter, così registi
+    e piattaforme sono risolti una volta per batch (senza prefetch delle tabelle).
+    Un gruppo fallito (es. stesso film inserito nel frattempo da un'altra
+    richiesta) è ritentato una volta, poi le sue righe risultano "failed".
+    Con `atomic` basta una riga non valida per non scrivere nulla ("skipped"),
+    e le righe valide sono applicate in un'unica transazione.
+    """
+    started = time.perf_counter()
+    results = []
+    films = []  # (posizione in results, film)
+    for line_no, campi in lines:
+        film, msg = parse_film_fields(list(campi))
+        results.append({"line": line_no, "status": "invalid" if film is None else None, "error": msg})
+        if film is not None:
+            films.append((len(results) - 1, film))
+
+    if atomic and len(films) < len(results):
+        for r in results:
+            if r["status"] is None:
+                r["status"] = "skipped"
+    elif films:
+        with pooled_connection() as (conn, cur):
+            upserter = FilmUpserter(cur)
+            for group in _batched(films, len(films) if atomic else max(1, group_size)):
+                statuses, error = None, None
+                for attempt in (1, 2):
+                    try:
+                        conn.begin()
+                        statuses = upserter.upsert([film for _, film in group])
+                        upserter.cleanup()
+                        conn.commit()
+                        break
+                    except Exception as e:
+                        conn.rollback()
+                        # gli id tenuti in memoria possono riferirsi a righe annullate dal rollback
+                        upserter = FilmUpserter(cur)
+                        error = f"Errore inserimento/aggiornamento: {e}"
+                        print(f"[ERRORE] Gruppo di {len(group)} righe non applicato (tentativo {attempt}): {e}")
+                if statuses is None:
+                    for index, _ in group:
+                        results[index].update(status="failed", error=error)
+                    continue
+                invalidate_tables()
+                for (index, _), status in zip(group, statuses):
+                    results[index]["status"] = status
+
+    report = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("inserted", "updated", "invalid", "failed", "skipped")}
+    report["lines"] = len(results)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    report["results"] = results
+    print(f"[DEBUG] Batch via API: {len(results)} righe, {report['inserted']} inseriti, "
+          f"{report['updated']} aggiornati in {report['seconds']}s")
+    return report
@@ -1,16 +1,204 @@
+import os
+import time
+import threading
 import mariadb
-from typing import Tuple
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# ---- Config (sovrascrivibile via env) ----
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "mariadb"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "user": os.getenv("DB_USER", "user"),
+    "password": os.getenv("DB_PASSWORD", "password"),
+    "database": os.getenv("DB_NAME", "movies_db"),
+}
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "5"))
+
 
 def get_connection() -> Tuple[mariadb.Connection, mariadb.Cursor]:
     """
-    Restituisce una connessione e un cursore a MariaDB.
+    Restituisce una connessione e un cursore a MariaDB (connessione dedicata, non dal pool).
     """
-    conn = mariadb.connect(
-        host="mariadb",
-        port=3306,
-        user="user",
-        password="password",
-        database="movies_db"
-    )
+    conn = mariadb.connect(**DB_CONFIG)
     cur = conn.cursor(dictionary=True)
     return conn, cur
+
+
+class PoolTimeoutError(Exception):
+    """
+    Sollevata quando nessuna connessione si libera entro il timeout del pool.
+    """
+
+
+class ConnectionPool:
+    """
+    Pool di connessioni MariaDB condiviso dal processo.
+
+    - Le connessioni sono create in modo lazy fino a `size`.
+    - Al checkout una connessione inattiva da più di `ping_interval` secondi
+      viene verificata con ping() e, se caduta, riconnessa o sostituita.
+    - Le connessioni lavorano in autocommit: le scritture aprono una
+      transazione esplicita con conn.begin().
+    """
+
+    def __init__(self, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 ping_interval: float = POOL_PING_INTERVAL, **conn_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.conn_kwargs = conn_kwargs or dict(DB_CONFIG)
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: List[Tuple[mariadb.Connection, float]] = []
+        self._in_use = 0
+        self._created = 0
+        self._reconnects = 0
+
+    def _new_connection(self) -> mariadb.Connection:
+        conn = mariadb.connect(**self.conn_kwargs)
+        conn.autocommit = True
+        with self._lock:
+            self._created += 1
+        return conn
+
+    def _is_alive(self, conn: mariadb.Connection) -> bool:
+        try:
+            conn.ping()
+            return True
+        except mariadb.Error:
+            pass
+        try:
+            conn.reconnect()
+            conn.autocommit = True
+            with self._lock:
+                self._reconnects += 1
+            return True
+        except mariadb.Error:
+            return False
+
+    def acquire(self) -> mariadb.Connection:
+        """
+        Preleva una connessione dal pool, attendendo al massimo `timeout` secondi.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError(f"Nessuna connessione libera nel pool entro {self.timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = self._new_connection()
+                    break
+                conn, last_used = item
+                if time.monotonic() - last_used < self.ping_interval or self._is_alive(conn):
+                    break
+                print("[DEBUG] Connessione del pool non più valida, scartata")
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def release(self, conn: mariadb.Connection, discard: bool = False) -> None:
+        """
+        Restituisce una connessione al pool (o la chiude se `discard`).
+        """
+        with self._lock:
+            self._in_use -= 1
+        if discard:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    @staticmethod
+    def _discard(conn: mariadb.Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self) -> Iterator[Tuple[mariadb.Connection, mariadb.Cursor]]:
+        """
+        Context manager: fornisce (conn, cur) e rilascia la connessione all'uscita.
+        In caso di eccezione esegue rollback; se la connessione è caduta la scarta.
+        """
+        conn = self.acquire()
+        cur = None
+        discard = False
+        try:
+            cur = conn.cursor(dictionary=True)
+            yield conn, cur
+        except Exception as e:
+            try:
+                conn.rollback()
+            except mariadb.Error:
+                discard = True
+            if isinstance(e, (mariadb.InterfaceError, mariadb.OperationalError)):
+                discard = True
+            raise
+        finally:
+            if cur is not None:
+                try:
+                    cur.close()
+                except Exception:
+                    discard = True
+            self.release(conn, discard=discard)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Statistiche correnti del pool.
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "created": self._created,
+                "reconnects": self._reconnects,
+            }
+
+    def close_all(self) -> None:
+        """
+        Chiude tutte le connessioni inattive del pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Restituisce il pool di connessioni del processo (creato al primo uso).
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+@contextmanager
+def pooled_connection() -> Iterator[Tuple[mariadb.Connection, mariadb.Cursor]]:
+    """
+    Scorciatoia per get_pool().connection().
+    """
+    with get_pool().connection() as (conn, cur):
+        yield conn, cur
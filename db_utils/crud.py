@@ -1,5 +1,6 @@
-from typing import Optional
-from .connection import get_connection
+from typing import Iterable, List, Optional, Tuple
+from .connection import pooled_connection
+from .result_cache import invalidate_tables
 
 def _get_or_create_regista(cur, nome: str, eta: Optional[int]) -> int:
     """
@@ -27,37 +28,67 @@ def _get_or_create_piattaforma(cur, nome: Optional[str]) -> Optional[int]:
     cur.execute("INSERT INTO piattaforme (nome) VALUES (?)", (nome,))
     return cur.lastrowid
 
-def _cleanup_orphan_piattaforme(cur):
+def _cleanup_orphan_piattaforme(cur, candidate_ids: Iterable[Optional[int]]) -> List[int]:
     """
-    Rimuove piattaforme non più usate da nessun film
+    Rimuove, tra le piattaforme indicate (quelle appena sostituite),
+    quelle non più usate da nessun film e ne restituisce gli id.
+    Il controllo usa gli indici su piattaforma_1_id/piattaforma_2_id,
+    quindi costa O(candidati) e non O(film).
     """
-    # Recupera piattaforme orfane
-    cur.execute("""
-        SELECT id, nome FROM piattaforme 
-        WHERE id NOT IN (
-            SELECT DISTINCT piattaforma_1_id FROM movies WHERE piattaforma_1_id IS NOT NULL
-            UNION
-            SELECT DISTINCT piattaforma_2_id FROM movies WHERE piattaforma_2_id IS NOT NULL
-        )
-    """)
+    ids = sorted({pid for pid in candidate_ids if pid is not None})
+    if not ids:
+        return []
+
+    # Recupera piattaforme orfane (bloccandole fino al commit)
+    cur.execute(f"""
+        SELECT p.id, p.nome FROM piattaforme p
+        WHERE p.id IN ({", ".join("?" * len(ids))})
+          AND NOT EXISTS (SELECT 1 FROM movies m WHERE m.piattaforma_1_id = p.id)
+          AND NOT EXISTS (SELECT 1 FROM movies m WHERE m.piattaforma_2_id = p.id)
+        FOR UPDATE
+    """, ids)
     orphan_piattaforme = cur.fetchall()
 
     # Esegue la cancellazione
-    cur.execute("""
-        DELETE FROM piattaforme 
-        WHERE id NOT IN (
-            SELECT DISTINCT piattaforma_1_id FROM movies WHERE piattaforma_1_id IS NOT NULL
-            UNION
-            SELECT DISTINCT piattaforma_2_id FROM movies WHERE piattaforma_2_id IS NOT NULL
-        )
-    """)
+    orphan_ids = [r["id"] for r in orphan_piattaforme]
+    if orphan_ids:
+        cur.execute(f"DELETE FROM piattaforme WHERE id IN ({', '.join('?' * len(orphan_ids))})", orphan_ids)
 
     # Debug finale
     if orphan_piattaforme:
-        for pid, nome in orphan_piattaforme:
-            print(f"[DEBUG] Piattaforma eliminata: id={pid}, nome={nome}")
+        for r in orphan_piattaforme:
+            print(f"[DEBUG] Piattaforma eliminata: id={r['id']}, nome={r['nome']}")
     else:
         print("[DEBUG] Nessuna piattaforma eliminata")
+    return orphan_ids
+
+
+def parse_film_fields(campi: List[str]) -> Tuple[Optional[tuple], Optional[str]]:
+    """
+    Valida i campi di un film e li converte nei tipi del DB.
+    Restituisce ((titolo, regista, eta, anno, genere, piattaforma_1, piattaforma_2), None)
+    oppure (None, messaggio_errore).
+    """
+    campi = [x.strip() for x in campi]
+    if not (6 <= len(campi) <= 7):
+        return None, f"Input non valido, attesi 6 o 7 campi ma trovati {len(campi)}"
+
+    for i, campo in enumerate(campi[:6]):
+        if not campo:
+            return None, f"Input non valido, il campo {i+1} non può essere vuoto"
+
+    if len(campi) == 6:
+        titolo, regista, eta, anno, genere, piattaforma_1 = campi
+        piattaforma_2 = None
+    else:
+        titolo, regista, eta, anno, genere, piattaforma_1, piattaforma_2 = campi
+
+    try:
+        eta_int, anno_int = int(eta), int(anno)
+    except ValueError:
+        return None, "Input non valido, età e anno devono essere numeri interi"
+
+    return (titolo, regista, eta_int, anno_int, genere, piattaforma_1, piattaforma_2 or None), None
 
 
 def insert_or_update_film(stringa: str) -> tuple[bool, str | None]:
@@ -67,66 +98,49 @@ def insert_or_update_film(stringa: str) -> tuple[bool, str | None]:
     Formato: titolo, regista, eta, anno, genere, piattaforma_1[, piattaforma_2]
     """
     try:
-        campi = [x.strip() for x in stringa.split(",")]
-        if not (6 <= len(campi) <= 7):
-            msg = f"Input non valido, attesi 6 o 7 campi ma trovati {len(campi)}"
+        film, msg = parse_film_fields(stringa.split(","))
+        if film is None:
             print(f"[ERRORE] {msg}")
             return False, msg
-        
-        for i, campo in enumerate(campi[:6]):
-            if not campo:
-                msg = f"Input non valido, il campo {i+1} non può essere vuoto"
-                print(f"[ERRORE] {msg}")
-                return False, msg
-
-        if len(campi) == 6:
-            titolo, regista, eta, anno, genere, piattaforma_1 = campi
-            piattaforma_2 = None
-        else:
-            titolo, regista, eta, anno, genere, piattaforma_1, piattaforma_2 = campi
-
-        conn, cur = get_connection()
-
-        regista_id = _get_or_create_regista(cur, regista, int(eta) if eta else None)
-        piattaforma_1_id = _get_or_create_piattaforma(cur, piattaforma_1)
-        piattaforma_2_id = _get_or_create_piattaforma(cur, piattaforma_2)
-
-        cur.execute("SELECT id, piattaforma_1_id, piattaforma_2_id FROM movies WHERE titolo=? AND regista_id=?",
-                    (titolo, regista_id))
-        result = cur.fetchone()
-
-        if result:
-            film_id, old_p1, old_p2 = result['id'], result['piattaforma_1_id'], result['piattaforma_2_id']
-            cur.execute(
-                """UPDATE movies SET anno=?, genere=?, piattaforma_1_id=?, piattaforma_2_id=?, regista_id=?
-                   WHERE id=?""",
-                (int(anno) if anno else None, genere, piattaforma_1_id, piattaforma_2_id, regista_id, film_id)
-            )
-            if (old_p1 != piattaforma_1_id) or (old_p2 != piattaforma_2_id):
-                _cleanup_orphan_piattaforme(cur)
-
-            print(f"[DEBUG] Film aggiornato: {titolo}")
-            
-        else:
-            cur.execute(
-                """INSERT INTO movies (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
-                   VALUES (?, ?, ?, ?, ?, ?)""",
-                (titolo, int(anno) if anno else None, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
-            )
-
-            print(f"[DEBUG] Film inserito: {titolo}")
-
-        conn.commit()
+        titolo, regista, eta, anno, genere, piattaforma_1, piattaforma_2 = film
+
+        with pooled_connection() as (conn, cur):
+            conn.begin()
+
+            regista_id = _get_or_create_regista(cur, regista, eta)
+            piattaforma_1_id = _get_or_create_piattaforma(cur, piattaforma_1)
+            piattaforma_2_id = _get_or_create_piattaforma(cur, piattaforma_2)
+
+            cur.execute("SELECT id, piattaforma_1_id, piattaforma_2_id FROM movies WHERE titolo=? AND regista_id=?",
+                        (titolo, regista_id))
+            result = cur.fetchone()
+
+            if result:
+                film_id, old_p1, old_p2 = result['id'], result['piattaforma_1_id'], result['piattaforma_2_id']
+                cur.execute(
+                    """UPDATE movies SET anno=?, genere=?, piattaforma_1_id=?, piattaforma_2_id=?, regista_id=?
+                       WHERE id=?""",
+                    (anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id, film_id)
+                )
+                if (old_p1 != piattaforma_1_id) or (old_p2 != piattaforma_2_id):
+                    _cleanup_orphan_piattaforme(cur, {old_p1, old_p2} - {piattaforma_1_id, piattaforma_2_id})
+
+                print(f"[DEBUG] Film aggiornato: {titolo}")
+
+            else:
+                cur.execute(
+                    """INSERT INTO movies (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (titolo, anno, genere, piattaforma_1_id, piattaforma_2_id, regista_id)
+                )
+
+                print(f"[DEBUG] Film inserito: {titolo}")
+
+            conn.commit()
+        invalidate_tables()
         return True, None
 
     except Exception as e:
         msg = f"Errore inserimento/aggiornamento: {e}"
         print(f"[ERRORE] {msg}")
         return False, msg
-
-    finally:
-        try:
-            cur.close()
-            conn.close()
-        except:
-            pass
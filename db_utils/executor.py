@@ -1,22 +1,404 @@
-from typing import List, Dict, Tuple, Optional
-from .connection import get_connection
+import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Dict, NamedTuple, Tuple, Optional
+from .connection import POOL_SIZE, get_connection, get_pool, pooled_connection
+from .metrics import REGISTRY, observe_stage, stage
+from .result_cache import normalize_sql, result_cache
+
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000"))
+SQL_FETCH_SIZE = int(os.getenv("SQL_FETCH_SIZE", "200"))
+# Durata massima (secondi) di una query sul server, lettura delle righe compresa (0 = nessun limite)
+SQL_MAX_STATEMENT_TIME = float(os.getenv("SQL_MAX_STATEMENT_TIME", "10"))
+# Scansioni complete (EXPLAIN type=ALL) oltre questa stima di righe sono rifiutate (0 = nessun limite)
+EXPLAIN_MAX_SCAN_ROWS = int(os.getenv("EXPLAIN_MAX_SCAN_ROWS", "500000"))
+# Righe esaminate stimate da EXPLAIN (prodotto sulle tabelle di un join) oltre le quali la query è rifiutata
+EXPLAIN_MAX_ROWS_ESTIMATE = int(os.getenv("EXPLAIN_MAX_ROWS_ESTIMATE", "10000000"))
+# Budget per endpoint: '{"sql_search": {"max_time": 30, "max_rows_estimate": 50000000}}'
+SQL_BUDGETS = json.loads(os.getenv("SQL_BUDGETS") or "{}")
+
+# Thread dedicati al lavoro su DB: non più dei posti nel pool di connessioni
+_db_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+
+# Connessioni con un'istruzione in esecuzione per la chiamata corrente di run_in_db_executor
+_running_queries: contextvars.ContextVar[Optional[List]] = contextvars.ContextVar("running_queries", default=None)
+
+SQL_BUDGET_EVENTS = REGISTRY.counter("sql_budget_events_total", "Query rifiutate o interrotte dai budget di esecuzione",
+                                     ["reason"])
+
+
+class QueryBudget(NamedTuple):
+    """
+    Limiti di esecuzione di una query (0 = nessun limite).
+    """
+    max_time: float = SQL_MAX_STATEMENT_TIME
+    max_scan_rows: int = EXPLAIN_MAX_SCAN_ROWS
+    max_rows_estimate: int = EXPLAIN_MAX_ROWS_ESTIMATE
+
+
+DEFAULT_BUDGET = QueryBudget()
+# SQL scritta dall'utente: le scansioni complete sono spesso volute, restano i limiti su join e durata
+_BUDGETS = {"sql_search": DEFAULT_BUDGET._replace(max_scan_rows=0)}
+for _endpoint, _overrides in SQL_BUDGETS.items():
+    _BUDGETS[_endpoint] = _BUDGETS.get(_endpoint, DEFAULT_BUDGET)._replace(**_overrides)
+
+
+def budget_for(endpoint: str) -> QueryBudget:
+    """
+    Budget di esecuzione delle query di un endpoint (es. "search", "sql_search").
+    """
+    return _BUDGETS.get(endpoint, DEFAULT_BUDGET)
+
+
+class QueryRejected(Exception):
+    """
+    Query rifiutata prima dell'esecuzione perché il piano supera il budget.
+    """
+
+    def __init__(self, code: str, message: str, token: Optional[str] = None):
+        super().__init__(message)
+        self.error = {"code": code, "message": message, "token": token}
+
+
+def is_statement_timeout(db_error: Optional[str]) -> bool:
+    """
+    True se l'errore del DB indica una query interrotta da max_statement_time.
+    """
+    return bool(db_error) and "max_statement_time" in db_error
+
+
+@contextmanager
+def _running(conn) -> Iterator[None]:
+    # rende la connessione interrompibile (kill_queries) se il chiamante viene annullato
+    running = _running_queries.get()
+    if running is None:
+        yield
+        return
+    running.append(conn)
+    try:
+        yield
+    finally:
+        running.remove(conn)
+
+
+def kill_queries(connections: List) -> None:
+    """
+    Interrompe (KILL QUERY) le istruzioni in corso sulle connessioni indicate,
+    da una connessione dedicata: il pool potrebbe essere tutto occupato.
+    """
+    ids = [c.connection_id for c in connections]
+    conn, cur = get_connection()
+    try:
+        for connection_id in ids:
+            try:
+                cur.execute(f"KILL QUERY {int(connection_id)}")
+                SQL_BUDGET_EVENTS.inc(reason="cancelled")
+            except Exception as e:
+                print(f"[ERRORE] KILL QUERY {connection_id} fallito: {e}")
+    finally:
+        conn.close()
+    print(f"[DEBUG] Interrotte {len(ids)} query (richiesta annullata)")
+
 
 def execute_query(sql_query: str) -> Tuple[bool, Optional[List[Dict]], Optional[str]]:
     """
     Esegue una query SQL su MariaDB e restituisce una lista di dict.
+    Usa una connessione del pool condiviso.
     """
     try:
-        conn, cur = get_connection()
-        cur.execute(sql_query)
-        rows = cur.fetchall()
+        with pooled_connection() as (conn, cur), _running(conn):
+            cur.execute(sql_query)
+            rows = cur.fetchall()
         return True, rows, None
 
     except Exception as e:
         return False, None, str(e)
 
-    finally:
+
+class QueryStream:
+    """
+    Esecuzione non bufferizzata di una query su una connessione del pool.
+
+    Il server restituisce al più offset + max_rows + 1 righe (sql_select_limit
+    impostato per la sola istruzione con SET STATEMENT ... FOR), che vengono
+    lette a blocchi di `fetch_size`: la memoria usata non dipende dalla
+    dimensione del risultato. Dopo l'ultima pagina `has_more` indica se
+    esistevano altre righe oltre max_rows.
+
+    Con `max_time` la query (lettura delle righe compresa) è interrotta dal
+    server dopo tanti secondi (max_statement_time).
+
+    Con `dictionary=False` le righe sono tuple nell'ordine di `columns`.
+
+    open, fetch e close sono serializzati: close può essere chiamata da un
+    altro thread (es. client disconnesso) mentre la query è ancora in corso e
+    restituisce la connessione appena l'operazione termina; dopo close lo
+    stream non si riapre.
+
+    Uso:
+        with QueryStream(sql, max_rows=100) as qs:
+            while rows := qs.fetch():
+                ...
+    """
+
+    def __init__(self, sql_query: str, max_rows: int = SQL_MAX_ROWS, offset: int = 0,
+                 fetch_size: int = SQL_FETCH_SIZE, dictionary: bool = True,
+                 max_time: float = SQL_MAX_STATEMENT_TIME):
+        self.sql_query = sql_query
+        self.max_rows = max(0, max_rows)
+        self.offset = max(0, offset)
+        self.fetch_size = max(1, fetch_size)
+        self.dictionary = dictionary
+        self.max_time = max(0.0, max_time)
+        self.has_more = False
+        self.columns: List[str] = []
+
+        self._conn = None
+        self._cur = None
+        self._skipped = 0
+        self._returned = 0
+        self._done = False
+        self._failed = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def open(self) -> None:
+        """
+        Preleva una connessione ed esegue la query (solleva eccezione se fallisce).
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Stream già chiuso")
+            self._conn = get_pool().acquire()
+            try:
+                self._cur = self._conn.cursor(dictionary=self.dictionary, buffered=False)
+                limits = f"sql_select_limit={self.offset + self.max_rows + 1}"
+                if self.max_time:
+                    limits = f"max_statement_time={self.max_time:g}, {limits}"
+                with _running(self._conn):
+                    self._cur.execute(f"SET STATEMENT {limits} FOR {self.sql_query}")
+                self.columns = [d[0] for d in (self._cur.description or ())]
+            except Exception:
+                self._failed = True
+                self._release()
+                raise
+
+    def fetch(self) -> List[Dict]:
+        """
+        Restituisce il prossimo blocco di righe, lista vuota a risultato finito.
+        """
+        with self._lock:
+            if self._done or self._cur is None:
+                return []
+            try:
+                with _running(self._conn):
+                    return self._fetch()
+            except Exception:
+                self._failed = True
+                raise
+
+    def _fetch(self) -> List[Dict]:
+        while self._skipped < self.offset:
+            rows = self._cur.fetchmany(min(self.fetch_size, self.offset - self._skipped))
+            if not rows:
+                self._done = True
+                return []
+            self._skipped += len(rows)
+
+        remaining = self.max_rows - self._returned
+        if remaining <= 0:
+            # al massimo una riga residua: serve solo a sapere se ce ne sono altre
+            self.has_more = bool(self._cur.fetchall())
+            self._done = True
+            return []
+
+        rows = self._cur.fetchmany(min(self.fetch_size, remaining))
+        if not rows:
+            self._done = True
+            return []
+        self._returned += len(rows)
+        return rows
+
+    @property
+    def next_offset(self) -> Optional[int]:
+        """
+        Offset della pagina successiva, o None se il risultato è finito.
+        """
+        return self.offset + self._returned if self.has_more else None
+
+    def close(self) -> None:
+        """
+        Chiude il cursore e restituisce la connessione al pool.
+        """
+        with self._lock:
+            self._closed = True
+            self._release()
+
+    def _release(self) -> None:
+        if self._conn is None:
+            return
         try:
-            cur.close()
-            conn.close()
-        except:
-            pass
+            if self._cur is not None:
+                self._cur.close()
+        except Exception:
+            self._failed = True
+        # una connessione con righe non lette (o in errore) non è riutilizzabile
+        get_pool().release(self._conn, discard=self._failed or not self._done)
+        self._conn, self._cur = None, None
+
+    def __enter__(self) -> "QueryStream":
+        self.open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def fetch_page(sql_query: str, limit: int = SQL_MAX_ROWS, offset: int = 0,
+               budget: QueryBudget = DEFAULT_BUDGET) -> Tuple[bool, Optional[List[Dict]], Optional[str], bool]:
+    """
+    Esegue una query restituendo al più `limit` righe a partire da `offset`.
+    Le pagine già lette sono servite dalla cache dei risultati; le altre
+    passano dal controllo del piano (check_cost) e sono eseguite entro
+    budget.max_time secondi. Solleva QueryRejected se il piano supera il budget.
+    Restituisce (ok, righe, errore, has_more).
+    """
+    key = ("rows", normalize_sql(sql_query), limit, offset)
+    hit, cached = result_cache.get(key)
+    if hit:
+        rows, has_more = cached
+        return True, list(rows), None, has_more
+
+    db_error = check_cost(sql_query, budget)
+    if db_error:
+        return False, None, db_error, False
+    generation = result_cache.generation()
+    try:
+        rows: List[Dict] = []
+        with stage("db_query"), QueryStream(sql_query, max_rows=limit, offset=offset, max_time=budget.max_time) as qs:
+            while chunk := qs.fetch():
+                rows.extend(chunk)
+            has_more = qs.has_more
+    except Exception as e:
+        return False, None, str(e), False
+    result_cache.put(key, sql_query, (rows, has_more), len(rows), generation)
+    return True, list(rows), None, has_more
+
+
+def fetch_columns_page(sql_query: str, limit: int = SQL_MAX_ROWS, offset: int = 0,
+                       budget: QueryBudget = DEFAULT_BUDGET
+                       ) -> Tuple[bool, Optional[List[str]], Optional[List[tuple]], Optional[str], bool]:
+    """
+    Come fetch_page, ma con righe in forma di tuple.
+    Restituisce (ok, colonne, righe, errore, has_more).
+    """
+    key = ("columns", normalize_sql(sql_query), limit, offset)
+    hit, cached = result_cache.get(key)
+    if hit:
+        columns, rows, has_more = cached
+        return True, list(columns), list(rows), None, has_more
+
+    db_error = check_cost(sql_query, budget)
+    if db_error:
+        return False, None, None, db_error, False
+    generation = result_cache.generation()
+    try:
+        rows: List[tuple] = []
+        with stage("db_query"), QueryStream(sql_query, max_rows=limit, offset=offset, dictionary=False,
+                                            max_time=budget.max_time) as qs:
+            while chunk := qs.fetch():
+                rows.extend(chunk)
+            columns, has_more = qs.columns, qs.has_more
+    except Exception as e:
+        return False, None, None, str(e), False
+    result_cache.put(key, sql_query, (columns, rows, has_more), len(rows), generation)
+    return True, list(columns), list(rows), None, has_more
+
+
+def explain_query(sql_query: str) -> Tuple[bool, Optional[List[Dict]], Optional[str]]:
+    """
+    Piano di esecuzione della query (EXPLAIN), senza eseguirla.
+    Restituisce (ok, righe del piano, errore): un errore di sintassi o di
+    schema è segnalato da MariaDB senza leggere i dati.
+    """
+    with stage("explain"):
+        return execute_query(f"EXPLAIN {sql_query}")
+
+
+def estimate_rows(plan: List[Dict]) -> int:
+    """
+    Righe esaminate stimate da un piano EXPLAIN: prodotto delle righe delle
+    tabelle di uno stesso SELECT (join a cicli annidati), sommato sui SELECT.
+    """
+    per_select: Dict[Any, int] = {}
+    for step in plan:
+        per_select[step.get("id")] = per_select.get(step.get("id"), 1) * max(1, int(step.get("rows") or 1))
+    return sum(per_select.values())
+
+
+def check_cost(sql_query: str, budget: QueryBudget = DEFAULT_BUDGET) -> Optional[str]:
+    """
+    Controllo preventivo del costo di una query con EXPLAIN (senza eseguirla).
+    Solleva QueryRejected se il piano prevede una scansione completa oltre
+    budget.max_scan_rows righe o più di budget.max_rows_estimate righe esaminate.
+    Restituisce l'errore del DB se EXPLAIN fallisce, altrimenti None.
+    """
+    if not budget.max_scan_rows and not budget.max_rows_estimate:
+        return None
+    ok, plan, db_error = explain_query(sql_query)
+    if not ok:
+        return db_error
+    if budget.max_scan_rows:
+        for step in plan:
+            rows = step.get("rows") or 0
+            if step.get("type") == "ALL" and rows > budget.max_scan_rows:
+                SQL_BUDGET_EVENTS.inc(reason="full_scan")
+                raise QueryRejected("full_scan", f"Scansione completa di '{step.get('table')}' (circa {rows} "
+                                    f"righe stimate, limite {budget.max_scan_rows})", step.get("table"))
+    if budget.max_rows_estimate:
+        estimate = estimate_rows(plan)
+        if estimate > budget.max_rows_estimate:
+            SQL_BUDGET_EVENTS.inc(reason="rows_estimate")
+            tables = ", ".join(str(step.get("table")) for step in plan)
+            raise QueryRejected("rows_estimate", f"Circa {estimate} righe esaminate stimate su {tables} "
+                                f"(limite {budget.max_rows_estimate})", None)
+    return None
+
+
+async def run_in_db_executor(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Esegue una funzione bloccante (accesso DB) nel thread pool dedicato,
+    senza bloccare l'event loop.
+    Il contesto del chiamante (tempi per fase della richiesta) è propagato al
+    thread; l'attesa di un thread libero è misurata come fase "db_queue".
+    Se il chiamante viene annullato (es. client disconnesso) le query ancora
+    in esecuzione per questa chiamata sono interrotte con KILL QUERY.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    submitted = time.perf_counter()
+    running: List = []
+
+    def _run() -> Any:
+        observe_stage("db_queue", time.perf_counter() - submitted)
+        _running_queries.set(running)
+        return func(*args, **kwargs)
+
+    try:
+        return await loop.run_in_executor(_db_executor, ctx.run, _run)
+    except asyncio.CancelledError:
+        if running:
+            loop.run_in_executor(None, kill_queries, list(running))
+        raise
+
+
+async def execute_query_async(sql_query: str) -> Tuple[bool, Optional[List[Dict]], Optional[str]]:
+    """
+    Versione asincrona di execute_query (eseguita nel thread pool DB).
+    """
+    return await run_in_db_executor(execute_query, sql_query)
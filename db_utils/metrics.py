@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Bucket (secondi) dei tempi per fase: da accessi in cache a generazioni LLM su CPU
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Header Server-Timing nelle risposte del backend
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0").lower() in ("1", "true", "yes")
+
+# Tempi per fase della richiesta corrente (per Server-Timing), None fuori da una richiesta
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_timings", default=None)
+
+
+def _label_key(labelnames: Sequence[str], labels: Dict[str, str]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], le: Optional[str] = None) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(labelnames, values)]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Imposta il totale di un contatore mantenuto da un altro componente (nei collector).
+        """
+        with self._lock:
+            self._values[_label_key(self.labelnames, labels)] = value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_label_key(self.labelnames, labels)] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    render = Counter.render
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in items:
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, str(bound))} {n}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Insieme di metriche esposte in formato testo Prometheus.
+    I collector registrati sono chiamati prima di ogni render (per i gauge
+    letti da altri componenti: pool di connessioni, cache, ...).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def register_collector(self, collector: Callable[[], None]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"[ERRORE] Collector metriche fallito: {e}")
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("text2sql_stage_seconds", "Durata delle fasi di una richiesta", ["stage"])
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    """
+    Registra la durata di una fase (istogramma e tempi della richiesta corrente).
+    """
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Misura la durata del blocco come fase `name`.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def start_request_timing() -> Dict[str, float]:
+    """
+    Inizia la raccolta dei tempi per fase della richiesta corrente (contesto asyncio/thread).
+    """
+    timings: Dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """
+    Valore dell'header Server-Timing (durate in millisecondi).
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
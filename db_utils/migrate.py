@@ -0,0 +1,74 @@
+import re
+from pathlib import Path
+from typing import List, Tuple
+from .connection import pooled_connection
+from .result_cache import result_cache
+
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent / "migrations"
+_LOCK_NAME = "movies_db_schema_migrations"
+_LOCK_TIMEOUT = 60
+
+
+def list_migrations(directory: Path = MIGRATIONS_DIR) -> List[Tuple[int, str, Path]]:
+    """
+    Elenca gli script di migrazione NNNN_nome.sql ordinati per versione.
+    """
+    migrations = []
+    for path in directory.glob("*.sql"):
+        m = re.match(r"^(\d+)_(.+)\.sql$", path.name)
+        if m:
+            migrations.append((int(m.group(1)), m.group(2), path))
+    return sorted(migrations)
+
+
+def split_statements(sql_text: str) -> List[str]:
+    """
+    Divide uno script in istruzioni (terminate da ';' a fine riga), ignorando i commenti '--'.
+    """
+    lines = [line for line in sql_text.splitlines() if not line.strip().startswith("--")]
+    statements = re.split(r";\s*$", "\n".join(lines), flags=re.MULTILINE)
+    return [s.strip() for s in statements if s.strip()]
+
+
+def apply_migrations(directory: Path = MIGRATIONS_DIR) -> List[int]:
+    """
+    Applica gli script di migrazione non ancora eseguiti, in ordine di versione.
+    Le versioni applicate sono registrate nella tabella schema_migrations;
+    un lock applicativo (GET_LOCK) evita esecuzioni concorrenti tra container.
+    Restituisce le versioni applicate in questa chiamata.
+    """
+    applied_now = []
+    with pooled_connection() as (conn, cur):
+        cur.execute("SELECT GET_LOCK(?, ?) AS locked", (_LOCK_NAME, _LOCK_TIMEOUT))
+        if not cur.fetchone()["locked"]:
+            raise RuntimeError("Impossibile ottenere il lock per le migrazioni")
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name VARCHAR(200) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute("SELECT version FROM schema_migrations")
+            done = {r["version"] for r in cur.fetchall()}
+
+            for version, name, path in list_migrations(directory):
+                if version in done:
+                    continue
+                print(f"[DEBUG] Applico migrazione {version:04d}_{name}")
+                # le DDL in MariaDB fanno commit implicito: gli script devono essere idempotenti
+                for statement in split_statements(path.read_text(encoding="utf-8")):
+                    cur.execute(statement)
+                cur.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+                applied_now.append(version)
+        finally:
+            cur.execute("SELECT RELEASE_LOCK(?)", (_LOCK_NAME,))
+            cur.fetchall()
+
+    if applied_now:
+        result_cache.clear()
+    else:
+        print("[DEBUG] Nessuna migrazione da applicare")
+    return applied_now
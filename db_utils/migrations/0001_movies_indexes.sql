@@ -0,0 +1,12 @@
+-- Indici per il percorso di upsert (crud.insert_or_update_film / bulk)
+-- e per i filtri più frequenti nelle query generate dall'LLM.
+
+-- Lookup regista per (nome, eta) in _get_or_create_regista
+ALTER TABLE registi ADD UNIQUE INDEX IF NOT EXISTS uq_registi_nome_eta (nome, eta);
+
+-- Lookup film per (titolo, regista_id) in insert_or_update_film
+ALTER TABLE movies ADD UNIQUE INDEX IF NOT EXISTS uq_movies_titolo_regista (titolo, regista_id);
+
+-- Filtri comuni: WHERE anno = ... / WHERE genere = ...
+CREATE INDEX IF NOT EXISTS idx_movies_anno ON movies (anno);
+CREATE INDEX IF NOT EXISTS idx_movies_genere ON movies (genere);
@@ -0,0 +1,154 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, Tuple
+
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+# Risultati con più righe non vengono messi in cache (0 = nessun limite)
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "1000"))
+# Limite di sicurezza per scritture fatte fuori dall'applicazione (0 = nessuna scadenza)
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "300"))
+
+# Tabelle scritte da crud/bulk
+WRITE_TABLES = ("movies", "registi", "piattaforme")
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_IDENT = re.compile(r"`([^`]+)`|([A-Za-z_][A-Za-z0-9_$]*)")
+
+# funzioni il cui risultato cambia a ogni esecuzione: query non memorizzabili
+_VOLATILE = {"rand", "now", "uuid", "uuid_short", "sysdate", "curdate", "curtime", "current_date",
+             "current_time", "current_timestamp", "localtime", "localtimestamp", "unix_timestamp",
+             "utc_date", "utc_time", "utc_timestamp", "connection_id", "last_insert_id", "found_rows",
+             "row_count", "nextval", "lastval", "sleep"}
+
+
+def normalize_sql(sql_query: str) -> str:
+    """
+    Normalizza una query per usarla come chiave: spazi compattati fuori dalle
+    stringhe letterali, senza ';' finale.
+    """
+    parts, pos = [], 0
+    for m in _STRING.finditer(sql_query):
+        parts.append(re.sub(r"\s+", " ", sql_query[pos:m.start()]))
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(re.sub(r"\s+", " ", sql_query[pos:]))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _identifiers(sql_query: str) -> FrozenSet[str]:
+    # tutti gli identificatori fuori dalle stringhe: un sovrainsieme delle tabelle lette
+    code = _STRING.sub(" ", sql_query)
+    return frozenset((m.group(1) or m.group(2)).lower() for m in _IDENT.finditer(code))
+
+
+class ResultCache:
+    """
+    Cache LRU dei risultati delle query, con chiave basata sulla SQL normalizzata.
+
+    Ogni voce ricorda gli identificatori presenti nella query (sovrainsieme
+    delle tabelle da cui dipende): invalidate(tabelle) rimuove solo le voci
+    che possono leggere quelle tabelle. Un contatore di generazione evita di
+    memorizzare risultati letti prima di un'invalidazione concorrente.
+    """
+
+    def __init__(self, size: int = RESULT_CACHE_SIZE, max_rows: int = RESULT_CACHE_MAX_ROWS,
+                 ttl: float = RESULT_CACHE_TTL):
+        self.size = size
+        self.max_rows = max_rows
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[FrozenSet[str], Any, float]]" = OrderedDict()
+        self._generation = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def generation(self) -> int:
+        """
+        Valore da leggere prima di eseguire la query e passare a put().
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Restituisce (True, valore) se la chiave è in cache, altrimenti (False, None).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and time.monotonic() - entry[2] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, entry[1]
+
+    def put(self, key: Hashable, sql_query: str, value: Any, n_rows: int, generation: int) -> None:
+        """
+        Memorizza il risultato di `sql_query`, salvo query non deterministiche,
+        risultati troppo grandi o invalidazioni avvenute dopo `generation`.
+        """
+        if self.size <= 0 or (self.max_rows and n_rows > self.max_rows):
+            return
+        deps = _identifiers(sql_query)
+        if deps & _VOLATILE:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (deps, value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, tables: Iterable[str]) -> int:
+        """
+        Rimuove le voci che dipendono da almeno una delle tabelle indicate.
+        Restituisce il numero di voci rimosse.
+        """
+        tables = {t.lower() for t in tables}
+        with self._lock:
+            self._generation += 1
+            stale = [key for key, (deps, _, _) in self._entries.items() if deps & tables]
+            for key in stale:
+                del self._entries[key]
+            self.stats["invalidations"] += len(stale)
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+    def info(self) -> Dict:
+        """
+        Contatori della cache (hit rate compreso) e numero di voci.
+        """
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None,
+                "size": len(self._entries),
+            }
+
+
+result_cache = ResultCache()
+
+
+def invalidate_tables(tables: Iterable[str] = WRITE_TABLES) -> int:
+    """
+    Invalida i risultati in cache che leggono le tabelle indicate (da chiamare dopo il commit di una scrittura).
+    """
+    removed = result_cache.invalidate(tables)
+    if removed:
+        print(f"[DEBUG] Cache risultati: {removed} voci invalidate")
+    return removed
@@ -1,7 +1,85 @@
+import os
+import time
+import threading
 from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 from .executor import execute_query
 
 
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "600"))
+SCHEMA_CHECK_INTERVAL = float(os.getenv("SCHEMA_CHECK_INTERVAL", "30"))
+# Valori distinti campionati per colonna testuale (colonne con più valori non vengono campionate)
+SCHEMA_SAMPLE_VALUES = int(os.getenv("SCHEMA_SAMPLE_VALUES", "50"))
+
+_COLS_SQL = """
+    SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, DATA_TYPE AS data_type
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME <> 'schema_migrations'
+    ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+# Fingerprint economico: numero di tabelle + checksum di nome/CREATE_TIME
+# (CREATE_TIME cambia con CREATE/ALTER TABLE, non con le scritture sui dati)
+_FINGERPRINT_SQL = """
+    SELECT COUNT(*) AS n_tables,
+           COALESCE(SUM(CRC32(CONCAT(TABLE_NAME, '|', COALESCE(CREATE_TIME, '')))), 0) AS checksum
+    FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME <> 'schema_migrations'
+"""
+
+
+_FK_SQL = """
+    SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name,
+           REFERENCED_TABLE_NAME AS ref_table, REFERENCED_COLUMN_NAME AS ref_column
+    FROM information_schema.KEY_COLUMN_USAGE
+    WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+    ORDER BY TABLE_NAME, COLUMN_NAME
+"""
+
+_TEXT_TYPES = {"char", "varchar", "enum", "set", "tinytext"}
+
+
+def _fetch_foreign_keys() -> List[Tuple[str, str, str, str]]:
+    ok, rows, err = execute_query(_FK_SQL)
+    if not ok:
+        print(f"[ERRORE] Lettura chiavi esterne fallita: {err}")
+        return []
+    return [(r["table_name"], r["column_name"], r["ref_table"], r["ref_column"]) for r in rows]
+
+
+def _fetch_sample_values(columns: List[Dict], limit: int = SCHEMA_SAMPLE_VALUES) -> Dict[Tuple[str, str], List[str]]:
+    """
+    Valori distinti delle colonne testuali a bassa cardinalità (al più `limit`).
+    Ogni lettura è limitata a 1 secondo (max_statement_time): se scade la colonna è saltata.
+    """
+    samples = {}
+    if limit <= 0:
+        return samples
+    for r in columns:
+        if (r.get("data_type") or "").lower() not in _TEXT_TYPES:
+            continue
+        table, column = r["table_name"], r["column_name"]
+        ok, rows, err = execute_query(
+            f"SET STATEMENT max_statement_time=1 FOR "
+            f"SELECT DISTINCT `{column}` AS value FROM `{table}` WHERE `{column}` IS NOT NULL LIMIT {limit + 1}"
+        )
+        if ok and rows and len(rows) <= limit:
+            samples[(table, column)] = [str(v["value"]) for v in rows]
+    return samples
+
+
+def _format_schema_text(rows: List[Dict]) -> str:
+    by_table = defaultdict(list)
+    for r in rows:
+        by_table[r["table_name"]].append(r["column_name"])
+
+    lines = []
+    for tbl in sorted(by_table.keys()):
+        cols_sorted = ", ".join(by_table[tbl])
+        lines.append(f"TABLE {tbl}({cols_sorted});")
+    return "\n".join(lines)
+
+
 def schema_text_from_information_schema() -> str | None:
     """
     Costruisce una rappresentazione compatta dello schema leggendo da information_schema.
@@ -10,23 +88,192 @@ def schema_text_from_information_schema() -> str | None:
         TABLE registi(id, nome, eta);
         TABLE piattaforme(id, nome);
     oppure None se qualcosa va storto.
+    Non usa la cache: per il prompt preferire get_schema_text().
     """
-    cols_sql = """
-        SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name
-        FROM information_schema.COLUMNS
-        WHERE TABLE_SCHEMA = DATABASE()
-        ORDER BY TABLE_NAME, ORDINAL_POSITION
-    """
-    ok, rows, err = execute_query(cols_sql)
+    ok, rows, err = execute_query(_COLS_SQL)
     if not ok or not rows:
         return None
+    return _format_schema_text(rows)
 
-    by_table = defaultdict(list)
-    for r in rows:
-        by_table[r["table_name"]].append(r["column_name"])
 
-    lines = []
-    for tbl in sorted(by_table.keys()):
-        cols_sorted = ", ".join(by_table[tbl])
-        lines.append(f"TABLE {tbl}({cols_sorted});")
-    return "\n".join(lines)
\ No newline at end of file
+def _fetch_fingerprint() -> str | None:
+    ok, rows, err = execute_query(_FINGERPRINT_SQL)
+    if not ok or not rows:
+        return None
+    r = rows[0]
+    return f"{r['n_tables']}:{r['checksum']}"
+
+
+class SchemaCache:
+    """
+    Cache in memoria dello schema (colonne + testo per il prompt).
+
+    Invalidazione:
+    - TTL: dopo `ttl` secondi lo schema viene sempre riletto;
+    - fingerprint: al massimo ogni `check_interval` secondi si confronta
+      il fingerprint di information_schema.TABLES con quello memorizzato;
+    - esplicita: invalidate() (esposta dall'endpoint admin del backend).
+    Ogni ricarica con fingerprint diverso incrementa `version`.
+    """
+
+    def __init__(self, ttl: float = SCHEMA_CACHE_TTL, check_interval: float = SCHEMA_CHECK_INTERVAL):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._columns: Optional[List[Dict]] = None
+        self._text: Optional[str] = None
+        self._fingerprint: Optional[str] = None
+        self._links: Optional[Dict] = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    def _load(self) -> None:
+        fingerprint = _fetch_fingerprint()
+        ok, rows, err = execute_query(_COLS_SQL)
+        if not ok or not rows:
+            print(f"[ERRORE] Caricamento schema fallito: {err}")
+            return
+
+        now = time.monotonic()
+        if fingerprint != self._fingerprint or self._columns is None:
+            self.version += 1
+        self._columns = rows
+        self._text = _format_schema_text(rows)
+        self._links = None
+        self._fingerprint = fingerprint
+        self._loaded_at = now
+        self._checked_at = now
+        print(f"[DEBUG] Schema caricato in cache (versione {self.version})")
+
+    def _refresh_if_needed(self) -> None:
+        now = time.monotonic()
+        if self._columns is None or now - self._loaded_at >= self.ttl:
+            self._load()
+            return
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            fingerprint = _fetch_fingerprint()
+            if fingerprint is not None and fingerprint != self._fingerprint:
+                self._load()
+
+    def get_columns(self) -> List[Dict]:
+        """
+        Colonne dello schema come lista di dict {table_name, column_name}.
+        """
+        with self._lock:
+            self._refresh_if_needed()
+            return list(self._columns or [])
+
+    def get_text(self) -> str | None:
+        """
+        Testo compatto dello schema per il prompt, o None se non disponibile.
+        """
+        with self._lock:
+            self._refresh_if_needed()
+            return self._text
+
+    def get_links(self) -> Dict:
+        """
+        Metadati per lo schema linking, letti alla prima richiesta dopo ogni
+        ricarica: {"tables": {tabella: [colonne]}, "foreign_keys": [(tabella,
+        colonna, tabella_rif, colonna_rif)], "samples": {(tabella, colonna): [valori]}}.
+        """
+        with self._lock:
+            self._refresh_if_needed()
+            if self._links is None and self._columns is not None:
+                tables: Dict[str, List[str]] = defaultdict(list)
+                for r in self._columns:
+                    tables[r["table_name"]].append(r["column_name"])
+                self._links = {
+                    "tables": dict(tables),
+                    "foreign_keys": _fetch_foreign_keys(),
+                    "samples": _fetch_sample_values(self._columns),
+                }
+            return self._links or {"tables": {}, "foreign_keys": [], "samples": {}}
+
+    def get_fingerprint(self) -> str | None:
+        """
+        Fingerprint dello schema attualmente in cache.
+        """
+        with self._lock:
+            self._refresh_if_needed()
+            return self._fingerprint
+
+    def invalidate(self) -> None:
+        """
+        Svuota la cache: la prossima lettura ricarica lo schema.
+        """
+        with self._lock:
+            self._columns = None
+            self._text = None
+            self._links = None
+
+    def info(self) -> Dict:
+        """
+        Stato della cache (versione, fingerprint, età in secondi).
+        """
+        with self._lock:
+            loaded = self._columns is not None
+            return {
+                "version": self.version,
+                "fingerprint": self._fingerprint,
+                "loaded": loaded,
+                "age_seconds": round(time.monotonic() - self._loaded_at, 3) if loaded else None,
+            }
+
+
+_schema_cache = SchemaCache()
+
+
+def get_schema_columns() -> List[Dict]:
+    """
+    Colonne dello schema servite dalla cache.
+    """
+    return _schema_cache.get_columns()
+
+
+def get_schema_tables() -> Dict[str, List[str]]:
+    """
+    Schema in cache come dizionario {tabella: [colonne]}.
+    """
+    tables: Dict[str, List[str]] = defaultdict(list)
+    for r in _schema_cache.get_columns():
+        tables[r["table_name"]].append(r["column_name"])
+    return dict(tables)
+
+
+def get_schema_links() -> Dict:
+    """
+    Tabelle, chiavi esterne e valori campione dello schema in cache (per lo schema linking).
+    """
+    return _schema_cache.get_links()
+
+
+def get_schema_text() -> str | None:
+    """
+    Testo dello schema per il prompt servito dalla cache.
+    """
+    return _schema_cache.get_text()
+
+
+def get_schema_fingerprint() -> str | None:
+    """
+    Fingerprint dello schema in cache (utile come chiave per altre cache).
+    """
+    return _schema_cache.get_fingerprint()
+
+
+def invalidate_schema_cache() -> None:
+    """
+    Invalida la cache dello schema.
+    """
+    _schema_cache.invalidate()
+
+
+def schema_cache_info() -> Dict:
+    """
+    Stato corrente della cache dello schema.
+    """
+    return _schema_cache.info()
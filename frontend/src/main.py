@@ -1,16 +1,46 @@
 import os
-import requests
+import json
+import time
+import httpx
+import jinja2
+import asyncio
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Dict, Optional
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
 # ---- Config ----
 BACKEND_URL = os.getenv("BACKEND_URL", "http://backend:8003").rstrip("/")
+# Connessioni verso il backend (client condiviso, keep-alive)
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE = int(os.getenv("BACKEND_MAX_KEEPALIVE", "20"))
+# Validità (secondi) dello schema mostrato da /schema_summary
+SCHEMA_SUMMARY_TTL = float(os.getenv("SCHEMA_SUMMARY_TTL", "300"))
 
-app = FastAPI()
+_client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Crea il client HTTP condiviso verso il backend e lo chiude allo shutdown.
+    """
+    global _client
+    _client = httpx.AsyncClient(
+        base_url=BACKEND_URL,
+        timeout=httpx.Timeout(120, connect=10),
+        limits=httpx.Limits(max_connections=BACKEND_MAX_CONNECTIONS,
+                            max_keepalive_connections=BACKEND_MAX_KEEPALIVE),
+    )
+    yield
+    await _client.aclose()
+    _client = None
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Static files (CSS/JS opzionali)
 static_dir = Path(__file__).resolve().parents[1] / "static"
@@ -20,6 +50,168 @@ if static_dir.exists():
 # Templates directory
 templates_dir = Path(__file__).resolve().parents[1] / "templates"
 templates = Jinja2Templates(directory=str(templates_dir))
+# Stessi template in modalità asincrona, per le pagine inviate man mano (risultati in streaming)
+stream_env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(templates_dir)), autoescape=True,
+                                enable_async=True)
+
+
+def backend() -> httpx.AsyncClient:
+    """
+    Client HTTP condiviso verso il backend.
+    """
+    if _client is None:
+        raise RuntimeError("Client verso il backend non inizializzato")
+    return _client
+
+
+# ---------------- STREAMING ----------------
+
+_decoder = json.JSONDecoder()
+
+
+class BackendStream:
+    """
+    Legge una risposta JSON del backend con `stream=true` ({..., "results": [...], ...})
+    man mano che arriva: `open()` restituisce i campi che precedono i risultati
+    (es. sql, sql_validation), `items()` i risultati uno alla volta; i campi
+    finali (truncated, next_offset, error) sono aggiunti a `head` alla fine.
+    Funziona anche con una risposta non in streaming (es. SQL non valida).
+    """
+
+    def __init__(self, path: str, payload: dict, timeout: float):
+        self.path = path
+        self.payload = payload
+        self.timeout = timeout
+        self.head: Dict = {}
+        self._resp: httpx.Response | None = None
+        self._chunks: AsyncIterator[str] | None = None
+        self._buf = ""
+        self._pos = 0
+        self._in_results = False
+
+    @property
+    def has_results(self) -> bool:
+        """
+        True se la risposta contiene risultati ancora da leggere con items().
+        """
+        return self._in_results
+
+    async def open(self) -> Dict:
+        request = backend().build_request("POST", self.path, params={"stream": "true"},
+                                          json=self.payload, timeout=self.timeout)
+        self._resp = await backend().send(request, stream=True)
+        try:
+            self._resp.raise_for_status()
+            self._chunks = self._resp.aiter_text()
+            await self._expect("{")
+            await self._read_fields()
+        except BaseException:
+            await self.close()
+            raise
+        if not self._in_results:
+            await self.close()
+        return self.head
+
+    async def items(self) -> AsyncIterator[Dict]:
+        try:
+            while self._in_results:
+                if await self._peek() == "]":
+                    self._pos += 1
+                    self._in_results = False
+                    await self._read_fields()
+                    break
+                yield await self._value()
+                if await self._peek() == ",":
+                    self._pos += 1
+        except Exception as e:
+            self.head["stream_error"] = f"Risultati incompleti: {e}"
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self._resp is not None:
+            await self._resp.aclose()
+
+    async def _more(self) -> None:
+        chunk = await anext(self._chunks, None)
+        if chunk is None:
+            raise ValueError("risposta JSON troncata")
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+
+    async def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            await self._more()
+
+    async def _expect(self, char: str) -> None:
+        if await self._peek() != char:
+            raise ValueError(f"atteso '{char}' nella risposta del backend")
+        self._pos += 1
+
+    async def _value(self):
+        # un valore è completo solo se nel buffer c'è già il separatore che lo segue
+        # (un numero a fine buffer potrebbe continuare nel chunk successivo)
+        await self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+                if end < len(self._buf):
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                pass
+            await self._more()
+
+    async def _read_fields(self) -> None:
+        # campi "chiave": valore fino a "results": [ oppure alla chiusura dell'oggetto
+        while (char := await self._peek()) != "}":
+            if char == ",":
+                self._pos += 1
+                continue
+            key = await self._value()
+            await self._expect(":")
+            if key == "results" and await self._peek() == "[":
+                self._pos += 1
+                self._in_results = True
+                return
+            self.head[key] = await self._value()
+        self._pos += 1
+
+
+async def render_stream(name: str, context: dict) -> AsyncIterator[str]:
+    """
+    Renderizza un template inviando l'HTML man mano che è prodotto:
+    le parti pronte (es. SQL generata) partono subito, i risultati seguono
+    quando arrivano dal backend. Le parti accumulate sono inviate insieme.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+    async def _render():
+        try:
+            async for part in stream_env.get_template(name).generate_async(context):
+                await queue.put(part)
+        except Exception as e:
+            print(f"[ERRORE] Rendering in streaming interrotto: {e}")
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(_render())
+    try:
+        while (part := await queue.get()) is not None:
+            parts = [part]
+            while not queue.empty():
+                part = queue.get_nowait()
+                if part is None:
+                    yield "".join(parts)
+                    return
+                parts.append(part)
+            yield "".join(parts)
+    finally:
+        task.cancel()
 
 
 # ---------------- UI ROUTES ----------------
@@ -32,58 +224,75 @@ def ui_home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+_schema_summary = {"text": None, "expires": 0.0}
+_schema_lock = asyncio.Lock()
+
+
+async def get_schema_summary() -> str:
+    """
+    Schema del database già formattato (una riga TABLE per tabella),
+    in cache per SCHEMA_SUMMARY_TTL secondi; richieste contemporanee
+    alla scadenza fanno una sola chiamata al backend.
+    """
+    async with _schema_lock:
+        if _schema_summary["text"] is None or time.monotonic() >= _schema_summary["expires"]:
+            r = await backend().get("/schema_summary", timeout=30)
+            r.raise_for_status()
+            grouped: Dict[str, list] = {}
+            for c in r.json():
+                grouped.setdefault(c["table_name"], []).append(c["table_column"])
+            _schema_summary["text"] = "\n".join(f"TABLE {tbl}({', '.join(cols)});" for tbl, cols in grouped.items())
+            _schema_summary["expires"] = time.monotonic() + SCHEMA_SUMMARY_TTL
+        return _schema_summary["text"]
+
+
 @app.post("/schema_summary", response_class=HTMLResponse)
-def ui_schema_summary(request: Request):
+async def ui_schema_summary(request: Request):
     """
     Recupera e mostra lo schema del database.
     """
     try:
-        r = requests.get(f"{BACKEND_URL}/schema_summary", timeout=30)
-        r.raise_for_status()
-        schema = r.json()
+        schema_text = await get_schema_summary()
     except Exception as e:
         error = f"Errore nel recupero dello schema: {e}"
         return templates.TemplateResponse("index.html", {"request": request, "error": error})
 
-    return templates.TemplateResponse("index.html", {"request": request, "schema": schema})
+    return templates.TemplateResponse("index.html", {"request": request, "schema_text": schema_text})
 
 
 @app.post("/search", response_class=HTMLResponse)
-def ui_search(request: Request,
-              question: str = Form(...),
-              model: Optional[str] = Form(None)):
+async def ui_search(request: Request,
+                    question: str = Form(...),
+                    model: Optional[str] = Form(None)):
     """
     Text-to-SQL: genera una query SQL a partire da una domanda in linguaggio naturale.
+    La pagina con la SQL generata è inviata subito, i risultati man mano che arrivano.
     """
     payload = {"question": question, "model": model or None}
+    stream = BackendStream("/search", payload, timeout=120)
     try:
-        r = requests.post(f"{BACKEND_URL}/search", json=payload, timeout=120)
-        r.raise_for_status()
-        data = r.json()
-        search = {
-            "sql": data.get("sql"),
-            "sql_validation": data.get("sql_validation"),
-            "results": data.get("results")
-        }
+        search = await stream.open()
     except Exception as e:
         error = f"Errore nella richiesta /search: {e}"
         return templates.TemplateResponse("index.html",
                                           {"request": request, "error": error, "question": question, "model": model})
 
+    if stream.has_results:
+        search["results"] = stream.items()
     ctx = {"request": request, "search": search, "question": question, "model": model}
-    return templates.TemplateResponse("index.html", ctx)
+    return StreamingResponse(render_stream("index.html", ctx), media_type="text/html")
 
 
 @app.post("/search_with_retry", response_class=HTMLResponse)
-def ui_search_with_retry(request: Request,
-                         question: str = Form(...),
-                         model: Optional[str] = Form(None)):
+async def ui_search_with_retry(request: Request,
+                               question: str = Form(...),
+                               model: Optional[str] = Form(None)):
     """
     Text-to-SQL con tentativi multipli (retry) se il primo fallisce.
     """
     payload = {"question": question, "model": model or None}
     try:
-        r = requests.post(f"{BACKEND_URL}/search_with_retry", json=payload, timeout=180)
+        r = await backend().post("/search_with_retry", json=payload, timeout=180)
         r.raise_for_status()
         data = r.json()
         s1 = data.get("attempt_1")
@@ -101,36 +310,34 @@ def ui_search_with_retry(request: Request,
 
 
 @app.post("/sql_search", response_class=HTMLResponse)
-def ui_sql_search(request: Request, sql_query: str = Form(...)):
+async def ui_sql_search(request: Request, sql_query: str = Form(...)):
     """
     Esegue direttamente una query SQL fornita dall'utente.
+    I risultati sono inviati man mano che arrivano dal backend.
     """
     payload = {"sql_query": sql_query}
+    stream = BackendStream("/sql_search", payload, timeout=120)
     try:
-        r = requests.post(f"{BACKEND_URL}/sql_search", json=payload, timeout=120)
-        r.raise_for_status()
-        data = r.json()
-        sql_search = {
-            "sql_validation": data.get("sql_validation"),
-            "results": data.get("results")
-        }
+        sql_search = await stream.open()
     except Exception as e:
         error = f"Errore nella richiesta /sql_search: {e}"
         return templates.TemplateResponse("index.html",
                                           {"request": request, "error": error, "sql_query": sql_query})
 
+    if stream.has_results:
+        sql_search["results"] = stream.items()
     ctx = {"request": request, "sql_search": sql_search, "sql_query": sql_query}
-    return templates.TemplateResponse("index.html", ctx)
+    return StreamingResponse(render_stream("index.html", ctx), media_type="text/html")
 
 
 @app.post("/add", response_class=HTMLResponse)
-def ui_add(request: Request, data_line: str = Form(...)):
+async def ui_add(request: Request, data_line: str = Form(...)):
     """
     Inserisce una riga nel database secondo il formato richiesto.
     """
     payload = {"data_line": data_line}
     try:
-        r = requests.post(f"{BACKEND_URL}/add", json=payload, timeout=60)
+        r = await backend().post("/add", json=payload, timeout=60)
         r.raise_for_status()
         status = (r.json() or {}).get("status", "error")
     except Exception as e:
@@ -140,5 +347,3 @@ def ui_add(request: Request, data_line: str = Form(...)):
                                            "add_input": data_line, "error": f"Errore /add: {e}"})
 
     return templates.TemplateResponse("index.html", {"request": request, "add_status": status, "add_input": data_line})
-
-
@@ -1,27 +1,14 @@
-import csv
-from db_utils.crud import insert_or_update_film
+from db_utils.bulk import bulk_load_tsv
+from db_utils.migrate import apply_migrations
 
-# Legge i dati dal file TSV
-with open('data.tsv', newline='') as file:
-    reader: csv.DictReader = csv.DictReader(file, delimiter='\t')
-    
-    for riga in reader:  
-        """
-        Crea una stringa concatenando i campi richiesti
-        e la passa alla funzione insert_or_update_film
-        """
-        stringa: str = (
-            riga['Titolo'] + ", " +
-            riga['Regista'] + ", " +
-            riga['Età_Autore'] + ", " +
-            riga['Anno'] + ", " +
-            riga['Genere'] + ", " +
-            riga['Piattaforma_1'] + ", " +
-            riga['Piattaforma_2']
-        )
-        insert_or_update_film(stringa)  # Inserisce o aggiorna il film nel DB
+# Applica le migrazioni (indici/vincoli) prima del caricamento
+apply_migrations()
 
+# Carica i dati dal file TSV in un'unica passata, a batch
+stats = bulk_load_tsv('data.tsv')
 
-
-
-        
+print(f"[DEBUG] Caricamento completato: {stats['rows']} righe "
+      f"({stats['inserted']} inseriti, {stats['updated']} aggiornati, {stats['skipped']} scartati) "
+      f"in {stats['seconds']} s, {stats['rows_per_sec']} righe/s")
+for line_no, msg in stats["errors"]:
+    print(f"[ERRORE] Riga {line_no}: {msg}")
@@ -0,0 +1,121 @@
+import time
+import socket
+import asyncio
+
+import pytest
+
+from text_to_sql import text_to_sql
+from text_to_sql.fake_ollama import DEFAULT_SQL, start_fake_ollama
+from text_to_sql.ollama_pool import OllamaPool
+
+MODEL = "gemma3:1b-it-qat"
+
+
+def _free_port() -> int:
+    # porta senza nessuno in ascolto: un endpoint "morto" (connessione rifiutata)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def _start(**kwargs):
+        server, url = start_fake_ollama(**kwargs)
+        started.append(server)
+        return server, url
+
+    yield _start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def _ask(pool: OllamaPool, monkeypatch, model: str = MODEL, n: int = 1, refresh: bool = True):
+    # percorso reale di ask_ollama_stream_async, con il pool del test al posto di quello globale
+    monkeypatch.setattr(text_to_sql, "ollama_pool", pool)
+
+    async def scenario():
+        try:
+            if refresh:
+                await pool.refresh_tags()
+            return await asyncio.gather(*(text_to_sql.ask_ollama_stream_async("domanda", model) for _ in range(n)))
+        finally:
+            await text_to_sql.close_async_client()
+
+    return [sql for sql, _ in asyncio.run(scenario())]
+
+
+def _sql(sql: str) -> str:
+    return sql.rstrip(";")
+
+
+def test_routing_spreads_load_and_respects_limit(servers, monkeypatch):
+    a, url_a = servers(latency=0.1)
+    b, url_b = servers(latency=0.1)
+    pool = OllamaPool([url_a, url_b], max_inflight=2, hedge_after=0)
+
+    results = _ask(pool, monkeypatch, n=8)
+    assert {_sql(r) for r in results} == {_sql(DEFAULT_SQL)}
+    assert a.requests == b.requests == 4
+    assert a.max_inflight <= 2 and b.max_inflight <= 2
+    assert all(ep["inflight"] == 0 for ep in pool.info())
+
+
+def test_failover_from_dead_node_opens_breaker(servers, monkeypatch):
+    fast, url_fast = servers(latency=0.0)
+    dead_url = f"http://127.0.0.1:{_free_port()}"
+    pool = OllamaPool([dead_url, url_fast], max_failures=1, cooldown=60, hedge_after=0)
+
+    # senza /api/tags il modello è considerato disponibile ovunque: la prima richiesta va sul nodo morto
+    results = _ask(pool, monkeypatch, n=3, refresh=False)
+    assert {_sql(r) for r in results} == {_sql(DEFAULT_SQL)}
+    dead, alive = pool.info()
+    assert dead["state"] == "open" and dead["ejections"] == 1
+    assert alive["state"] == "closed" and fast.requests == 3
+
+
+def test_breaker_half_open_probe_closes_when_node_recovers(servers, monkeypatch):
+    port = _free_port()
+    pool = OllamaPool([f"http://127.0.0.1:{port}"], max_failures=2, cooldown=0.2, hedge_after=0)
+
+    failed = _ask(pool, monkeypatch, n=2, refresh=False)
+    assert all("[ERROR]" in r for r in failed)
+    assert pool.info()[0]["state"] == "open"
+    assert "[ERROR]" in _ask(pool, monkeypatch, refresh=False)[0]   # escluso: nessun endpoint disponibile
+
+    servers(port=port)
+    time.sleep(0.25)
+    assert pool.info()[0]["state"] == "half_open"
+    assert _sql(_ask(pool, monkeypatch, refresh=False)[0]) == _sql(DEFAULT_SQL)
+    assert pool.info()[0]["state"] == "closed"
+
+
+def test_404_removes_model_from_endpoint(servers, monkeypatch):
+    _, url = servers(models=[MODEL])
+    pool = OllamaPool([url], hedge_after=0)
+    asyncio.run(pool.refresh_tags(text_to_sql.get_async_client()))
+    asyncio.run(text_to_sql.close_async_client())
+    pool.endpoints[0].models.add("modello-rimosso")   # elenco /api/tags non aggiornato
+
+    assert "[ERROR]" in _ask(pool, monkeypatch, model="modello-rimosso", refresh=False)[0]
+    assert pool.info()[0]["models"] == [MODEL]
+    assert pool.info()[0]["state"] == "closed"   # un 404 non conta per il circuit breaker
+
+
+def test_hedging_answers_from_fast_node(servers, monkeypatch):
+    slow, url_slow = servers(latency=2.0)
+    fast, url_fast = servers(latency=0.0)
+    pool = OllamaPool([url_slow, url_fast], hedge_after=0.2)
+
+    started = time.perf_counter()
+    result = _ask(pool, monkeypatch, refresh=False)[0]
+    assert _sql(result) == _sql(DEFAULT_SQL)
+    assert time.perf_counter() - started < 1.5
+    assert (slow.requests, fast.requests) == (1, 1)
+    slow_ep, fast_ep = pool.info()
+    assert fast_ep["hedges"] == 1
+    assert slow_ep["inflight"] == fast_ep["inflight"] == 0
+    assert slow_ep["state"] == "closed"   # la richiesta annullata non conta come errore
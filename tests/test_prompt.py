@@ -0,0 +1,31 @@
+from text_to_sql.schema_linking import prune_schema, render_schema
+from text_to_sql.text_to_sql import build_messages
+
+TABLES = {
+    "movies": ["id", "titolo", "anno", "genere", "regista_id"],
+    "registi": ["id", "nome", "eta"],
+    "piattaforme": ["id", "nome"],
+    "movies_piattaforme": ["movie_id", "piattaforma_id"],
+}
+FOREIGN_KEYS = [
+    ("movies", "regista_id", "registi", "id"),
+    ("movies_piattaforme", "movie_id", "movies", "id"),
+    ("movies_piattaforme", "piattaforma_id", "piattaforme", "id"),
+]
+SAMPLES = {("piattaforme", "nome"): ["Netflix", "Prime Video"]}
+
+
+def _messages(question: str) -> list[dict]:
+    # come _prepare_nlp: schema completo nel sistema, schema ridotto nel messaggio utente
+    context = prune_schema(question, TABLES, FOREIGN_KEYS, SAMPLES)
+    return build_messages(render_schema(TABLES, FOREIGN_KEYS), question, context)
+
+
+def test_system_message_is_identical_across_questions_and_warm_up():
+    first = _messages("Quali film ha diretto Christopher Nolan?")
+    second = _messages("Quali film sono disponibili su Netflix?")
+    warm_up = build_messages(render_schema(TABLES, FOREIGN_KEYS), "")
+
+    assert first[0] == second[0] == warm_up[0]
+    assert first[1] != second[1]
+    assert "Netflix" in second[1]["content"]   # valori di esempio nel messaggio utente
@@ -0,0 +1,69 @@
+import time
+import asyncio
+
+import pytest
+
+from text_to_sql.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, Claim, LLMScheduler, Overloaded
+
+MODEL = "gemma3:1b-it-qat"
+
+
+def test_joined_claim_is_promoted_while_queued():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1)
+        await scheduler.acquire(MODEL)   # unico posto occupato
+        order = []
+
+        async def waiter(name, **kwargs):
+            await scheduler.acquire(MODEL, **kwargs)
+            order.append(name)
+            scheduler.release(MODEL)
+
+        batch = asyncio.create_task(waiter("batch", priority=PRIORITY_BATCH))
+        await asyncio.sleep(0)
+        claim = Claim(PRIORITY_BATCH)
+        shared = asyncio.create_task(waiter("shared", claim=claim))
+        await asyncio.sleep(0)
+        claim.join(PRIORITY_INTERACTIVE)   # una richiesta interattiva si unisce alla generazione
+
+        scheduler.release(MODEL)
+        await asyncio.gather(batch, shared)
+        return order, scheduler.info()[0]
+
+    order, info = asyncio.run(scenario())
+    assert order == ["shared", "batch"]
+    assert info["inflight"] == 0 and info["queued"] == {}
+
+
+def test_joined_claim_extends_deadline():
+    async def scenario(extend):
+        scheduler = LLMScheduler(max_concurrency=1)
+        await scheduler.acquire(MODEL)
+        claim = Claim(PRIORITY_INTERACTIVE, time.monotonic() + 0.1)
+        task = asyncio.create_task(scheduler.acquire(MODEL, claim=claim))
+        await asyncio.sleep(0)
+        if extend:
+            claim.join(PRIORITY_INTERACTIVE, time.monotonic() + 5)
+        await asyncio.sleep(0.3)
+        scheduler.release(MODEL)
+        await task
+        return scheduler.info()[0]
+
+    assert asyncio.run(scenario(extend=True))["inflight"] == 1
+    with pytest.raises(Overloaded) as exc:
+        asyncio.run(scenario(extend=False))
+    assert exc.value.status == 503
+
+
+def test_cancelled_waiter_does_not_keep_the_slot():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1)
+        await scheduler.acquire(MODEL)
+        task = asyncio.create_task(scheduler.acquire(MODEL, claim=Claim()))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        scheduler.release(MODEL)
+        return scheduler.info()[0]
+
+    assert asyncio.run(scenario())["inflight"] == 0
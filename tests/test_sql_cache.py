@@ -0,0 +1,54 @@
+import json
+import threading
+
+from text_to_sql.sql_cache import SQLCache
+
+MODEL = "gemma3:1b-it-qat"
+BAD_SQL = "SELECT titolo FROM film"
+
+
+def test_discard_removes_entry_served_by_similarity():
+    cache = SQLCache(path=None)
+    cache.put("Quali film ha diretto Christopher Nolan?", MODEL, "fp", BAD_SQL)
+    question = "Dammi i film che ha diretto Christopher Nolan"
+    assert cache.get(question, MODEL, "fp") == (BAD_SQL, "similar")
+
+    cache.discard(question, MODEL, "fp", BAD_SQL)
+    assert cache.get(question, MODEL, "fp") == (None, None)
+    assert cache.get("Quali film ha diretto Christopher Nolan?", MODEL, "fp") == (None, None)
+
+
+def test_discard_keeps_other_models_and_schemas():
+    cache = SQLCache(path=None)
+    cache.put("film di Nolan", MODEL, "fp", BAD_SQL)
+    cache.put("film di Nolan", "altro", "fp", BAD_SQL)
+    cache.put("film di Nolan", MODEL, "fp2", BAD_SQL)
+    cache.discard("film di Nolan", MODEL, "fp", BAD_SQL)
+    assert cache.get("film di Nolan", "altro", "fp") == (BAD_SQL, "exact")
+    assert cache.get("film di Nolan", MODEL, "fp2") == (BAD_SQL, "exact")
+
+
+def test_put_saves_in_background(tmp_path):
+    path = tmp_path / "sql_cache.json"
+    cache = SQLCache(path=str(path), save_interval=3600)
+    cache.put("film di Nolan", MODEL, "fp", BAD_SQL)
+    assert not path.exists()
+
+    cache.flush()
+    assert json.loads(path.read_text(encoding="utf-8")) == [["film di nolan", MODEL, "fp", BAD_SQL]]
+    assert SQLCache(path=str(path)).get("film di Nolan", MODEL, "fp") == (BAD_SQL, "exact")
+
+
+def test_concurrent_saves_leave_no_temp_files(tmp_path):
+    path = tmp_path / "sql_cache.json"
+    cache = SQLCache(path=str(path), save_interval=3600)
+    for i in range(50):
+        cache.put(f"domanda {i}", MODEL, "fp", f"SELECT {i}")
+
+    threads = [threading.Thread(target=cache.save, args=(str(path),)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(json.loads(path.read_text(encoding="utf-8"))) == 50
+    assert [p.name for p in tmp_path.iterdir()] == ["sql_cache.json"]
@@ -0,0 +1,67 @@
+import pytest
+
+from text_to_sql.sql_validator import validate_sql
+
+SCHEMA = {"movies": ["id", "titolo", "anno", "genere", "regista_id"], "registi": ["id", "nome", "eta"]}
+
+
+@pytest.mark.parametrize("sql, code, token", [
+    ("SELECT titolo FROM movies /*!, SLEEP(600) */", "forbidden_function", "SLEEP"),
+    ("SELECT titolo /*! , LOAD_FILE('/etc/passwd') */ FROM movies", "forbidden_function", "LOAD_FILE"),
+    ("SELECT titolo FROM movies LIMIT 5 /*!50000 INTO OUTFILE '/tmp/x' */", "forbidden_keyword", "INTO"),
+    ("SELECT titolo FROM movies /*M! FOR UPDATE */", "forbidden_keyword", "UPDATE"),
+    ("SELECT titolo FROM movies /*M!100000 ; DROP TABLE movies */", "multiple_statements", ";"),
+])
+def test_executable_comments_are_checked_as_code(sql, code, token):
+    check = validate_sql(sql, SCHEMA)
+    assert (check.ok, check.code, check.token) == (False, code, token)
+
+
+def test_executable_comment_must_be_closed():
+    check = validate_sql("SELECT titolo FROM movies /*! WHERE anno > 2000", SCHEMA)
+    assert (check.ok, check.code) == (False, "syntax_error")
+
+
+def test_executable_comment_content_is_validated_against_schema():
+    assert validate_sql("SELECT titolo FROM movies /*! WHERE anno > 2000 */", SCHEMA).ok
+    check = validate_sql("SELECT titolo FROM movies /*! WHERE durata > 90 */", SCHEMA)
+    assert (check.ok, check.code, check.token) == (False, "unknown_column", "durata")
+
+
+def test_plain_comments_are_ignored():
+    assert validate_sql("SELECT titolo FROM movies /* SLEEP(600) */ -- DROP TABLE movies", SCHEMA).ok
+
+
+@pytest.mark.parametrize("expr", [
+    "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP", "CURRENT_USER", "LOCALTIME", "LOCALTIMESTAMP",
+    "UTC_DATE", "UTC_TIME", "UTC_TIMESTAMP",
+])
+def test_functions_without_parentheses_are_not_columns(expr):
+    assert validate_sql(f"SELECT titolo FROM movies WHERE anno = YEAR({expr})", SCHEMA).ok
+    assert validate_sql(f"SELECT titolo, {expr} AS adesso FROM movies", SCHEMA).ok
+
+
+def test_unknown_column_still_rejected():
+    check = validate_sql("SELECT titolo FROM movies WHERE anno = YEAR(data_uscita)", SCHEMA)
+    assert (check.ok, check.code, check.token) == (False, "unknown_column", "data_uscita")
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT titolo FROM movies WHERE anno >= EXTRACT(YEAR FROM CURDATE()) - 10",
+    "SELECT EXTRACT(YEAR FROM NOW())",
+    "SELECT TRIM(LEADING 'The ' FROM titolo) FROM movies",
+    "SELECT titolo FROM movies ORDER BY titolo COLLATE utf8mb4_general_ci",
+    "SELECT CONVERT(titolo USING utf8mb4) FROM movies",
+    "SELECT titolo FROM movies WHERE titolo = _utf8mb4'Inception'",
+    "SELECT titolo FROM movies WHERE titolo LIKE '%Update%'",
+    "SELECT titolo FROM movies WHERE titolo = 'Drop Dead Gorgeous' OR genere = 'delete; insert'",
+])
+def test_valid_read_only_queries_are_accepted(sql):
+    assert validate_sql(sql, SCHEMA).ok
+
+
+def test_from_inside_functions_still_checks_columns():
+    check = validate_sql("SELECT TRIM(LEADING 'The ' FROM durata) FROM movies", SCHEMA)
+    assert (check.ok, check.code, check.token) == (False, "unknown_column", "durata")
+    check = validate_sql("SELECT titolo FROM movies WHERE anno IN (SELECT anno FROM film)", SCHEMA)
+    assert (check.ok, check.code, check.token) == (False, "unknown_table", "film")
@@ -0,0 +1,148 @@
+"""
+Finto server Ollama per test e benchmark senza modelli reali.
+
+Implementa /api/tags e /api/chat (con e senza streaming NDJSON) e risponde
+sempre con la stessa SQL, dopo una latenza configurabile e alla velocità di
+generazione indicata (`chunk_delay` secondi per token, anche senza streaming).
+Può simulare errori (HTTP 500) con una probabilità data.
+
+Uso da riga di comando:
+    python -m text_to_sql.fake_ollama --port 11435 --latency 0.5 --token-rate 40 --fail-rate 0.1
+
+Uso in-process:
+    server, url = start_fake_ollama(latency=0.2)
+    ...
+    server.shutdown()
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+DEFAULT_SQL = "SELECT titolo, anno FROM movies ORDER BY anno DESC LIMIT 10;"
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], models: List[str], latency: float = 0.0,
+                 fail_rate: float = 0.0, sql: str = DEFAULT_SQL, chunk_delay: float = 0.0):
+        super().__init__(address, _Handler)
+        self.models = models
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.sql = sql
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeOllamaServer
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/api/tags":
+            self._json(200, {"models": [{"name": m, "model": m} for m in self.server.models]})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/api/chat":
+            self._json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        srv = self.server
+        with srv._lock:
+            srv.requests += 1
+            srv.inflight += 1
+            srv.max_inflight = max(srv.max_inflight, srv.inflight)
+        try:
+            model = payload.get("model")
+            if model not in srv.models:
+                self._json(404, {"error": f"model '{model}' not found"})
+                return
+            time.sleep(srv.latency)
+            if srv.fail_rate and random.random() < srv.fail_rate:
+                self._json(500, {"error": "fake failure"})
+                return
+            tokens = srv.sql.split(" ")
+            prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", [])) // 4
+            eval_seconds = len(tokens) * srv.chunk_delay
+            final = {"model": model, "done": True, "prompt_eval_count": prompt_tokens,
+                     "eval_count": len(tokens), "prompt_eval_duration": int(srv.latency * 1e9),
+                     "eval_duration": int(eval_seconds * 1e9),
+                     "total_duration": int((srv.latency + eval_seconds) * 1e9)}
+            if not payload.get("stream", True):
+                time.sleep(eval_seconds)
+                self._json(200, {**final, "message": {"role": "assistant", "content": srv.sql}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for token in tokens:
+                chunk = {"model": model, "done": False, "message": {"role": "assistant", "content": token + " "}}
+                self.wfile.write((json.dumps(chunk) + "\n").encode())
+                self.wfile.flush()
+                time.sleep(srv.chunk_delay)
+            self.wfile.write((json.dumps({**final, "message": {"role": "assistant", "content": ""}}) + "\n").encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # il client ha chiuso lo stream (stop anticipato)
+        finally:
+            with srv._lock:
+                srv.inflight -= 1
+
+
+def start_fake_ollama(host: str = "127.0.0.1", port: int = 0, models: Optional[List[str]] = None,
+                      **kwargs) -> Tuple[FakeOllamaServer, str]:
+    """
+    Avvia il finto server in un thread. Restituisce (server, url base).
+    """
+    server = FakeOllamaServer((host, port), models or ["gemma3:1b-it-qat", "gemma3:1b-it-q4_K_M"], **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.url
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", default="gemma3:1b-it-qat,gemma3:1b-it-q4_K_M")
+    parser.add_argument("--latency", type=float, default=0.0, help="secondi prima della risposta")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="secondi per token generato")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="token/s generati (alternativa a --chunk-delay)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="probabilità di HTTP 500")
+    parser.add_argument("--sql", default=DEFAULT_SQL)
+    args = parser.parse_args()
+    if args.token_rate > 0:
+        args.chunk_delay = 1 / args.token_rate
+
+    server = FakeOllamaServer((args.host, args.port), args.models.split(","), latency=args.latency,
+                              fail_rate=args.fail_rate, sql=args.sql, chunk_delay=args.chunk_delay)
+    print(f"[DEBUG] Finto Ollama in ascolto su {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Endpoint Ollama separati da virgola (default: OLLAMA_HOST)
+OLLAMA_HOSTS = os.getenv("OLLAMA_HOSTS") or os.getenv("OLLAMA_HOST", "http://ollama:11434")
+# Richieste contemporanee massime per endpoint
+OLLAMA_ENDPOINT_MAX_INFLIGHT = int(os.getenv("OLLAMA_ENDPOINT_MAX_INFLIGHT", "4"))
+# Circuit breaker: errori consecutivi prima dell'esclusione e secondi di esclusione
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))
+OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "30"))
+# Intervallo di aggiornamento dei modelli disponibili (/api/tags)
+OLLAMA_TAGS_INTERVAL = float(os.getenv("OLLAMA_TAGS_INTERVAL", "60"))
+# Dopo quanti secondi senza risposta inviare una richiesta duplicata a un altro endpoint (0 = mai)
+OLLAMA_HEDGE_AFTER = float(os.getenv("OLLAMA_HEDGE_AFTER", "15"))
+
+
+class NoEndpointAvailable(Exception):
+    """
+    Nessun endpoint Ollama può servire la richiesta (tutti esclusi o saturi).
+    """
+
+
+class EndpointError(Exception):
+    """
+    Errore di un endpoint che conta per il circuit breaker (rete, timeout, 5xx).
+    """
+
+
+class Endpoint:
+    """
+    Stato di un endpoint Ollama: richieste in corso, modelli disponibili e
+    circuit breaker ("closed" -> "open" dopo `max_failures` errori consecutivi,
+    "half_open" dopo `cooldown` secondi: una sola richiesta di prova).
+    """
+
+    def __init__(self, url: str, max_inflight: int, max_failures: int, cooldown: float):
+        self.url = url.rstrip("/")
+        self.max_inflight = max(1, max_inflight)
+        self.max_failures = max(1, max_failures)
+        self.cooldown = cooldown
+
+        self.inflight = 0
+        self.models: Optional[Set[str]] = None      # None = non ancora noti
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_inflight = False
+        self.stats = {"requests": 0, "errors": 0, "hedges": 0, "ejections": 0}
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    def allows(self, now: float) -> bool:
+        if self.state == "open" and now - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.probe_inflight
+        return self.state == "closed"
+
+    def info(self) -> Dict:
+        return {
+            "url": self.url,
+            "state": self.state,
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "models": sorted(self.models) if self.models is not None else None,
+            **self.stats,
+        }
+
+
+class OllamaPool:
+    """
+    Pool lato client di endpoint Ollama.
+
+    - instradamento least-outstanding-requests tra gli endpoint sani che
+      hanno il modello richiesto (da /api/tags);
+    - limite di richieste contemporanee per endpoint: oltre il limite le
+      richieste asincrone attendono che un posto si liberi;
+    - circuit breaker per endpoint;
+    - hedging: se la risposta tarda più di `hedge_after` secondi la stessa
+      richiesta parte su un secondo endpoint e vince la prima risposta.
+    """
+
+    def __init__(self, urls: Iterable[str], max_inflight: int = OLLAMA_ENDPOINT_MAX_INFLIGHT,
+                 max_failures: int = OLLAMA_BREAKER_FAILURES, cooldown: float = OLLAMA_BREAKER_COOLDOWN,
+                 tags_interval: float = OLLAMA_TAGS_INTERVAL, hedge_after: float = OLLAMA_HEDGE_AFTER):
+        self.endpoints = [Endpoint(u.strip(), max_inflight, max_failures, cooldown) for u in urls if u.strip()]
+        if not self.endpoints:
+            raise ValueError("Nessun endpoint Ollama configurato")
+        self.tags_interval = tags_interval
+        self.hedge_after = hedge_after
+
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._next = 0
+        self._tags_at = 0.0
+        self._tags_task: Optional[asyncio.Task] = None
+
+    # ---------------- selezione ----------------
+
+    def _try_acquire(self, model: str, exclude: Iterable[Endpoint] = (), force: bool = False
+                     ) -> Tuple[Optional[Endpoint], str]:
+        """
+        Sceglie e occupa l'endpoint meno carico. Restituisce (endpoint, "") oppure
+        (None, "busy") se tutti i candidati sono al limite, (None, "unavailable")
+        se non ci sono candidati. Con `force` il limite per endpoint è ignorato.
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [ep for ep in self.endpoints if ep not in exclude and ep.allows(now)]
+            candidates = [ep for ep in healthy if ep.serves(model)] or healthy
+            if not candidates:
+                return None, "unavailable"
+            free = [ep for ep in candidates if force or ep.inflight < ep.max_inflight]
+            if not free:
+                return None, "busy"
+            # a parità di carico si ruota il punto di partenza
+            start = self._next % len(free)
+            self._next += 1
+            ep = min(free[start:] + free[:start], key=lambda e: e.inflight)
+            ep.inflight += 1
+            ep.stats["requests"] += 1
+            if ep.state == "half_open":
+                ep.probe_inflight = True
+            return ep, ""
+
+    def acquire_nowait(self, model: str) -> Endpoint:
+        """
+        Versione sincrona: non attende, al limite usa comunque l'endpoint meno carico.
+        """
+        ep, reason = self._try_acquire(model, force=True)
+        if ep is None:
+            raise NoEndpointAvailable(f"Nessun endpoint Ollama disponibile per {model}")
+        return ep
+
+    @contextmanager
+    def endpoint(self, model: str) -> Iterator[Endpoint]:
+        """
+        Occupa un endpoint per una richiesta sincrona (senza attesa né hedging):
+        un EndpointError sollevato nel blocco conta per il circuit breaker.
+        """
+        ep = self.acquire_nowait(model)
+        ok = True
+        try:
+            yield ep
+        except EndpointError:
+            ok = False
+            raise
+        finally:
+            self.release(ep, ok=ok)
+
+    async def acquire(self, model: str, exclude: Iterable[Endpoint] = (), timeout: Optional[float] = None,
+                      wait: bool = True) -> Optional[Endpoint]:
+        """
+        Occupa un endpoint per `model`, attendendo se tutti sono al limite.
+        Con `wait=False` restituisce None invece di attendere.
+        """
+        self._maybe_refresh_tags()
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            ep, reason = self._try_acquire(model, exclude)
+            if ep is not None:
+                return ep
+            if reason == "unavailable":
+                if not wait:
+                    return None
+                raise NoEndpointAvailable(f"Nessun endpoint Ollama disponibile per {model}")
+            if not wait:
+                return None
+
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            with self._lock:
+                self._waiters.append((loop, fut))
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                await asyncio.wait_for(fut, timeout=remaining)
+            except asyncio.TimeoutError:
+                raise NoEndpointAvailable(f"Endpoint Ollama saturi per {model}")
+            finally:
+                with self._lock:
+                    if (loop, fut) in self._waiters:
+                        self._waiters.remove((loop, fut))
+
+    def release(self, ep: Endpoint, ok: Optional[bool] = True) -> None:
+        """
+        Libera il posto occupato e aggiorna il circuit breaker con l'esito
+        (`ok=None`: richiesta annullata, esito ignoto).
+        """
+        with self._lock:
+            ep.inflight -= 1
+            if ep.state == "half_open":
+                ep.probe_inflight = False
+            if ok:
+                ep.failures = 0
+                ep.state = "closed"
+            elif ok is not None:
+                self._record_failure(ep)
+            waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_wake, fut)
+
+    def _record_failure(self, ep: Endpoint) -> None:
+        ep.failures += 1
+        ep.stats["errors"] += 1
+        if ep.state == "half_open" or ep.failures >= ep.max_failures:
+            if ep.state != "open":
+                ep.stats["ejections"] += 1
+                print(f"[DEBUG] Endpoint Ollama escluso: {ep.url} ({ep.failures} errori)")
+            ep.state = "open"
+            ep.opened_at = time.monotonic()
+
+    # ---------------- modelli disponibili ----------------
+
+    def _maybe_refresh_tags(self) -> None:
+        if time.monotonic() - self._tags_at < self.tags_interval:
+            return
+        if self._tags_task is None or self._tags_task.done():
+            self._tags_at = time.monotonic()
+            self._tags_task = asyncio.get_running_loop().create_task(self.refresh_tags())
+
+    async def refresh_tags(self, client=None) -> None:
+        """
+        Legge /api/tags da ogni endpoint: aggiorna i modelli disponibili e fa da
+        controllo di salute (un endpoint che risponde torna "closed").
+        """
+        if client is None:
+            from .text_to_sql import get_async_client
+            client = get_async_client()
+
+        async def _one(ep: Endpoint) -> None:
+            try:
+                resp = await client.get(f"{ep.url}/api/tags", timeout=5)
+                resp.raise_for_status()
+                models = {m.get("name") or m.get("model") for m in resp.json().get("models", [])}
+                with self._lock:
+                    ep.models = {m for m in models if m}
+                    if ep.state == "open":
+                        # risponde di nuovo: ammessa subito una richiesta di prova
+                        ep.state = "half_open"
+            except Exception as e:
+                with self._lock:
+                    self._record_failure(ep)
+                print(f"[DEBUG] /api/tags non disponibile su {ep.url}: {e}")
+
+        self._tags_at = time.monotonic()
+        await asyncio.gather(*(_one(ep) for ep in self.endpoints))
+
+    def forget_model(self, url: str, model: str) -> None:
+        """
+        Segna che l'endpoint non ha il modello (es. risposta 404).
+        """
+        with self._lock:
+            for ep in self.endpoints:
+                if ep.url == url.rstrip("/"):
+                    ep.models = (ep.models or set()) - {model}
+
+    # ---------------- richieste ----------------
+
+    async def request(self, model: str, send: Callable[[str], Awaitable[T]],
+                      hedge_after: Optional[float] = None, timeout: Optional[float] = None) -> T:
+        """
+        Esegue `send(url_endpoint)` sull'endpoint scelto, con hedging.
+        `send` deve sollevare EndpointError per gli errori dell'endpoint: in quel
+        caso la richiesta è ripetuta una volta su un altro endpoint.
+        Restituisce il primo risultato riuscito; se tutti i tentativi falliscono
+        rilancia l'ultimo errore.
+        """
+        hedge_after = self.hedge_after if hedge_after is None else hedge_after
+        primary = await self.acquire(model, timeout=timeout)
+        attempts: Dict[asyncio.Future, Endpoint] = {asyncio.ensure_future(send(primary.url)): primary}
+        tried = [primary]
+        hedged = failed_over = False
+        error: Optional[BaseException] = None
+
+        async def _spare(wait: bool) -> Optional[Endpoint]:
+            try:
+                ep = await self.acquire(model, exclude=tried, timeout=timeout, wait=wait)
+            except NoEndpointAvailable:
+                return None
+            if ep is not None:
+                tried.append(ep)
+                attempts[asyncio.ensure_future(send(ep.url))] = ep
+            return ep
+
+        try:
+            while attempts:
+                wait_for = hedge_after if (hedge_after > 0 and not hedged) else None
+                done, _ = await asyncio.wait(attempts, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # nessuna risposta entro hedge_after: duplica su un altro endpoint, se libero
+                    hedged = True
+                    backup = await _spare(wait=False)
+                    if backup is not None:
+                        backup.stats["hedges"] += 1
+                    continue
+                for task in done:
+                    ep = attempts.pop(task)
+                    if task.exception() is None:
+                        self.release(ep, ok=True)
+                        return task.result()
+                    error = task.exception()
+                    endpoint_error = isinstance(error, EndpointError)
+                    self.release(ep, ok=not endpoint_error)
+                    if endpoint_error and not attempts and not failed_over:
+                        failed_over = True
+                        await _spare(wait=True)
+            raise error
+        finally:
+            for task, ep in attempts.items():
+                task.cancel()
+                self.release(ep, ok=None)
+
+    def info(self) -> List[Dict]:
+        """
+        Stato di ogni endpoint (carico, modelli, circuit breaker, contatori).
+        """
+        now = time.monotonic()
+        with self._lock:
+            for ep in self.endpoints:
+                ep.allows(now)
+            return [ep.info() for ep in self.endpoints]
+
+
+def _wake(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+ollama_pool = OllamaPool(OLLAMA_HOSTS.split(","))
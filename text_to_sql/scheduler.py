@@ -0,0 +1,288 @@
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+from db_utils.metrics import REGISTRY
+from .ollama_pool import ollama_pool
+
+T = TypeVar("T")
+
+# Priorità (valori più bassi prima): richieste interattive prima dei batch,
+# e a parità di classe i primi tentativi prima dei retry
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 2
+RETRY_PENALTY = 1
+PRIORITY_NAMES = {0: "interactive", 1: "interactive_retry", 2: "batch", 3: "batch_retry"}
+
+# Generazioni contemporanee per modello (0 = capacità del pool: somma dei posti degli endpoint)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "0"))
+# Override per modello: '{"gemma3:1b-it-qat": 8}'
+LLM_MODEL_CONCURRENCY = json.loads(os.getenv("LLM_MODEL_CONCURRENCY") or "{}")
+# Richieste in attesa per modello oltre le quali si rifiuta (429)
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "64"))
+# Scadenza di default (secondi) per ottenere e completare una generazione
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "90"))
+
+_QUEUE_WAIT = REGISTRY.histogram("llm_queue_wait_seconds", "Attesa nella coda dello scheduler LLM",
+                                 ["model", "priority"])
+_SHED = REGISTRY.counter("llm_shed_total", "Richieste LLM rifiutate dallo scheduler", ["model", "reason"])
+_QUEUE_DEPTH = REGISTRY.gauge("llm_queue_depth", "Richieste LLM in coda", ["model", "priority"])
+_INFLIGHT = REGISTRY.gauge("llm_inflight", "Generazioni LLM in corso", ["model"])
+_LIMIT = REGISTRY.gauge("llm_concurrency_limit", "Generazioni LLM contemporanee ammesse", ["model"])
+
+
+class Overloaded(Exception):
+    """
+    Richiesta rifiutata dallo scheduler: coda piena (status 429) oppure
+    scadenza non rispettabile (status 503). `retry_after` in secondi.
+    """
+
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Stale:
+    # segnaposto di una voce di coda sostituita (priorità alzata): non conta più
+    @staticmethod
+    def done() -> bool:
+        return True
+
+
+class Claim:
+    """
+    Priorità e scadenza di una generazione condivisa da più richieste (single-flight).
+    Chi si unisce con join() può alzarne la priorità, anche mentre è in coda,
+    e prolungarne la scadenza: non attende alla priorità né rischia lo scarto
+    per la scadenza della richiesta che ha avviato la generazione.
+    """
+
+    def __init__(self, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None):
+        self.priority = priority
+        self.deadline = deadline if deadline is not None else time.monotonic() + LLM_DEADLINE
+        self._queue: Optional["_ModelQueue"] = None
+        self._entry: Optional[list] = None   # voce in coda, finché la generazione attende un posto
+
+    def join(self, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None) -> None:
+        self.deadline = max(self.deadline, deadline if deadline is not None else time.monotonic() + LLM_DEADLINE)
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        if self._entry is not None and not self._entry[2].done():
+            # nuova voce con la stessa sequenza (resta l'ordine di arrivo), la vecchia è ignorata
+            entry, self._entry = self._entry, [priority, self._entry[1], self._entry[2]]
+            entry[2] = _Stale()
+            heapq.heappush(self._queue.waiting, self._entry)
+
+
+class _ModelQueue:
+    """
+    Coda di priorità e posti di generazione di un modello.
+    I posti liberati passano direttamente al primo in attesa (priorità, poi ordine di arrivo).
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.inflight = 0
+        self.service_time: Optional[float] = None   # media mobile della durata di una generazione
+        self.waiting: List[list] = []               # heap di [priorità, sequenza, future]
+        self.stats = {"admitted": 0, "queued_total": 0, "shed_queue_full": 0, "shed_deadline": 0, "preempted": 0}
+
+    def live(self) -> List[list]:
+        return [e for e in self.waiting if not e[2].done()]
+
+    def estimate_wait(self, priority: int, limit: int) -> float:
+        # tempo stimato prima di ottenere un posto: richieste davanti / posti * durata media
+        if self.service_time is None:
+            return 0.0
+        ahead = sum(1 for e in self.live() if e[0] <= priority)
+        return (ahead // limit + 1) * self.service_time if self.inflight >= limit else 0.0
+
+
+class LLMScheduler:
+    """
+    Controllo di ammissione davanti al client LLM.
+
+    - al più `limit` generazioni contemporanee per modello (vedi LLM_MAX_CONCURRENCY);
+    - oltre il limite le richieste attendono in una coda di priorità
+      (PRIORITY_INTERACTIVE prima di PRIORITY_BATCH, retry dopo i primi tentativi);
+    - coda piena: una nuova richiesta più prioritaria scavalca l'ultima in coda
+      di priorità inferiore, altrimenti è rifiutata subito (429);
+    - scadenze: una richiesta che secondo la durata media delle generazioni
+      non può terminare entro la sua scadenza è rifiutata subito, o appena
+      l'attesa in coda la rende irrealizzabile (503).
+
+    Va usato da un solo event loop (il backend).
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, queue_max: int = LLM_QUEUE_MAX,
+                 deadline: float = LLM_DEADLINE):
+        self.max_concurrency = max_concurrency
+        self.queue_max = max(0, queue_max)
+        self.deadline = deadline
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+
+    def limit(self, model: str) -> int:
+        """
+        Generazioni contemporanee ammesse per `model`.
+        """
+        limit = LLM_MODEL_CONCURRENCY.get(model) or self.max_concurrency
+        if not limit:
+            limit = sum(ep.max_inflight for ep in ollama_pool.endpoints if ep.serves(model))
+        return max(1, limit)
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(model)
+        return self._queues[model]
+
+    def _shed(self, q: _ModelQueue, reason: str, status: int, message: str, limit: int) -> Overloaded:
+        q.stats[f"shed_{reason}"] += 1
+        _SHED.inc(model=q.model, reason=reason)
+        backlog = len(q.live()) / limit + 1
+        retry_after = max(1, math.ceil(backlog * (q.service_time or 1)))
+        print(f"[DEBUG] Scheduler LLM: richiesta rifiutata ({reason}) per {q.model}")
+        return Overloaded(message, status, retry_after)
+
+    async def acquire(self, model: str, priority: int = PRIORITY_INTERACTIVE,
+                      deadline: Optional[float] = None, claim: Optional[Claim] = None) -> None:
+        """
+        Ottiene un posto di generazione per `model` (da restituire con release).
+        `deadline` è un istante di time.monotonic(); default: ora + LLM_DEADLINE.
+        Con `claim` priorità e scadenza sono le sue, aggiornate durante l'attesa.
+        Solleva Overloaded se la richiesta va scartata.
+        """
+        q = self._queue(model)
+        limit = self.limit(model)
+        if claim is not None:
+            priority, deadline = claim.priority, claim.deadline
+        deadline = deadline if deadline is not None else time.monotonic() + self.deadline
+        if q.inflight < limit and not q.live():
+            q.inflight += 1
+            q.stats["admitted"] += 1
+            _QUEUE_WAIT.observe(0, model=model, priority=PRIORITY_NAMES.get(priority, str(priority)))
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining - q.estimate_wait(priority, limit) - (q.service_time or 0) <= 0:
+            raise self._shed(q, "deadline", 503, "Generazione SQL non completabile entro la scadenza", limit)
+
+        live = q.live()
+        if len(live) >= self.queue_max:
+            worst = max(live, key=lambda e: (e[0], e[1]), default=None)
+            if worst is None or worst[0] <= priority:
+                raise self._shed(q, "queue_full", 429, "Troppe richieste in coda per il modello", limit)
+            # scavalca la richiesta meno prioritaria (e più recente) in coda
+            q.stats["preempted"] += 1
+            worst[2].set_exception(self._shed(q, "queue_full", 429, "Richiesta scavalcata da una più prioritaria",
+                                              limit))
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), fut]
+        heapq.heappush(q.waiting, entry)
+        q.stats["queued_total"] += 1
+        queued_at = time.monotonic()
+        if claim is not None:
+            claim._queue, claim._entry = q, entry
+        try:
+            while True:
+                # inutile attendere oltre l'ultimo istante utile per iniziare la generazione
+                # (con un claim la scadenza può essere prolungata durante l'attesa)
+                last_start = (claim.deadline if claim is not None else deadline) - (q.service_time or 0)
+                done, _ = await asyncio.wait({fut}, timeout=max(0.0, last_start - time.monotonic()))
+                if done:
+                    fut.result()   # Overloaded se scavalcata da una richiesta più prioritaria
+                    break
+                if claim is None or claim.deadline - (q.service_time or 0) <= time.monotonic():
+                    fut.cancel()
+                    raise self._shed(q, "deadline", 503, "Scadenza raggiunta in coda prima della generazione SQL",
+                                     limit)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release(model)   # il posto era già stato assegnato
+            fut.cancel()
+            raise
+        finally:
+            if claim is not None:
+                claim._queue, claim._entry = None, None
+            self._compact(q)
+        q.stats["admitted"] += 1
+        _QUEUE_WAIT.observe(time.monotonic() - queued_at, model=model,
+                            priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def release(self, model: str, service_time: Optional[float] = None) -> None:
+        """
+        Restituisce un posto: passa al primo in attesa oppure torna libero.
+        `service_time` (durata della generazione) aggiorna la media usata per le scadenze.
+        """
+        q = self._queue(model)
+        if service_time is not None:
+            q.service_time = service_time if q.service_time is None else 0.8 * q.service_time + 0.2 * service_time
+        while q.waiting:
+            _, _, fut = heapq.heappop(q.waiting)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        q.inflight = max(0, q.inflight - 1)
+
+    @staticmethod
+    def _compact(q: _ModelQueue) -> None:
+        # rimuove dalla coda le attese concluse (scadute, annullate, scavalcate)
+        if len(q.waiting) > 2 * len(q.live()) + 8:
+            q.waiting = q.live()
+            heapq.heapify(q.waiting)
+
+    async def run(self, model: str, factory: Callable[[], Awaitable[T]], priority: int = PRIORITY_INTERACTIVE,
+                  deadline: Optional[float] = None, claim: Optional[Claim] = None) -> T:
+        """
+        Esegue `factory()` (una chiamata a Ollama) occupando un posto di generazione per `model`.
+        """
+        await self.acquire(model, priority, deadline, claim)
+        started = time.monotonic()
+        try:
+            result = await factory()
+        except BaseException:
+            self.release(model)
+            raise
+        self.release(model, time.monotonic() - started)
+        return result
+
+    def info(self) -> List[Dict]:
+        """
+        Stato delle code per modello (posti occupati, richieste in attesa per priorità, contatori).
+        """
+        report = []
+        for model, q in self._queues.items():
+            depth: Dict[str, int] = {}
+            for e in q.live():
+                name = PRIORITY_NAMES.get(e[0], str(e[0]))
+                depth[name] = depth.get(name, 0) + 1
+            report.append({
+                "model": model,
+                "inflight": q.inflight,
+                "limit": self.limit(model),
+                "queued": depth,
+                "service_time": round(q.service_time, 3) if q.service_time is not None else None,
+                **q.stats,
+            })
+        return report
+
+
+llm_scheduler = LLMScheduler()
+
+
+def _collect_metrics() -> None:
+    for entry in llm_scheduler.info():
+        _INFLIGHT.set(entry["inflight"], model=entry["model"])
+        _LIMIT.set(entry["limit"], model=entry["model"])
+        for name in PRIORITY_NAMES.values():
+            _QUEUE_DEPTH.set(entry["queued"].get(name, 0), model=entry["model"], priority=name)
+
+
+REGISTRY.register_collector(_collect_metrics)
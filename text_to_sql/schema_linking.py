@@ -0,0 +1,201 @@
+import os
+import json
+import math
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from .sql_cache import normalize_question
+
+
+SCHEMA_PRUNING = os.getenv("SCHEMA_PRUNING", "1").lower() in ("1", "true", "yes")
+# Budget (token stimati) per la parte di schema nel prompt (0 = nessun limite)
+SCHEMA_MAX_TOKENS = int(os.getenv("SCHEMA_MAX_TOKENS", "0"))
+
+# parole della domanda che indicano una tabella senza somigliarle nel nome
+# (estendibile con SCHEMA_SYNONYMS='{"parola": ["tabella", ...]}')
+_SYNONYMS: Dict[str, List[str]] = {
+    "film": ["movies"], "pellicola": ["movies"], "pellicole": ["movies"],
+    "diretto": ["registi"], "diretti": ["registi"], "autore": ["registi"], "autori": ["registi"],
+    "streaming": ["piattaforme"], "disponibile": ["piattaforme"], "disponibili": ["piattaforme"],
+}
+_SYNONYMS.update(json.loads(os.getenv("SCHEMA_SYNONYMS") or "{}"))
+
+ForeignKey = Tuple[str, str, str, str]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Stima dei token di un testo (circa 4 caratteri per token, come per i tokenizer BPE).
+    """
+    return math.ceil(len(text) / 4)
+
+
+def _parts(identifier: str) -> List[str]:
+    # "piattaforma_1_id" -> ["piattaforma", "id"]
+    return [p for p in normalize_question(identifier.replace("_", " ")).split() if not p.isdigit()]
+
+
+def _similar(word: str, part: str) -> bool:
+    # uguali, o con radice comune (registi/regista, piattaforma/piattaforme, genere/generi)
+    if word == part:
+        return True
+    common = 0
+    for a, b in zip(word, part):
+        if a != b:
+            break
+        common += 1
+    return common >= max(4, min(len(word), len(part)) - 2)
+
+
+def _contains_value(norm_question: str, words: Set[str], value: str) -> bool:
+    norm_value = normalize_question(value)
+    if len(norm_value) < 3:
+        return False
+    if " " not in norm_value:
+        return any(_similar(w, norm_value) for w in words)
+    return f" {norm_value} " in f" {norm_question} "
+
+
+def link_schema(question: str, tables: Dict[str, List[str]], foreign_keys: Sequence[ForeignKey] = (),
+                samples: Optional[Dict[Tuple[str, str], List[str]]] = None) -> Dict[str, Dict]:
+    """
+    Tabelle dello schema collegate lessicalmente alla domanda.
+    Una tabella è collegata se la domanda ne cita il nome (o un sinonimo),
+    il nome di una colonna, o un valore campione di una sua colonna.
+    Le colonne chiave esterna non contano: indicano la tabella referenziata,
+    che arriva comunque con i join.
+    Restituisce {tabella: {"score", "columns": colonne citate, "values": {colonna: [valori]}}}.
+    """
+    norm_question = normalize_question(question)
+    words = set(norm_question.split())
+    fk_columns = {(table, column) for table, column, _, _ in foreign_keys}
+    links: Dict[str, Dict] = {}
+
+    def _link(table: str, score: int) -> Dict:
+        entry = links.setdefault(table, {"score": 0, "columns": set(), "values": defaultdict(list)})
+        entry["score"] += score
+        return entry
+
+    for word in words:
+        for table in _SYNONYMS.get(word, ()):
+            if table in tables:
+                _link(table, 3)
+
+    for table, columns in tables.items():
+        if any(_similar(w, p) for p in _parts(table) for w in words):
+            _link(table, 3)
+        for column in columns:
+            if (table, column) in fk_columns:
+                continue
+            if any(_similar(w, p) for p in _parts(column) if p != "id" for w in words):
+                _link(table, 2)["columns"].add(column)
+
+    for (table, column), values in (samples or {}).items():
+        if table not in tables:
+            continue
+        for value in values:
+            if _contains_value(norm_question, words, value):
+                entry = _link(table, 3)
+                entry["columns"].add(column)
+                entry["values"][column].append(value)
+
+    return links
+
+
+def join_closure(seeds: Iterable[str], foreign_keys: Sequence[ForeignKey]) -> Set[str]:
+    """
+    Tabelle necessarie per collegare le tabelle `seeds`: aggiunge i percorsi di
+    join più brevi (grafo delle chiavi esterne) e le tabelle referenziate
+    direttamente dalle tabelle scelte (es. movies -> registi, piattaforme).
+    """
+    graph: Dict[str, Set[str]] = defaultdict(set)
+    for table, _, ref_table, _ in foreign_keys:
+        graph[table].add(ref_table)
+        graph[ref_table].add(table)
+
+    seeds = list(dict.fromkeys(seeds))
+    selected: Set[str] = set(seeds[:1])
+    for seed in seeds[1:]:
+        if seed in selected:
+            continue
+        # BFS dall'insieme già scelto fino al nuovo seed
+        parent = {t: None for t in selected}
+        queue = deque(selected)
+        while queue:
+            node = queue.popleft()
+            if node == seed:
+                break
+            for nxt in graph[node]:
+                if nxt not in parent:
+                    parent[nxt] = node
+                    queue.append(nxt)
+        node = seed if seed in parent else None
+        selected.add(seed)
+        while node is not None:
+            selected.add(node)
+            node = parent[node]
+
+    for table, _, ref_table, _ in foreign_keys:
+        if table in selected:
+            selected.add(ref_table)
+    return selected
+
+
+def render_schema(tables: Dict[str, List[str]], foreign_keys: Sequence[ForeignKey] = (),
+                  values: Optional[Dict[Tuple[str, str], List[str]]] = None) -> str:
+    """
+    Testo dello schema per il prompt: una riga TABLE per tabella, poi i join
+    tra le tabelle presenti e i valori citati nella domanda.
+    """
+    lines = [f"TABLE {t}({', '.join(tables[t])});" for t in sorted(tables)]
+    for table, column, ref_table, ref_column in foreign_keys:
+        if table in tables and ref_table in tables:
+            lines.append(f"-- JOIN {table}.{column} = {ref_table}.{ref_column}")
+    for (table, column), vals in sorted((values or {}).items()):
+        if table in tables:
+            lines.append(f"-- VALORI {table}.{column}: " + ", ".join("'" + v.replace("'", "''") + "'" for v in vals))
+    return "\n".join(lines)
+
+
+def prune_schema(question: str, tables: Dict[str, List[str]], foreign_keys: Sequence[ForeignKey] = (),
+                 samples: Optional[Dict[Tuple[str, str], List[str]]] = None,
+                 max_tokens: int = SCHEMA_MAX_TOKENS) -> str:
+    """
+    Schema ridotto alle tabelle rilevanti per la domanda (schema linking).
+    Senza tabelle collegate si usa lo schema completo. Con `max_tokens` > 0,
+    se il testo supera il budget si tengono solo le colonne di join e quelle
+    citate delle tabelle meno rilevanti, poi si scartano le tabelle collegate
+    con punteggio più basso (il budget è rispettato al meglio possibile).
+    """
+    links = link_schema(question, tables, foreign_keys, samples)
+    ranked = sorted(links, key=lambda t: (-links[t]["score"], t))
+    selected = join_closure(ranked, foreign_keys) if ranked else set(tables)
+
+    key_columns = defaultdict(set)
+    for table, column, ref_table, ref_column in foreign_keys:
+        key_columns[table].add(column)
+        key_columns[ref_table].add(ref_column)
+    values = {(t, c): v for t in links for c, v in links[t]["values"].items()}
+
+    current = {t: list(tables[t]) for t in selected}
+    text = render_schema(current, foreign_keys, values)
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+
+    # meno rilevanti prima: tabelle aggiunte solo per i join, poi per punteggio crescente
+    by_relevance = sorted(selected, key=lambda t: (links.get(t, {}).get("score", 0), t))
+    for table in by_relevance:
+        keep = key_columns[table] | links.get(table, {}).get("columns", set())
+        current[table] = [c for c in tables[table] if c in keep] or tables[table][:1]
+        text = render_schema(current, foreign_keys, values)
+        if estimate_tokens(text) <= max_tokens:
+            return text
+
+    # poi si scartano le tabelle collegate meno rilevanti, mantenendo i join tra le restanti
+    seeds = list(ranked)
+    while len(seeds) > 1:
+        seeds.pop()
+        kept = join_closure(seeds, foreign_keys)
+        text = render_schema({t: current.get(t, tables[t]) for t in kept}, foreign_keys, values)
+        if estimate_tokens(text) <= max_tokens:
+            break
+    return text
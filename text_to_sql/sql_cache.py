@@ -0,0 +1,241 @@
+import os
+import re
+import json
+import math
+import atexit
+import tempfile
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+SQL_CACHE_EXACT_SIZE = int(os.getenv("SQL_CACHE_EXACT_SIZE", "1024"))
+SQL_CACHE_SIMILAR_SIZE = int(os.getenv("SQL_CACHE_SIMILAR_SIZE", "512"))
+SQL_CACHE_THRESHOLD = float(os.getenv("SQL_CACHE_THRESHOLD", "0.9"))
+SQL_CACHE_PATH = os.getenv("SQL_CACHE_PATH") or None
+# Ogni quanti secondi le modifiche alla cache sono salvate su SQL_CACHE_PATH
+SQL_CACHE_SAVE_INTERVAL = float(os.getenv("SQL_CACHE_SAVE_INTERVAL", "30"))
+
+# parole che non cambiano il significato della domanda ("i film di Nolan" ~ "film di Nolan")
+_STOPWORDS = {"il", "lo", "la", "i", "gli", "le", "un", "uno", "una", "e", "ed",
+              "mi", "ci", "per", "favore", "quali", "sono", "dammi", "mostra", "elenca"}
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizza una domanda: minuscolo, senza accenti né punteggiatura, spazi compattati.
+    """
+    s = unicodedata.normalize("NFKD", question.lower())
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    s = re.sub(r"[^\w\s]", " ", s)
+    return " ".join(s.split())
+
+
+def _vectorize(norm_question: str) -> Tuple[Dict[str, int], float]:
+    """
+    Vettore sparso di trigrammi di caratteri (parole non stopword) e relativa norma.
+    """
+    words = [w for w in norm_question.split() if w not in _STOPWORDS]
+    text = f" {' '.join(words)} "
+    vec = Counter(text[i:i + 3] for i in range(len(text) - 2))
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    return dict(vec), norm
+
+
+def _numbers(norm_question: str) -> Tuple[str, ...]:
+    # anni/quantità diversi => domanda diversa, anche se il testo è quasi uguale
+    return tuple(re.findall(r"\d+", norm_question))
+
+
+class SQLCache:
+    """
+    Cache domanda -> SQL a due livelli.
+
+    1. esatto: LRU con chiave (domanda normalizzata, modello, fingerprint schema);
+    2. similarità: LRU separata su vettori di trigrammi; restituisce la SQL
+       della domanda più simile se il coseno supera `threshold` (e i numeri
+       presenti nelle due domande coincidono).
+
+    Se `path` è impostato la cache viene caricata all'avvio e, se modificata,
+    salvata su file JSON in background ogni `save_interval` secondi e
+    all'uscita del processo (gli inserimenti non scrivono su disco).
+    """
+
+    def __init__(self, exact_size: int = SQL_CACHE_EXACT_SIZE, similar_size: int = SQL_CACHE_SIMILAR_SIZE,
+                 threshold: float = SQL_CACHE_THRESHOLD, path: Optional[str] = SQL_CACHE_PATH,
+                 save_interval: float = SQL_CACHE_SAVE_INTERVAL):
+        self.exact_size = exact_size
+        self.similar_size = similar_size
+        self.threshold = threshold
+        self.path = path
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        self._exact: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self._similar: "OrderedDict[Tuple[str, str, str], Tuple[Dict[str, int], float, str]]" = OrderedDict()
+        self.stats = {"exact_hits": 0, "exact_misses": 0, "similar_hits": 0, "similar_misses": 0, "evictions": 0}
+
+        if self.path:
+            self.load(self.path)
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _key(question: str, model: str, fingerprint: Optional[str]) -> Tuple[str, str, str]:
+        return normalize_question(question), model, fingerprint or ""
+
+    def get(self, question: str, model: str, fingerprint: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Cerca la SQL per una domanda.
+        Restituisce (sql, livello) con livello "exact"/"similar", oppure (None, None).
+        """
+        key = self._key(question, model, fingerprint)
+        with self._lock:
+            sql = self._exact.get(key)
+            if sql is not None:
+                self._exact.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return sql, "exact"
+            self.stats["exact_misses"] += 1
+
+            if self.similar_size <= 0:
+                return None, None
+            vec, norm = _vectorize(key[0])
+            numbers = _numbers(key[0])
+            best_key, best_score = None, 0.0
+            for other_key, (other_vec, other_norm, _) in self._similar.items():
+                if other_key[1:] != key[1:] or not norm or not other_norm:
+                    continue
+                if _numbers(other_key[0]) != numbers:
+                    continue
+                dot = sum(v * other_vec.get(g, 0) for g, v in vec.items())
+                score = dot / (norm * other_norm)
+                if score > best_score:
+                    best_key, best_score = other_key, score
+
+            if best_key is not None and best_score >= self.threshold:
+                self._similar.move_to_end(best_key)
+                self.stats["similar_hits"] += 1
+                print(f"[DEBUG] Cache SQL per similarità ({best_score:.2f}): '{best_key[0]}'")
+                return self._similar[best_key][2], "similar"
+            self.stats["similar_misses"] += 1
+            return None, None
+
+    def put(self, question: str, model: str, fingerprint: Optional[str], sql: str) -> None:
+        """
+        Memorizza la SQL generata per una domanda in entrambi i livelli.
+        """
+        key = self._key(question, model, fingerprint)
+        with self._lock:
+            self._insert(key, sql)
+        self._mark_dirty()
+
+    def _mark_dirty(self) -> None:
+        # salvataggio differito: al più uno in programma, eseguito da un thread del timer
+        if not self.path:
+            return
+        with self._lock:
+            self._dirty = True
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_interval, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self) -> None:
+        """
+        Salva la cache su `path` se è cambiata dall'ultimo salvataggio.
+        """
+        with self._lock:
+            self._save_timer = None
+            dirty, self._dirty = self._dirty, False
+        if dirty and self.path:
+            self.save(self.path)
+
+    def _insert(self, key: Tuple[str, str, str], sql: str) -> None:
+        self._exact[key] = sql
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.exact_size:
+            self._exact.popitem(last=False)
+            self.stats["evictions"] += 1
+
+        if self.similar_size > 0:
+            vec, norm = _vectorize(key[0])
+            self._similar[key] = (vec, norm, sql)
+            self._similar.move_to_end(key)
+            while len(self._similar) > self.similar_size:
+                self._similar.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def discard(self, question: str, model: str, fingerprint: Optional[str], sql: Optional[str] = None) -> None:
+        """
+        Rimuove una domanda dalla cache (es. SQL risultata non valida).
+        Con `sql` rimuove anche le voci di altre domande (stesso modello e schema)
+        che hanno quella SQL: quella servita per similarità non resta in cache.
+        """
+        key = self._key(question, model, fingerprint)
+        with self._lock:
+            removed = self._exact.pop(key, None) is not None
+            removed = self._similar.pop(key, None) is not None or removed
+            if sql is not None:
+                for other in [k for k, v in self._exact.items() if k[1:] == key[1:] and v == sql]:
+                    removed = self._exact.pop(other, None) is not None or removed
+                for other in [k for k, v in self._similar.items() if k[1:] == key[1:] and v[2] == sql]:
+                    removed = self._similar.pop(other, None) is not None or removed
+        if removed:
+            self._mark_dirty()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._exact.clear()
+            self._similar.clear()
+
+    def info(self) -> Dict:
+        """
+        Contatori hit/miss e dimensioni dei due livelli.
+        """
+        with self._lock:
+            return {**self.stats, "exact_size": len(self._exact), "similar_size": len(self._similar)}
+
+    def save(self, path: str) -> None:
+        """
+        Salva le voci della cache su file JSON (scrittura atomica, un file
+        temporaneo per scrittura; salvataggi contemporanei sono serializzati).
+        """
+        with self._save_lock:
+            with self._lock:
+                entries = [[*key, sql] for key, sql in self._exact.items()]
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp",
+                                           dir=os.path.dirname(os.path.abspath(path)))
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"[ERRORE] Salvataggio cache SQL fallito: {e}")
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def load(self, path: str) -> None:
+        """
+        Carica le voci della cache da file JSON, se presente.
+        """
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"[ERRORE] Caricamento cache SQL fallito: {e}")
+            return
+        with self._lock:
+            for question, model, fingerprint, sql in entries:
+                self._insert((question, model, fingerprint), sql)
+        print(f"[DEBUG] Cache SQL caricata: {len(entries)} voci")
+
+
+sql_cache = SQLCache()
@@ -0,0 +1,398 @@
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+
+class Token(NamedTuple):
+    kind: str    # "word", "quoted_ident", "string", "number", "op", "punct", "variable"
+    value: str
+    pos: int
+
+
+class SQLCheck(NamedTuple):
+    """
+    Esito della validazione: ok=True oppure codice + messaggio + token coinvolto.
+    """
+    ok: bool
+    code: Optional[str] = None
+    message: Optional[str] = None
+    token: Optional[str] = None
+
+
+# Codici che indicano una query non sicura (il resto sono errori di validità)
+UNSAFE_CODES = {"multiple_statements", "not_read_only", "forbidden_keyword", "forbidden_function"}
+
+_FORBIDDEN_KEYWORDS = {
+    "insert", "update", "delete", "drop", "alter", "create", "truncate", "replace", "grant",
+    "revoke", "rename", "load", "call", "handler", "lock", "unlock", "set", "into", "outfile",
+    "dumpfile", "merge", "flush", "kill", "shutdown", "execute", "prepare", "deallocate",
+}
+# Nomi che sono anche funzioni di stringa innocue: INSERT(str, pos, len, new), REPLACE(str, a, b)
+_FUNCTION_OK = {"insert", "replace"}
+_FORBIDDEN_FUNCTIONS = {"sleep", "benchmark", "load_file", "get_lock", "release_lock", "release_all_locks",
+                        "master_pos_wait", "sys_exec", "sys_eval"}
+
+_KEYWORDS = {
+    "select", "from", "where", "and", "or", "not", "in", "is", "null", "like", "between", "as", "on",
+    "join", "left", "right", "inner", "outer", "cross", "natural", "straight_join", "using", "group", "by",
+    "order", "asc", "desc", "having", "limit", "offset", "distinct", "distinctrow", "all", "any", "some",
+    "union", "intersect", "except", "case", "when", "then", "else", "end", "exists", "true", "false",
+    "unknown", "with", "recursive", "over", "partition", "window", "rows", "range", "preceding",
+    "following", "current", "row", "unbounded", "interval", "collate", "escape", "regexp", "rlike",
+    "div", "mod", "xor", "separator", "binary", "signed", "unsigned", "char", "varchar", "date", "time",
+    "datetime", "timestamp", "decimal", "integer", "int", "float", "double", "json", "year", "month",
+    "day", "hour", "minute", "second", "week", "quarter", "microsecond", "year_month", "day_hour",
+    "day_minute", "day_second", "hour_minute", "hour_second", "minute_second", "sounds", "natural",
+    "language", "mode", "boolean", "query", "expansion", "against", "match", "high_priority",
+    "sql_calc_found_rows", "sql_no_cache", "sql_cache", "sql_small_result", "sql_big_result",
+    "ignore", "force", "index", "key", "use", "fetch", "first", "next", "only", "nulls", "last",
+    "value", "values", "lateral", "dual", "nchar", "utf8mb4", "utf8", "latin1", "filter",
+    # funzioni richiamabili senza parentesi
+    "current_date", "current_time", "current_timestamp", "current_user", "current_role", "localtime",
+    "localtimestamp", "utc_date", "utc_time", "utc_timestamp",
+    # parti della sintassi di TRIM(LEADING|TRAILING|BOTH ... FROM ...)
+    "leading", "trailing", "both",
+}
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<exec_comment>/\*M?!\d*)
+  | (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+  | (?P<quoted_ident>`(?:[^`]|``)*`)
+  | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|\.\d+)
+  | (?P<variable>@@?[\w.$]+)
+  | (?P<word>[A-Za-z_À-￿][\w$À-￿]*)
+  | (?P<op><=>|<=|>=|<>|!=|\|\||&&|:=|[-+*/%=<>!~^&|])
+  | (?P<punct>[(),.;?])
+""", re.VERBOSE | re.DOTALL)
+
+
+class SQLSyntaxError(ValueError):
+    pass
+
+
+def tokenize(sql: str) -> List[Token]:
+    """
+    Divide il testo SQL in token (stringhe, identificatori, parole, operatori),
+    scartando spazi e commenti. Il contenuto dei commenti eseguibili di MariaDB
+    (/*! ... */, /*!50000 ... */, /*M! ... */) è codice per il server ed è
+    quindi tokenizzato come il resto della query.
+    """
+    tokens = []
+    pos = 0
+    in_exec_comment = False
+    while pos < len(sql):
+        if in_exec_comment and sql.startswith("*/", pos):
+            in_exec_comment = False
+            pos += 2
+            continue
+        m = _TOKEN_RE.match(sql, pos)
+        if not m:
+            raise SQLSyntaxError(f"Carattere non valido alla posizione {pos}: {sql[pos]!r}")
+        kind = m.lastgroup
+        if kind == "exec_comment":
+            if in_exec_comment:
+                raise SQLSyntaxError(f"Commento eseguibile annidato alla posizione {pos}")
+            in_exec_comment = True
+        elif kind not in ("ws", "comment"):
+            value = m.group(kind)
+            if kind == "quoted_ident":
+                value = value[1:-1].replace("``", "`")
+            tokens.append(Token(kind, value, pos))
+        pos = m.end()
+    if in_exec_comment:
+        raise SQLSyntaxError("Commento eseguibile non chiuso")
+    return tokens
+
+
+def _is_word(tok: Optional[Token], *values: str) -> bool:
+    return tok is not None and tok.kind == "word" and tok.value.lower() in values
+
+
+def _is_punct(tok: Optional[Token], value: str) -> bool:
+    return tok is not None and tok.kind == "punct" and tok.value == value
+
+
+def _ident(tok: Optional[Token]) -> Optional[str]:
+    if tok is None:
+        return None
+    if tok.kind == "quoted_ident" or (tok.kind == "word" and tok.value.lower() not in _KEYWORDS):
+        return tok.value
+    return None
+
+
+def _check_safety(tokens: List[Token]) -> Optional[SQLCheck]:
+    # una sola istruzione (un eventuale ';' finale è ammesso)
+    for i, tok in enumerate(tokens):
+        if _is_punct(tok, ";") and i != len(tokens) - 1:
+            return SQLCheck(False, "multiple_statements", "Ammessa una sola istruzione SQL", ";")
+
+    first = next((t for t in tokens if not _is_punct(t, "(")), None)
+    if not _is_word(first, "select", "with"):
+        return SQLCheck(False, "not_read_only", "Ammesse solo query SELECT (o WITH ... SELECT)",
+                        first.value if first else None)
+
+    for i, tok in enumerate(tokens):
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        if tok.kind == "variable" and tok.value.startswith("@") and nxt is not None and nxt.value == ":=":
+            return SQLCheck(False, "forbidden_keyword", "Assegnazione di variabili non permessa", tok.value)
+        if tok.kind != "word":
+            continue
+        word = tok.value.lower()
+        is_call = _is_punct(nxt, "(")
+        prev = tokens[i - 1] if i > 0 else None
+        if _is_punct(prev, "."):
+            continue  # nome qualificato (alias.colonna), non una keyword
+        if word in _FORBIDDEN_FUNCTIONS and is_call:
+            return SQLCheck(False, "forbidden_function", f"Funzione {tok.value.upper()} non permessa", tok.value)
+        if word in _FORBIDDEN_KEYWORDS and not (is_call and word in _FUNCTION_OK):
+            return SQLCheck(False, "forbidden_keyword", f"Operazione {tok.value.upper()} non permessa", tok.value)
+    return None
+
+
+def _check_schema(tokens: List[Token], schema: Dict[str, Set[str]]) -> Optional[SQLCheck]:
+    """
+    Verifica tabelle e colonne referenziate rispetto allo schema {tabella: {colonne}}.
+    Le colonne non qualificate sono verificate solo se tutte le sorgenti
+    della query sono tabelle reali (niente CTE o tabelle derivate).
+    """
+    tables = {t.lower(): {c.lower() for c in cols} for t, cols in schema.items()}
+    virtual: Set[str] = set()      # CTE, tabelle derivate, alias di colonna
+    aliases: Dict[str, Optional[str]] = {}  # alias/nome -> tabella reale (None se virtuale)
+    opaque = False                 # presenti sorgenti di cui non conosciamo le colonne
+
+    # nomi delle CTE: WITH nome [(colonne)] AS ( ... ), nome AS ( ... )
+    for i, tok in enumerate(tokens):
+        if _is_word(tok, "as") and _is_punct(tokens[i + 1] if i + 1 < len(tokens) else None, "("):
+            j = i - 1
+            if _is_punct(tokens[j] if j >= 0 else None, ")"):
+                while j >= 0 and not _is_punct(tokens[j], "("):
+                    j -= 1
+                j -= 1
+            name = _ident(tokens[j]) if j >= 0 else None
+            if name:
+                virtual.add(name.lower())
+                aliases[name.lower()] = None
+                opaque = True
+
+    # sorgenti: FROM/JOIN tabella [AS] alias [, tabella [AS] alias ...]
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if not ((_is_word(tok, "from", "join") and _is_table_source(tokens, i))
+                or (_is_punct(tok, ",") and _in_from_list(tokens, i))):
+            i += 1
+            continue
+        i += 1
+        if _is_punct(tokens[i] if i < len(tokens) else None, "("):
+            # tabella derivata: il suo alias è virtuale
+            depth, i = 1, i + 1
+            while i < len(tokens) and depth:
+                depth += 1 if _is_punct(tokens[i], "(") else -1 if _is_punct(tokens[i], ")") else 0
+                i += 1
+            alias_tok = tokens[i + 1] if _is_word(tokens[i] if i < len(tokens) else None, "as") else (
+                tokens[i] if i < len(tokens) else None)
+            alias = _ident(alias_tok)
+            if alias:
+                virtual.add(alias.lower())
+                aliases[alias.lower()] = None
+            opaque = True
+            continue
+
+        name = _ident(tokens[i] if i < len(tokens) else None)
+        if name is None:
+            continue
+        qualifier = None
+        if _is_punct(tokens[i + 1] if i + 1 < len(tokens) else None, "."):
+            qualifier, name = name, _ident(tokens[i + 2] if i + 2 < len(tokens) else None) or ""
+            i += 2
+        i += 1
+
+        if qualifier:
+            aliases.setdefault(qualifier.lower(), None)
+        if qualifier and qualifier.lower() == "information_schema":
+            opaque = True
+            real = None
+        elif name.lower() in virtual:
+            real = None
+        elif name.lower() in tables:
+            real = name.lower()
+        else:
+            return SQLCheck(False, "unknown_table", f"Tabella '{name}' non presente nello schema", name)
+        aliases[name.lower()] = real
+
+        if _is_word(tokens[i] if i < len(tokens) else None, "as"):
+            i += 1
+        alias = _ident(tokens[i] if i < len(tokens) else None)
+        if alias:
+            aliases[alias.lower()] = real
+            i += 1
+
+    # alias di colonna: "... AS nome" oppure implicito "espressione nome"
+    for i, tok in enumerate(tokens[1:], start=1):
+        alias = _ident(tok)
+        prev = tokens[i - 1]
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        if alias is None or _is_punct(nxt, "(") or _is_punct(nxt, "."):
+            continue
+        if (_is_word(prev, "as", "end") or _is_punct(prev, ")") or _ident(prev) is not None
+                or prev.kind in ("string", "number")):
+            virtual.add(alias.lower())
+
+    real_tables = {t for t in aliases.values() if t}
+    all_columns = set().union(*(tables[t] for t in real_tables)) if real_tables else set()
+
+    for i, tok in enumerate(tokens):
+        prev = tokens[i - 1] if i > 0 else None
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        # colonna qualificata: alias.colonna
+        if _is_punct(prev, ".") and i >= 2:
+            owner = _ident(tokens[i - 2])
+            column = tok.value if tok.kind in ("word", "quoted_ident") else None
+            if owner is None or column is None or column == "*":
+                continue
+            if owner.lower() not in aliases:
+                if i >= 4 and _is_punct(tokens[i - 3], "."):
+                    continue  # db.tabella.colonna
+                return SQLCheck(False, "unknown_table", f"Tabella o alias '{owner}' non definito", owner)
+            real = aliases[owner.lower()]
+            if real and column.lower() not in tables[real]:
+                return SQLCheck(False, "unknown_column", f"Colonna '{column}' non presente nella tabella '{real}'",
+                                f"{owner}.{column}")
+            continue
+
+        # colonna non qualificata
+        name = _ident(tok)
+        if (name is None or opaque or not real_tables or _is_punct(nxt, "(") or _is_punct(nxt, ".")
+                or name.lower() in aliases or name.lower() in virtual or name.lower() in all_columns):
+            continue
+        if tok.kind == "word" and _is_from_target(tokens, i):
+            continue
+        # collation e set di caratteri: COLLATE nome, CHARSET nome, CONVERT(x USING nome), _utf8mb4'...'
+        if _is_word(prev, "collate", "charset") or (_is_word(prev, "using") and not _is_punct(nxt, "(")):
+            continue
+        if tok.kind == "word" and tok.value.startswith("_") and nxt is not None and nxt.kind == "string":
+            continue
+        return SQLCheck(False, "unknown_column", f"Colonna '{name}' non presente nelle tabelle "
+                        f"{', '.join(sorted(real_tables))}", name)
+    return None
+
+
+def _in_from_list(tokens: List[Token], i: int) -> bool:
+    # la virgola in posizione i separa tabelle di una FROM (stesso livello di parentesi)?
+    depth = 0
+    for j in range(i - 1, -1, -1):
+        tok = tokens[j]
+        if _is_punct(tok, ")"):
+            depth += 1
+        elif _is_punct(tok, "("):
+            if depth == 0:
+                return False
+            depth -= 1
+        elif depth == 0 and tok.kind == "word":
+            word = tok.value.lower()
+            if word == "from":
+                return _is_table_source(tokens, j)
+            if word in ("select", "where", "group", "order", "having", "limit", "on", "using", "join"):
+                return False
+    return False
+
+
+def _is_table_source(tokens: List[Token], i: int) -> bool:
+    # FROM/JOIN in posizione i introduce tabelle? Sì al livello esterno o in una
+    # sottoquery; no dentro una funzione (EXTRACT(YEAR FROM ...), TRIM(... FROM ...))
+    depth = 0
+    for j in range(i - 1, -1, -1):
+        if _is_punct(tokens[j], ")"):
+            depth += 1
+        elif _is_punct(tokens[j], "("):
+            if depth == 0:
+                return _is_word(tokens[j + 1], "select", "with")
+            depth -= 1
+    return True
+
+
+def _is_from_target(tokens: List[Token], i: int) -> bool:
+    # il token i è un nome di tabella/alias già gestito dall'analisi delle FROM?
+    prev = tokens[i - 1] if i > 0 else None
+    if _is_word(prev, "from", "join"):
+        return _is_table_source(tokens, i - 1)
+    return _is_word(prev, "as") or _is_punct(prev, ",") and _in_from_list(tokens, i - 1)
+
+
+def validate_sql(sql: str, schema: Optional[Dict[str, Iterable[str]]] = None) -> SQLCheck:
+    """
+    Valida una query SQL:
+    - una sola istruzione, di sola lettura (SELECT / WITH ... SELECT);
+    - nessuna keyword o funzione con effetti collaterali (fuori da stringhe e identificatori);
+    - se `schema` ({tabella: colonne}) è fornito, tabelle e colonne referenziate devono esistere.
+    Restituisce un SQLCheck con il motivo strutturato in caso di rifiuto.
+    """
+    try:
+        tokens = tokenize(sql)
+    except SQLSyntaxError as e:
+        return SQLCheck(False, "syntax_error", str(e))
+    if not tokens:
+        return SQLCheck(False, "syntax_error", "Query vuota")
+    if _is_punct(tokens[-1], ";"):
+        tokens = tokens[:-1]
+
+    problem = _check_safety(tokens)
+    if problem:
+        return problem
+
+    depth = 0
+    for tok in tokens:
+        depth += 1 if _is_punct(tok, "(") else -1 if _is_punct(tok, ")") else 0
+        if depth < 0:
+            return SQLCheck(False, "syntax_error", "Parentesi non bilanciate", ")")
+    if depth:
+        return SQLCheck(False, "syntax_error", "Parentesi non bilanciate", "(")
+
+    if schema:
+        problem = _check_schema(tokens, {t: set(cols) for t, cols in schema.items()})
+        if problem:
+            return problem
+    return SQLCheck(True)
+
+
+def bound_limit(sql: str, max_rows: int) -> str:
+    """
+    Limita il numero di righe di una SELECT riscrivendone il LIMIT esterno:
+    aggiunge LIMIT `max_rows` se manca (o se vale solo per l'ultima parte di
+    una UNION) e riduce a `max_rows` un LIMIT numerico più alto
+    (LIMIT n, LIMIT offset, n, LIMIT n OFFSET offset).
+    A differenza di sql_select_limit vale anche per le query con un LIMIT proprio.
+    Le query non analizzabili sono restituite invariate.
+    """
+    try:
+        tokens = tokenize(sql)
+    except SQLSyntaxError:
+        return sql
+    if tokens and _is_punct(tokens[-1], ";"):
+        tokens = tokens[:-1]
+    if not tokens:
+        return sql
+
+    depth, limit_at = 0, None
+    for i, tok in enumerate(tokens):
+        depth += 1 if _is_punct(tok, "(") else -1 if _is_punct(tok, ")") else 0
+        if depth:
+            continue
+        if _is_word(tok, "limit", "fetch"):
+            limit_at = i
+        elif _is_word(tok, "union", "intersect", "except"):
+            limit_at = None
+
+    if limit_at is None:
+        end = _TOKEN_RE.match(sql, tokens[-1].pos).end()
+        return f"{sql[:end]} LIMIT {max_rows}"
+    if _is_word(tokens[limit_at], "fetch"):
+        return sql
+
+    count = tokens[limit_at + 1] if limit_at + 1 < len(tokens) else None
+    if _is_punct(tokens[limit_at + 2] if limit_at + 2 < len(tokens) else None, ","):
+        count = tokens[limit_at + 3] if limit_at + 3 < len(tokens) else None
+    if count is None or count.kind != "number" or not count.value.isdigit() or int(count.value) <= max_rows:
+        return sql
+    return f"{sql[:count.pos]}{max_rows}{sql[count.pos + len(count.value):]}"
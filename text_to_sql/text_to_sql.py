@@ -1,30 +1,100 @@
 import re
 import os
 import json
+import time
+import httpx
+import asyncio
 import requests
+from pathlib import Path
+from db_utils.metrics import REGISTRY, stage
+from .sql_validator import UNSAFE_CODES, validate_sql
+from .ollama_pool import EndpointError, ollama_pool
 
-def build_prompt(schema_text: str, question: str) -> str:
+DEFAULT_MODEL = "gemma3:1b-it-qat"
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "256"))
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "1").lower() in ("1", "true", "yes")
+
+# Permanenza del modello in memoria dopo l'ultima richiesta (evita i caricamenti a freddo)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Opzioni di generazione per tutti i modelli (vuote = default di Ollama)
+_DEFAULT_OPTIONS = {
+    name: cast(value)
+    for name, cast, value in (("num_ctx", int, os.getenv("OLLAMA_NUM_CTX")),
+                              ("num_predict", int, os.getenv("OLLAMA_NUM_PREDICT")),
+                              ("temperature", float, os.getenv("OLLAMA_TEMPERATURE")))
+    if value
+}
+# Override per modello: '{"gemma3:1b-it-qat": {"keep_alive": "1h", "num_ctx": 2048, "temperature": 0}}'
+OLLAMA_MODEL_OPTIONS = json.loads(os.getenv("OLLAMA_MODEL_OPTIONS") or "{}")
+
+# Modelli da preriscaldare all'avvio: OLLAMA_WARMUP_MODELS oppure MODELS=(...) di ollama_service/start.sh
+OLLAMA_START_SCRIPT = Path(os.getenv("OLLAMA_START_SCRIPT",
+                                     Path(__file__).resolve().parents[1] / "ollama_service" / "start.sh"))
+# Candidati della generazione in gara: "modello" o "modello@temperatura", separati da virgola
+# (vuoto = i modelli da preriscaldare, con le loro opzioni)
+OLLAMA_RACE_CANDIDATES = os.getenv("OLLAMA_RACE_CANDIDATES", "")
+
+OLLAMA_TOKENS = REGISTRY.counter("ollama_tokens_total", "Token valutati da Ollama (prompt e generati)",
+                                 ["model", "kind"])
+OLLAMA_DURATION = REGISTRY.histogram("ollama_duration_seconds", "Durate riportate da Ollama in /api/chat",
+                                     ["model", "phase"])
+OLLAMA_FIRST_TOKEN = REGISTRY.histogram("ollama_first_token_seconds", "Latenza al primo token in streaming",
+                                        ["model"])
+
+
+def resolve_model(model: str | None = None) -> str:
+    """
+    Restituisce il modello da usare: quello indicato o DEFAULT_MODEL.
+    """
+    return (model or "").strip() or DEFAULT_MODEL
+
+
+def model_options(model: str) -> tuple[str | None, dict]:
+    """
+    keep_alive e opzioni di generazione (num_ctx, num_predict, temperature, ...)
+    per un modello: default da env, sovrascritti da OLLAMA_MODEL_OPTIONS.
+    """
+    options = {**_DEFAULT_OPTIONS, **OLLAMA_MODEL_OPTIONS.get(model, {})}
+    keep_alive = options.pop("keep_alive", OLLAMA_KEEP_ALIVE) or None
+    return keep_alive, options
+
+
+_RULES = (
+    "Sei un assistente Text-to-SQL per MariaDB.\n"
+    "Regole IMPORTANTI:\n"
+    "- Genera SOLO UNA query SQL, SOLO SELECT (o CTE WITH + SELECT) e nulla più.\n"
+    "- NON usare INSERT/UPDATE/DELETE/CREATE/ALTER/DROP/TRUNCATE/REPLACE/GRANT.\n"
+    "- Usa solo tabelle e colonne presenti nello schema.\n"
+    "- Niente spiegazioni o commenti: restituisci solo SQL.\n"
+)
+
+
+def build_messages(schema_text: str, question: str, context: str | None = None) -> list[dict]:
     """
-    Costruisce un prompt per il modello Ollama in italiano.
+    Costruisce i messaggi per /api/chat di Ollama (in italiano).
+    Regole e schema completo formano il messaggio di sistema, identico byte
+    per byte tra richieste con lo stesso schema: Ollama riusa la KV cache del
+    prefisso e valuta solo il messaggio utente. Ciò che dipende dalla domanda
+    (`context`: schema ridotto, valori di esempio) va nel messaggio utente.
     Regole:
     - Solo SELECT o CTE WITH + SELECT.
     - Usa esclusivamente tabelle/colonne presenti nello schema.
     - Nessuna spiegazione, solo SQL.
     """
+    hint = f"TABELLE RILEVANTI PER LA DOMANDA:\n{context}\n\n" if context else ""
+    return [
+        {"role": "system", "content": f"{_RULES}SCHEMA DEL DATABASE:\n{schema_text}"},
+        {"role": "user", "content": f"{hint}DOMANDA UTENTE:\n{question}\n\n"
+                                    "Rispondi con SOLO il codice SQL (senza backtick)."},
+    ]
+
 
-    return (
-        "Sei un assistente Text-to-SQL per MariaDB.\n"
-        "Regole IMPORTANTI:\n"
-        "- Genera SOLO UNA query SQL, SOLO SELECT (o CTE WITH + SELECT) e nulla più.\n"
-        "- NON usare INSERT/UPDATE/DELETE/CREATE/ALTER/DROP/TRUNCATE/REPLACE/GRANT.\n"
-        "- Usa solo tabelle e colonne presenti nello schema.\n"
-        "- Niente spiegazioni o commenti: restituisci solo SQL.\n"
-        "SCHEMA DEL DATABASE:\n"
-        f"{schema_text}\n\n"
-        "DOMANDA UTENTE:\n"
-        f"{question}\n\n"
-        "Rispondi con SOLO il codice SQL (senza backtick)."
-    )
+def build_prompt(schema_text: str, question: str, context: str | None = None) -> str:
+    """
+    Prompt in un unico testo (stesso contenuto di build_messages).
+    """
+    return "\n\n".join(m["content"] for m in build_messages(schema_text, question, context))
 
 def _sanitize_sql(sql: str) -> str:
     """
@@ -52,9 +122,9 @@ def _sanitize_sql(sql: str) -> str:
     if ";" in s:
         s = s.split(";", 1)[0].strip()
 
-    # blocco keyword pericolose
-    forbidden = ("insert", "update", "delete", "drop", "alter", "create", "truncate", "replace", "grant")
-    if any(kw in s.lower() for kw in forbidden):
+    # blocco keyword pericolose (analisi a token: stringhe e identificatori non contano)
+    check = validate_sql(s)
+    if not check.ok and check.code in UNSAFE_CODES:
         return "SELECT NULL AS warning -- [ERROR] Query contiene keyword pericolose"
 
     # SELECT-only enforcement
@@ -63,41 +133,340 @@ def _sanitize_sql(sql: str) -> str:
 
     return s
 
-def ask_ollama(prompt : str, model: str | None = None) -> str:
+def _ollama_chat_url() -> str:
+    # primo endpoint configurato (OLLAMA_HOSTS / OLLAMA_HOST)
+    return f"{ollama_pool.endpoints[0].url}/api/chat"
+
+
+def _check_status(status_code: int, url: str, model: str) -> None:
+    # 5xx: errore dell'endpoint (conta per il circuit breaker); 404: modello assente su quell'endpoint
+    if status_code >= 500:
+        raise EndpointError(f"{url}: HTTP {status_code}")
+    if status_code == 404:
+        ollama_pool.forget_model(url, model)
+
+
+def _post(url: str, payload: dict, stream: bool = False) -> requests.Response:
+    try:
+        resp = requests.post(
+            f"{url}/api/chat",
+            data=json.dumps(payload),
+            timeout=OLLAMA_TIMEOUT,
+            headers={"Content-Type": "application/json"},
+            stream=stream
+        )
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise EndpointError(f"{url}: {e}") from e
+    _check_status(resp.status_code, url, payload["model"])
+    resp.raise_for_status()
+    return resp
+
+
+def _chat_payload(prompt: str | list[dict], use_model: str, stream: bool = False,
+                  options: dict | None = None) -> dict:
+    # prompt: testo unico (messaggio utente) oppure lista di messaggi (build_messages)
+    # options: sovrascrive per questa chiamata le opzioni del modello (es. temperature)
+    messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+    payload = {
+        "model": use_model,
+        "messages": messages,
+        "stream": stream
+    }
+    keep_alive, model_opts = model_options(use_model)
+    model_opts.update(options or {})
+    if keep_alive:
+        payload["keep_alive"] = keep_alive
+    if model_opts:
+        payload["options"] = model_opts
+    return payload
+
+
+def _record_usage(data: dict) -> None:
+    # contatori finali di /api/chat (risposta completa o ultimo chunk dello stream)
+    model = data.get("model", "")
+    for kind, field in (("prompt", "prompt_eval_count"), ("eval", "eval_count")):
+        if data.get(field) is not None:
+            OLLAMA_TOKENS.inc(data[field], model=model, kind=kind)
+    for phase in ("load", "prompt_eval", "eval", "total"):
+        if data.get(f"{phase}_duration") is not None:
+            OLLAMA_DURATION.observe(data[f"{phase}_duration"] / 1e9, model=model, phase=phase)
+
+
+def _sql_from_response(data: dict) -> str:
+    # estrazione SQL
+    _record_usage(data)
+    raw = data.get("message", {}).get("content", "") or ""
+    with stage("sanitize"):
+        sql = _sanitize_sql(raw)
+    return sql if sql else "SELECT NULL AS warning -- [ERROR] Output vuoto"
+
+
+def ask_ollama(prompt : str | list[dict], model: str | None = None) -> str:
     """
     Interroga Ollama via API REST (/api/chat).
     - Usa modello indicato o default 'gemma3:1b-it-qat'.
-    - Host configurabile via env OLLAMA_HOST (default: http://ollama:11434).
+    - Endpoint scelto dal pool (env OLLAMA_HOSTS o OLLAMA_HOST, default: http://ollama:11434).
     - Restituisce una query SQL SELECT (sanificata con _sanitize_sql).
     """
-    
+
     # setup modello
-    default_model = "gemma3:1b-it-qat"
-    use_model = (model or "").strip() or default_model
+    use_model = resolve_model(model)
+    payload = _chat_payload(prompt, use_model)
+
+    try:
+        with stage("ollama"), ollama_pool.endpoint(use_model) as ep:
+            resp = _post(ep.url, payload)
+        return _sql_from_response(resp.json())
+    except Exception as e:
+        print(f"[DEBUG] Errore in ask_ollama: {e}")
+        return f"SELECT NULL AS warning -- [ERROR] {e}"
 
-    ollama_host = os.getenv("OLLAMA_HOST", "http://ollama:11434").rstrip("/")
-    url = f"{ollama_host}/api/chat"
 
-    payload = {
-        "model": use_model,
-        "messages": [{"role": "user", "content": prompt}],
-        "stream": False
-    }
+_async_client: httpx.AsyncClient | None = None
 
-    try:
-        resp = requests.post(
-            url,
-            data=json.dumps(payload),
-            timeout=120,
-            headers={"Content-Type": "application/json"}
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Client HTTP asincrono condiviso (connessioni keep-alive verso Ollama).
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=OLLAMA_TIMEOUT,
+            limits=httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS,
+                                max_keepalive_connections=OLLAMA_MAX_CONNECTIONS),
         )
-        resp.raise_for_status()
-        data = resp.json()
+    return _async_client
 
-        # estrazione SQL
-        raw = data.get("message", {}).get("content", "") or ""
-        sql = _sanitize_sql(raw)
-        return sql if sql else "SELECT NULL AS warning -- [ERROR] Output vuoto"
+
+async def close_async_client() -> None:
+    """
+    Chiude il client HTTP asincrono condiviso (da chiamare allo shutdown).
+    """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def _chat_async(url: str, payload: dict) -> str:
+    try:
+        resp = await get_async_client().post(f"{url}/api/chat", json=payload)
+    except httpx.TransportError as e:
+        raise EndpointError(f"{url}: {e}") from e
+    _check_status(resp.status_code, url, payload["model"])
+    resp.raise_for_status()
+    return _sql_from_response(resp.json())
+
+
+async def ask_ollama_async(prompt: str | list[dict], model: str | None = None, options: dict | None = None) -> str:
+    """
+    Versione asincrona di ask_ollama: non blocca l'event loop durante la generazione.
+    Con OLLAMA_STREAM attivo usa la generazione in streaming con stop anticipato.
+    L'endpoint è scelto dal pool (least-outstanding, circuit breaker, hedging).
+    `options` sovrascrive le opzioni di generazione del modello (es. temperature).
+    """
+    if OLLAMA_STREAM:
+        sql, _ = await ask_ollama_stream_async(prompt, model, options)
+        return sql
+
+    use_model = resolve_model(model)
+    payload = _chat_payload(prompt, use_model, options=options)
+
+    try:
+        with stage("ollama"):
+            return await ollama_pool.request(use_model, lambda url: _chat_async(url, payload))
     except Exception as e:
-        print(f"[DEBUG] Errore in ask_ollama: {e}")
+        print(f"[DEBUG] Errore in ask_ollama_async: {e}")
         return f"SELECT NULL AS warning -- [ERROR] {e}"
+
+
+# ---------------- STREAMING ----------------
+
+_SQL_START = re.compile(r"(?im)^[ \t]*(with|select)\b")
+_SQL_END = re.compile(r";|```|\n[ \t]*\n")
+
+
+def _complete_statement(text: str) -> str | None:
+    """
+    Se `text` contiene già una istruzione SQL completa la restituisce, da
+    WITH/SELECT fino al terminatore (';', fence di chiusura o riga vuota
+    dopo la SELECT), altrimenti None.
+    """
+    start = _SQL_START.search(text)
+    fence = text.find("```")
+    if fence >= 0 and (start is None or fence < start.start()):
+        # la SQL è dentro un blocco ``` : ignora l'eventuale prosa che lo precede
+        start = _SQL_START.search(text, fence + 3)
+    if not start:
+        return None
+    end = _SQL_END.search(text, start.end())
+    if not end:
+        return None
+    return text[start.start():end.end() if end.group(0) == ";" else end.start()]
+
+
+class _StreamState:
+    """
+    Accumula i chunk NDJSON di /api/chat e misura le latenze di generazione.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_ms: float | None = None
+        self.text = ""
+        self.chunks = 0
+        self.statement: str | None = None
+        self.done = False
+        self.model = ""
+
+    def feed(self, line: str | bytes) -> bool:
+        """
+        Elabora una riga dello stream. Restituisce True se si può smettere di leggere.
+        """
+        if not line:
+            return False
+        data = json.loads(line)
+        if data.get("error"):
+            raise RuntimeError(data["error"])
+        self.model = data.get("model") or self.model
+        content = (data.get("message") or {}).get("content") or ""
+        if content:
+            if self.first_token_ms is None:
+                self.first_token_ms = (time.perf_counter() - self.started) * 1000
+                OLLAMA_FIRST_TOKEN.observe(self.first_token_ms / 1000, model=self.model)
+            self.text += content
+            self.chunks += 1
+            self.statement = _complete_statement(self.text)
+        self.done = bool(data.get("done"))
+        if self.done:
+            _record_usage(data)
+        return self.done or self.statement is not None
+
+    def result(self) -> tuple[str, dict]:
+        raw = self.statement if self.statement is not None else self.text
+        with stage("sanitize"):
+            sql = _sanitize_sql(raw) or "SELECT NULL AS warning -- [ERROR] Output vuoto"
+        stats = {
+            "first_token_ms": round(self.first_token_ms, 1) if self.first_token_ms is not None else None,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "chunks": self.chunks,
+            "stopped_early": self.statement is not None and not self.done,
+        }
+        print(f"[DEBUG] Generazione: primo token {stats['first_token_ms']} ms, "
+              f"totale {stats['total_ms']} ms, stop anticipato={stats['stopped_early']}")
+        return sql, stats
+
+
+def ask_ollama_stream(prompt: str | list[dict], model: str | None = None) -> tuple[str, dict]:
+    """
+    Interroga Ollama in streaming e chiude la connessione (interrompendo la
+    generazione) appena l'output contiene una istruzione SQL completa.
+    Restituisce (sql, stats) con latenza al primo token e totale in ms.
+    """
+    use_model = resolve_model(model)
+    state = _StreamState()
+    try:
+        with stage("ollama"), ollama_pool.endpoint(use_model) as ep:
+            with _post(ep.url, _chat_payload(prompt, use_model, stream=True), stream=True) as resp:
+                for line in resp.iter_lines():
+                    if state.feed(line):
+                        break
+        return state.result()
+    except Exception as e:
+        print(f"[DEBUG] Errore in ask_ollama_stream: {e}")
+        return f"SELECT NULL AS warning -- [ERROR] {e}", state.result()[1]
+
+
+async def _chat_stream_async(url: str, payload: dict) -> tuple[str, dict]:
+    state = _StreamState()
+    try:
+        async with get_async_client().stream("POST", f"{url}/api/chat", json=payload) as resp:
+            _check_status(resp.status_code, url, payload["model"])
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if state.feed(line):
+                    break
+    except httpx.TransportError as e:
+        raise EndpointError(f"{url}: {e}") from e
+    return state.result()
+
+
+async def ask_ollama_stream_async(prompt: str | list[dict], model: str | None = None,
+                                  options: dict | None = None) -> tuple[str, dict]:
+    """
+    Versione asincrona di ask_ollama_stream, con endpoint scelto dal pool
+    (con l'hedging vince il primo stream che produce una SQL completa).
+    """
+    use_model = resolve_model(model)
+    payload = _chat_payload(prompt, use_model, stream=True, options=options)
+    started = time.perf_counter()
+    try:
+        with stage("ollama"):
+            return await ollama_pool.request(use_model, lambda url: _chat_stream_async(url, payload))
+    except Exception as e:
+        print(f"[DEBUG] Errore in ask_ollama_stream_async: {e}")
+        stats = {"first_token_ms": None, "total_ms": round((time.perf_counter() - started) * 1000, 1),
+                 "chunks": 0, "stopped_early": False}
+        return f"SELECT NULL AS warning -- [ERROR] {e}", stats
+
+
+# ---------------- WARM-UP ----------------
+
+def warmup_models() -> list[str]:
+    """
+    Modelli da preriscaldare: OLLAMA_WARMUP_MODELS (separati da virgola) oppure
+    l'array MODELS=(...) di ollama_service/start.sh; in mancanza DEFAULT_MODEL.
+    """
+    env = os.getenv("OLLAMA_WARMUP_MODELS")
+    if env is not None:
+        return [m.strip() for m in env.split(",") if m.strip()]
+    try:
+        m = re.search(r"^MODELS=\((.*?)\)", OLLAMA_START_SCRIPT.read_text(encoding="utf-8"), flags=re.M)
+        if m:
+            return re.findall(r'"([^"]+)"', m.group(1))
+    except OSError:
+        pass
+    return [DEFAULT_MODEL]
+
+
+def race_candidates(model: str | None = None) -> list[tuple[str, float | None]]:
+    """
+    Candidati (modello, temperatura) della generazione in gara: OLLAMA_RACE_CANDIDATES
+    oppure i modelli da preriscaldare (temperatura None = opzioni del modello).
+    Il modello richiesto, se indicato, è il primo candidato.
+    """
+    candidates = []
+    for item in OLLAMA_RACE_CANDIDATES.split(",") if OLLAMA_RACE_CANDIDATES.strip() else warmup_models():
+        name, _, temperature = item.strip().partition("@")
+        if name:
+            candidates.append((name, float(temperature) if temperature else None))
+    if model and model.strip():
+        first = (resolve_model(model), None)
+        candidates = [first] + [c for c in candidates if c != first]
+    return candidates or [(DEFAULT_MODEL, None)]
+
+
+async def warm_up_async(messages: list[dict], models: list[str] | None = None) -> dict:
+    """
+    Carica i modelli in memoria su ogni endpoint del pool (con il loro
+    keep_alive) e valuta il prefisso di sistema, generando un solo token.
+    Restituisce {"endpoint modello": ms oppure errore}.
+    """
+    async def _one(url: str, model: str):
+        payload = _chat_payload(messages, model)
+        payload["options"] = {**payload.get("options", {}), "num_predict": 1}
+        started = time.perf_counter()
+        try:
+            resp = await get_async_client().post(f"{url}/api/chat", json=payload)
+            resp.raise_for_status()
+            return round((time.perf_counter() - started) * 1000, 1)
+        except Exception as e:
+            return f"errore: {e}"
+
+    models = models if models is not None else warmup_models()
+    targets = [(ep.url, m) for ep in ollama_pool.endpoints for m in models]
+    results = await asyncio.gather(*(_one(url, m) for url, m in targets))
+    report = {f"{url} {m}": result for (url, m), result in zip(targets, results)}
+    print(f"[DEBUG] Warm-up modelli Ollama: {report}")
+    return report